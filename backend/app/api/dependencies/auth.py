@@ -3,10 +3,11 @@ from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 
 from app.core.config import SECRET_KEY, API_PREFIX
+from app.core.timing import phase
 from app.models.user import UserInDB
 from app.api.dependencies.database import get_repository
 from app.db.repositories.users import UsersRepository
-from app.services import auth_service
+from app.services import auth_service, principal_cache
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl=f"{API_PREFIX}/users/login/token/")
@@ -17,11 +18,18 @@ async def get_user_from_token(
         token: str = Depends(oauth2_scheme),
         user_repo: UsersRepository = Depends(get_repository(UsersRepository))
 ) -> Optional[UserInDB]:
+    with phase("auth_cache"):
+        user = await principal_cache.get(token)
+    if user is not None:
+        return user
+
     try:
-        username = auth_service.get_username_from_token(token=token, secret_key=str(SECRET_KEY))
-        user = await user_repo.get_user_by_username(username=username)
+        payload = auth_service.get_payload_from_token(token=token, secret_key=str(SECRET_KEY))
+        user = await user_repo.get_user_by_username(username=payload.username)
     except Exception as e:
         raise e
+    if user is not None:
+        await principal_cache.set(token, user, expires_at=payload.exp)
     return user
 
 
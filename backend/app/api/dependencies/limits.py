@@ -0,0 +1,43 @@
+from fastapi import Depends, HTTPException, status
+from starlette.requests import Request
+from dependency_injector.wiring import inject, Provide
+
+from app.core.config import RATE_LIMIT_AUTH_RATE, RATE_LIMIT_AUTH_BURST, FORWARDED_PROXY_HOPS
+from app.core.metrics import REQUESTS_SHED
+from app.redis.containers import Container, container
+from app.redis.limits import RateLimiter
+
+
+def get_client_ip(request: Request) -> str:
+    # only the entries appended by our own proxies can be trusted, a client can put anything in front of them
+    if FORWARDED_PROXY_HOPS > 0:
+        forwarded = [ip.strip() for ip in request.headers.get("x-forwarded-for", "").split(",") if ip.strip()]
+        if forwarded:
+            return forwarded[-min(FORWARDED_PROXY_HOPS, len(forwarded))]
+    return request.client.host if request.client else "unknown"
+
+
+def too_many_requests(retry_after: int) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many requests, slow down.",
+        headers={"Retry-After": str(retry_after)}
+    )
+
+
+@inject
+async def limit_auth_by_ip(
+        request: Request,
+        rate_limiter: RateLimiter = Depends(Provide[Container.rate_limiter])
+) -> None:
+    if RATE_LIMIT_AUTH_RATE <= 0:
+        return
+    allowed, retry_after = await rate_limiter.allow(
+        f"auth:{get_client_ip(request)}", RATE_LIMIT_AUTH_RATE, RATE_LIMIT_AUTH_BURST
+    )
+    if not allowed:
+        REQUESTS_SHED.labels("auth_rate").inc()
+        raise too_many_requests(retry_after)
+
+
+container.wire(modules=[__name__])
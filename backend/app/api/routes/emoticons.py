@@ -1,50 +1,582 @@
-import httpx
+import json
+import time
+import uuid
 import asyncio
-import aiofiles
+import hashlib
 
-from fastapi import APIRouter, Depends
-from fastapi.responses import RedirectResponse
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from fastapi import APIRouter, Body, Depends, Header, HTTPException, Query, status
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, Response
+from starlette.requests import Request
 from dependency_injector.wiring import inject, Provide
 
-from app.redis.containers import Container
+from app.redis.containers import Container, container
 from app.models.user import UserInDB
 from app.api.dependencies.auth import get_current_user
-from app.redis.services import Service
+from app.api.dependencies.limits import too_many_requests
+from app.core.metrics import GENERATIONS, GENERATION_LATENCY, REQUESTS_SHED
+from app.redis.services import Service, UNTAGGED_MARKER
+from app.redis.generation import GenerationQueue
+from app.redis.limits import RateLimiter
+from app.services import emoticon_generator, emoticon_catalog, variant_renderer
+from app.services.upstream import UpstreamRejected, UpstreamUnavailable
+from app.services.variants import MEDIA_TYPES, sprite_columns
+from app.storage import storage
+from app.storage.files import DERIVED_PREFIXES, ObjectTooLarge, StoredImage, sprite_name, variant_name
+from app.core.config import (
+    EMOTICON_LEASE_TTL,
+    EMOTICON_LEASE_POLL_INTERVAL,
+    EMOTICON_BATCH_MAX_WORDS,
+    EMOTICON_BATCH_CONCURRENCY,
+    EMOTICON_MAX_BYTES,
+    MEDIA_STORAGE,
+    EMOTICON_SERVE_MODE,
+    EMOTICON_CACHE_MAX_AGE,
+    EMOTICON_MISS_MODE,
+    USAGE_TOP_MAX,
+    RATE_LIMIT_HIT_RATE,
+    RATE_LIMIT_HIT_BURST,
+    RATE_LIMIT_MISS_RATE,
+    RATE_LIMIT_MISS_BURST,
+    GENERATION_MAX_IN_FLIGHT,
+    GENERATION_SHED_RETRY_AFTER,
+    EMOTICON_VARIANT_SIZES,
+    EMOTICON_VARIANT_FORMATS,
+    SPRITE_CELL_SIZE,
+)
 
 router = APIRouter()
 
+_in_flight: Dict[str, asyncio.Future] = {}
+
+BUDGETS = {
+    "hit": (RATE_LIMIT_HIT_RATE, RATE_LIMIT_HIT_BURST),
+    "miss": (RATE_LIMIT_MISS_RATE, RATE_LIMIT_MISS_BURST),
+}
+
+
+VARIANT_SIZES = sorted(int(size) for size in EMOTICON_VARIANT_SIZES)
+VARIANT_FORMATS = [image_format for image_format in EMOTICON_VARIANT_FORMATS if image_format in MEDIA_TYPES]
+
+Variant = Tuple[Optional[int], str]
+
+
+class GenerationOverloaded(Exception):
+    pass
 
-async def fetch_emoticon(emoticon_word: str):
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"http://emoticon:8080/monster/{emoticon_word}")
-        return response.content
 
+def get_emoticon_url(emoticon_word: str) -> str:
+    return storage.url(emoticon_word)
 
-async def save_image(emoticon_word: str, image):
-    async with aiofiles.open(f"media/{emoticon_word}.png", 'wb') as f:
-        await f.write(image)
+
+def fetch_emoticon(emoticon_word: str) -> AsyncIterator[bytes]:
+    return emoticon_generator.stream(emoticon_word)
+
+
+async def save_image(emoticon_word: str, chunks: AsyncIterator[bytes]) -> StoredImage:
+    return await storage.write_stream(emoticon_word, chunks, max_size=EMOTICON_MAX_BYTES)
 
 
 async def handle_new_emoticon(emoticon_word, service):
-    await asyncio.gather(
-        save_image(emoticon_word, await fetch_emoticon(emoticon_word)),
-        service.save_emoticon_word(emoticon_word)
+    started = time.perf_counter()
+    try:
+        stored = await save_image(emoticon_word, fetch_emoticon(emoticon_word))
+    except Exception:
+        GENERATIONS.labels("error").inc()
+        raise
+    GENERATIONS.labels("ok").inc()
+    GENERATION_LATENCY.observe(time.perf_counter() - started)
+    # the marker goes last so no worker ever redirects to a file that isn't in place yet
+    await service.save_emoticon_word(emoticon_word, size=stored.size, etag=stored.etag)
+    emoticon_catalog.record(emoticon_word, storage.relative_path(emoticon_word), stored.size, stored.etag)
+
+
+async def wait_for_emoticon(emoticon_word, service) -> bool:
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + EMOTICON_LEASE_TTL
+    while loop.time() < deadline:
+        await asyncio.sleep(EMOTICON_LEASE_POLL_INTERVAL)
+        if await service.get_emoticon_word(emoticon_word):
+            return True
+        # the holder gave up without saving a marker (failed render) or its lease ran out, stop waiting on it;
+        # the marker is read once more because it is written right before the lease is released
+        if not await service.lease_exists(emoticon_word):
+            return bool(await service.get_emoticon_word(emoticon_word))
+    return False
+
+
+async def handle_new_emoticon_with_lease(emoticon_word, service):
+    token = uuid.uuid4().hex
+    leased = await service.acquire_lease(emoticon_word, token, EMOTICON_LEASE_TTL)
+    if not leased:
+        if await wait_for_emoticon(emoticon_word, service):
+            return
+        # one of the followers takes the lease over and renders, the others wait for it once more
+        leased = await service.acquire_lease(emoticon_word, token, EMOTICON_LEASE_TTL)
+        if not leased and await wait_for_emoticon(emoticon_word, service):
+            return
+    if not leased:
+        # the lease is still held past its ttl by a worker that stalled, render it here instead
+        await handle_new_emoticon(emoticon_word, service)
+        return
+
+    try:
+        if not await service.get_emoticon_word(emoticon_word) or storage.stat(emoticon_word) is None:
+            await handle_new_emoticon(emoticon_word, service)
+    finally:
+        await service.release_lease(emoticon_word, token)
+
+
+async def run_once(key: str, factory: Callable[[], Awaitable]) -> None:
+    future = _in_flight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(factory())
+        _in_flight[key] = future
+        future.add_done_callback(lambda _: _in_flight.pop(key, None))
+    # shield so a client hanging up doesn't cancel the render for everyone else waiting on it
+    await asyncio.shield(future)
+
+
+async def handle_new_emoticon_once(emoticon_word, service):
+    await run_once(emoticon_word, lambda: handle_new_emoticon_with_lease(emoticon_word, service))
+
+
+def shed_if_overloaded(key: str) -> None:
+    # joining a render that is already running costs nothing, only new renders count against the limit
+    if 0 < GENERATION_MAX_IN_FLIGHT <= len(_in_flight) and key not in _in_flight:
+        REQUESTS_SHED.labels("generation_concurrency").inc()
+        raise GenerationOverloaded()
+
+
+async def handle_new_emoticon_or_shed(emoticon_word, service):
+    shed_if_overloaded(emoticon_word)
+    await handle_new_emoticon_once(emoticon_word, service)
+
+
+async def handle_new_variant(emoticon_word, variant: Variant, service):
+    name = variant_name(emoticon_word, *variant)
+    original = await storage.read(emoticon_word)
+    if original is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Emoticon is not available.")
+    image = await variant_renderer.render(bytes(original), *variant)
+    stored = await storage.write(name, image)
+    await service.save_emoticon_word(name, size=stored.size, etag=stored.etag)
+    emoticon_catalog.record(name, storage.relative_path(name), stored.size, stored.etag)
+
+
+async def handle_new_variant_or_shed(emoticon_word, variant: Variant, service):
+    name = variant_name(emoticon_word, *variant)
+    shed_if_overloaded(name)
+    await run_once(name, lambda: handle_new_variant(emoticon_word, variant, service))
+
+
+def sprite_sheet_digest(emoticon_words: List[str], cell_size: int) -> str:
+    return hashlib.sha256(json.dumps([cell_size, sorted(emoticon_words)]).encode("utf-8")).hexdigest()
+
+
+def sprite_atlas(emoticon_words: List[str], cell_size: int) -> Dict[str, Dict[str, int]]:
+    # tiles are laid out in sorted order, so the atlas follows from the word set and never has to be stored
+    columns = sprite_columns(len(emoticon_words))
+    return {
+        emoticon_word: {
+            "x": i % columns * cell_size, "y": i // columns * cell_size, "w": cell_size, "h": cell_size
+        }
+        for i, emoticon_word in enumerate(sorted(emoticon_words))
+    }
+
+
+async def handle_new_sprite_sheet(emoticon_words: List[str], cell_size: int, service):
+    name = sprite_name(sprite_sheet_digest(emoticon_words, cell_size))
+    images = await asyncio.gather(*(storage.read(emoticon_word) for emoticon_word in sorted(emoticon_words)))
+    if any(image is None for image in images):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Emoticon is not available.")
+    sheet = await variant_renderer.render_sheet([bytes(image) for image in images], cell_size)
+    stored = await storage.write(name, sheet)
+    await service.save_emoticon_word(name, size=stored.size, etag=stored.etag)
+    emoticon_catalog.record(name, storage.relative_path(name), stored.size, stored.etag)
+
+
+def check_emoticon_words(emoticon_words: List[str]) -> None:
+    # derived renditions are stored and marked under these names, a requested word must never address one of them
+    if any(emoticon_word.startswith(DERIVED_PREFIXES) for emoticon_word in emoticon_words):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Emoticon words can't start with {', '.join(DERIVED_PREFIXES)}."
+        )
+
+
+def get_variant(size: Optional[int], image_format: Optional[str]) -> Optional[Variant]:
+    # only a fixed set of renditions is ever derived, so arbitrary sizes can't flood storage and Redis
+    if size is not None and size not in VARIANT_SIZES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"size must be one of {', '.join(map(str, VARIANT_SIZES))}."
+        )
+    if image_format is not None and image_format not in VARIANT_FORMATS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"format must be one of {', '.join(VARIANT_FORMATS)}."
+        )
+    if size is None and image_format in (None, "png"):
+        return None
+    return size, image_format or "png"
+
+
+async def take_budget(rate_limiter: RateLimiter, budget: str, username: str, cost: int = 1) -> Tuple[int, int]:
+    rate, burst = BUDGETS[budget]
+    if rate <= 0:
+        return cost, 0
+    granted, retry_after = await rate_limiter.take(f"{budget}:{username}", rate, burst, cost, partial=True)
+    if granted < cost:
+        REQUESTS_SHED.labels(f"{budget}_rate").inc(cost - granted)
+    return granted, retry_after
+
+
+class EmoticonFileResponse(FileResponse):
+    chunk_size = 64 * 1024
+
+
+class PackedImageResponse(Response):
+    # the body is a slice of the segment's mmap, handed to the server without copying it into bytes
+    def render(self, content: memoryview) -> memoryview:
+        return content
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = {candidate.strip() for candidate in if_none_match.split(",")}
+    return "*" in candidates or f'"{etag}"' in candidates or f'W/"{etag}"' in candidates
+
+
+async def serve_emoticon(
+        emoticon_word: str, marker: str, if_none_match: Optional[str], service, media_type: str = "image/png"
+) -> Optional[Response]:
+    # packed images have no file of their own to redirect to
+    if EMOTICON_SERVE_MODE != "direct" and MEDIA_STORAGE != "pack":
+        return RedirectResponse(get_emoticon_url(emoticon_word))
+
+    # the marker can be gone by the time the file is served (evicted right after a render), the file still has an etag
+    untagged = marker is None or marker == UNTAGGED_MARKER
+    headers = {"Cache-Control": f"public, max-age={EMOTICON_CACHE_MAX_AGE}, immutable"}
+    if not untagged:
+        headers["ETag"] = f'"{marker}"'
+        if etag_matches(if_none_match, marker):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if MEDIA_STORAGE == "pack":
+        image = await storage.read(emoticon_word)
+        if image is None:
+            return None
+    else:
+        stat_result = storage.stat(emoticon_word)
+        if stat_result is None:
+            return None
+    if untagged:
+        etag = await storage.compute_etag(emoticon_word)
+        if marker is not None:
+            await service.set_emoticon_etag(emoticon_word, etag)
+        marker = etag
+        headers["ETag"] = f'"{marker}"'
+        if etag_matches(if_none_match, marker):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if MEDIA_STORAGE == "pack":
+        return PackedImageResponse(image, media_type=media_type, headers=headers)
+    return EmoticonFileResponse(
+        storage.path(emoticon_word), media_type=media_type, headers=headers, stat_result=stat_result
+    )
+
+
+@router.post("/batch", name="emoticons:fetch-emoticons-batch")
+@inject
+async def emoticons_batch(
+        response: Response,
+        emoticon_words: List[str] = Body(..., embed=True),
+        service: Service = Depends(Provide[Container.service]),
+        generation_queue: GenerationQueue = Depends(Provide[Container.generation_queue]),
+        rate_limiter: RateLimiter = Depends(Provide[Container.rate_limiter]),
+        current_user: UserInDB = Depends(get_current_user)
+) -> Dict[str, Optional[str]]:
+    emoticon_words = list(dict.fromkeys(emoticon_words))
+    if len(emoticon_words) > EMOTICON_BATCH_MAX_WORDS:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"At most {EMOTICON_BATCH_MAX_WORDS} emoticons can be fetched at once."
+        )
+    check_emoticon_words(emoticon_words)
+
+    saved = await service.get_emoticon_words(emoticon_words)
+    semaphore = asyncio.Semaphore(EMOTICON_BATCH_CONCURRENCY)
+
+    async def generate(emoticon_word):
+        async with semaphore:
+            await handle_new_emoticon_or_shed(emoticon_word, service)
+
+    hits, misses = [], []
+    for emoticon_word in emoticon_words:
+        service.count_emoticon_request(emoticon_word, current_user.username, hit=bool(saved[emoticon_word]))
+        if saved[emoticon_word]:
+            hits.append(emoticon_word)
+        else:
+            misses.append(emoticon_word)
+
+    # words past the budget come back as None, like failed renders, the rest of the batch is still served
+    (hits_granted, hits_retry_after), (misses_granted, misses_retry_after) = await asyncio.gather(
+        take_budget(rate_limiter, "hit", current_user.username, len(hits)),
+        take_budget(rate_limiter, "miss", current_user.username, len(misses))
     )
+    throttled = set(hits[hits_granted:]) | set(misses[misses_granted:])
+    retry_after = max(hits_retry_after, misses_retry_after)
+    hits, misses = hits[:hits_granted], misses[:misses_granted]
+    for emoticon_word in hits:
+        service.touch_emoticon_word(emoticon_word)
+        emoticon_catalog.touch(emoticon_word)
+
+    if EMOTICON_MISS_MODE == "queue":
+        await asyncio.gather(*(generation_queue.enqueue(emoticon_word) for emoticon_word in misses))
+        failed = set(misses)
+    else:
+        results = await asyncio.gather(*(generate(emoticon_word) for emoticon_word in misses), return_exceptions=True)
+        failed = {emoticon_word for emoticon_word, result in zip(misses, results) if isinstance(result, Exception)}
+        if any(isinstance(result, GenerationOverloaded) for result in results):
+            retry_after = max(retry_after, GENERATION_SHED_RETRY_AFTER)
+    if retry_after:
+        response.headers["Retry-After"] = str(retry_after)
+
+    failed |= throttled
+    return {
+        emoticon_word: None if emoticon_word in failed else get_emoticon_url(emoticon_word)
+        for emoticon_word in emoticon_words
+    }
+
+
+@router.post("/sprite", name="emoticons:sprite-sheet")
+@inject
+async def emoticons_sprite_sheet(
+        request: Request,
+        emoticon_words: List[str] = Body(..., embed=True),
+        size: int = Body(SPRITE_CELL_SIZE, embed=True),
+        service: Service = Depends(Provide[Container.service]),
+        generation_queue: GenerationQueue = Depends(Provide[Container.generation_queue]),
+        rate_limiter: RateLimiter = Depends(Provide[Container.rate_limiter]),
+        current_user: UserInDB = Depends(get_current_user)
+) -> Response:
+    emoticon_words = list(dict.fromkeys(emoticon_words))
+    if not 0 < len(emoticon_words) <= EMOTICON_BATCH_MAX_WORDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Between 1 and {EMOTICON_BATCH_MAX_WORDS} emoticons can be put on one sprite sheet."
+        )
+    check_emoticon_words(emoticon_words)
+    if size not in VARIANT_SIZES and size != SPRITE_CELL_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"size must be one of {', '.join(map(str, sorted({*VARIANT_SIZES, SPRITE_CELL_SIZE})))}."
+        )
+
+    # a cached sheet answers without looking at its words, even if some of their own files were evicted since
+    sheet_name = sprite_name(sprite_sheet_digest(emoticon_words, size))
+    saved = await service.get_emoticon_words([sheet_name] + emoticon_words)
+    if saved[sheet_name]:
+        saved = {emoticon_word: True for emoticon_word in emoticon_words}
+    misses = [emoticon_word for emoticon_word in emoticon_words if not saved[emoticon_word]]
+    for emoticon_word in emoticon_words:
+        service.count_emoticon_request(emoticon_word, current_user.username, hit=bool(saved[emoticon_word]))
+    # every cold word is a render, so misses are charged one by one like in the batch route;
+    # words past the budget are left off the sheet and come back in "missing"
+    if misses:
+        granted, retry_after = await take_budget(rate_limiter, "miss", current_user.username, len(misses))
+    else:
+        granted, retry_after = await take_budget(rate_limiter, "hit", current_user.username)
+    if not granted:
+        raise too_many_requests(retry_after)
+    misses, throttled = misses[:granted], misses[granted:]
+    headers = {"Retry-After": str(retry_after)} if throttled else {}
+
+    if misses and EMOTICON_MISS_MODE == "queue":
+        await asyncio.gather(*(generation_queue.enqueue(emoticon_word) for emoticon_word in misses))
+        return JSONResponse(
+            status_code=status.HTTP_202_ACCEPTED,
+            content={"status": "pending", "missing": misses + throttled},
+            headers={"Retry-After": str(max(1, retry_after))}
+        )
+
+    # misses go through the same generation path as the batch route; words that still fail are left off the sheet
+    semaphore = asyncio.Semaphore(EMOTICON_BATCH_CONCURRENCY)
+
+    async def generate(emoticon_word):
+        async with semaphore:
+            await handle_new_emoticon_or_shed(emoticon_word, service)
+
+    results = await asyncio.gather(*(generate(emoticon_word) for emoticon_word in misses), return_exceptions=True)
+    missing = [emoticon_word for emoticon_word, result in zip(misses, results) if isinstance(result, Exception)]
+    missing += throttled
+    emoticon_words = [emoticon_word for emoticon_word in emoticon_words if emoticon_word not in missing]
+    if not emoticon_words:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="None of the emoticons could be generated, try again later.",
+            headers={"Retry-After": str(emoticon_generator.retry_after())}
+        )
+
+    digest = sprite_sheet_digest(emoticon_words, size)
+    name = sprite_name(digest)
+    if not await service.get_emoticon_word(name):
+        try:
+            shed_if_overloaded(name)
+            await run_once(name, lambda: handle_new_sprite_sheet(emoticon_words, size, service))
+        except GenerationOverloaded:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many emoticons are being generated right now, try again later.",
+                headers={"Retry-After": str(GENERATION_SHED_RETRY_AFTER)}
+            )
+    for emoticon_word in emoticon_words:
+        service.touch_emoticon_word(emoticon_word)
+        emoticon_catalog.touch(emoticon_word)
+
+    return JSONResponse(content={
+        "url": request.url_for("emoticons:sprite-sheet-image", digest=digest),
+        "size": size,
+        "atlas": sprite_atlas(emoticon_words, size),
+        "missing": missing,
+    }, headers=headers)
+
+
+@router.get("/sprite/{digest}", name="emoticons:sprite-sheet-image")
+@inject
+async def emoticons_sprite_sheet_image(
+        digest: str,
+        if_none_match: Optional[str] = Header(None),
+        service: Service = Depends(Provide[Container.service]),
+        current_user: UserInDB = Depends(get_current_user)
+) -> Response:
+    name = sprite_name(digest)
+    marker = await service.get_emoticon_word(name)
+    response = await serve_emoticon(name, marker, if_none_match, service) if marker else None
+    if response is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Sprite sheet is not available.")
+    service.touch_emoticon_word(name)
+    emoticon_catalog.touch(name)
+    return response
+
+
+@router.get("/stats/top", name="emoticons:top-words")
+@inject
+async def top_emoticon_words(
+        limit: int = 10,
+        service: Service = Depends(Provide[Container.service]),
+        current_user: UserInDB = Depends(get_current_user)
+) -> Dict[str, List[Dict]]:
+    if not 0 < limit <= USAGE_TOP_MAX:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"limit must be between 1 and {USAGE_TOP_MAX}."
+        )
+    top = await service.get_top_emoticon_words(limit)
+    return {
+        "words": [
+            {"word": emoticon_word, "requests": requests, "hits": requests - misses, "misses": misses}
+            for emoticon_word, requests, misses in top
+        ]
+    }
+
+
+@router.get("/status/{emoticon_word}", name="emoticons:generation-status")
+@inject
+async def emoticon_generation_status(
+        emoticon_word: str,
+        service: Service = Depends(Provide[Container.service]),
+        generation_queue: GenerationQueue = Depends(Provide[Container.generation_queue]),
+        current_user: UserInDB = Depends(get_current_user)
+) -> Dict[str, Optional[str]]:
+    check_emoticon_words([emoticon_word])
+    if await service.get_emoticon_word(emoticon_word):
+        return {"status": "ready", "url": get_emoticon_url(emoticon_word)}
+    return {"status": await generation_queue.status(emoticon_word) or "missing", "url": None}
 
 
 @router.get("/{emoticon_word}")
 @inject
 async def emoticons(
         emoticon_word: str,
+        request: Request,
+        size: Optional[int] = None,
+        image_format: Optional[str] = Query(None, alias="format"),
+        if_none_match: Optional[str] = Header(None),
         service: Service = Depends(Provide[Container.service]),
+        generation_queue: GenerationQueue = Depends(Provide[Container.generation_queue]),
+        rate_limiter: RateLimiter = Depends(Provide[Container.rate_limiter]),
         current_user: UserInDB = Depends(get_current_user)
-) -> RedirectResponse:
-    if not await service.get_emoticon_word(emoticon_word):
-        await handle_new_emoticon(emoticon_word, service)
-    return RedirectResponse(f"http://127.0.0.1/emoticon_files/{emoticon_word}.png")
+) -> Response:
+    check_emoticon_words([emoticon_word])
+    variant = get_variant(size, image_format)
+    key = emoticon_word if variant is None else variant_name(emoticon_word, *variant)
+    media_type = MEDIA_TYPES[variant[1] if variant else "png"]
+
+    marker = await service.get_emoticon_word(key)
+    service.count_emoticon_request(emoticon_word, current_user.username, hit=bool(marker))
+    if marker:
+        granted, retry_after = await take_budget(rate_limiter, "hit", current_user.username)
+        if not granted:
+            raise too_many_requests(retry_after)
+        service.touch_emoticon_word(key)
+        emoticon_catalog.touch(key)
+        response = await serve_emoticon(key, marker, if_none_match, service, media_type)
+        if response is not None:
+            return response
+        # the marker outlived its file, fall through and render it again
+
+    granted, retry_after = await take_budget(rate_limiter, "miss", current_user.username)
+    if not granted:
+        raise too_many_requests(retry_after)
+
+    # a variant is derived from the stored original, which may have to be rendered first
+    needs_original = variant is None or not (
+        await service.get_emoticon_word(emoticon_word) and storage.exists(emoticon_word)
+    )
+    if needs_original and EMOTICON_MISS_MODE == "queue":
+        await generation_queue.enqueue(emoticon_word)
+        return JSONResponse(
+            status_code=status.HTTP_202_ACCEPTED,
+            content={
+                "status": "pending",
+                "status_url": request.url_for("emoticons:generation-status", emoticon_word=emoticon_word),
+            },
+            headers={"Retry-After": "1"}
+        )
+
+    try:
+        if needs_original:
+            await handle_new_emoticon_or_shed(emoticon_word, service)
+        if variant is not None:
+            await handle_new_variant_or_shed(emoticon_word, variant, service)
+    except GenerationOverloaded:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many emoticons are being generated right now, try again later.",
+            headers={"Retry-After": str(GENERATION_SHED_RETRY_AFTER)}
+        )
+    except UpstreamUnavailable:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Emoticon generator is unavailable, try again later.",
+            headers={"Retry-After": str(emoticon_generator.retry_after())}
+        )
+    except UpstreamRejected as e:
+        raise HTTPException(status_code=e.status_code, detail="Emoticon generator rejected the word.")
+    except ObjectTooLarge:
+        raise HTTPException(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            detail="Emoticon generator returned an image over the size limit."
+        )
+
+    marker = await service.get_emoticon_word(key)
+    response = await serve_emoticon(key, marker, if_none_match, service, media_type)
+    if response is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Emoticon is not available.")
+    return response
 
 
-container = Container()
-container.config.redis_host.from_env("REDIS_HOST", "redis")
-container.config.redis_password.from_env("REDIS_PASSWORD", "password")
 container.wire(modules=[__name__])
@@ -8,12 +8,19 @@ from app.models.token import AccessToken
 from app.db.repositories.users import UsersRepository
 from app.services import auth_service
 from app.api.dependencies.auth import get_current_user
+from app.api.dependencies.limits import limit_auth_by_ip
 
 
 router = APIRouter()
 
 
-@router.post("/register_user", name="users:register-new-user", response_model=UserPublic, status_code=HTTP_201_CREATED)
+@router.post(
+    "/register_user",
+    name="users:register-new-user",
+    response_model=UserPublic,
+    status_code=HTTP_201_CREATED,
+    dependencies=[Depends(limit_auth_by_ip)]
+)
 async def register_new_user(
         new_user: UserCreate = Body(..., embed=True),
         user_repo: UsersRepository = Depends(get_repository(UsersRepository))
@@ -25,7 +32,12 @@ async def register_new_user(
     return UserPublic(**created_user.dict(), access_token=access_token)
 
 
-@router.post("/login/token/", response_model=AccessToken, name="users:login-username-and-password")
+@router.post(
+    "/login/token/",
+    response_model=AccessToken,
+    name="users:login-username-and-password",
+    dependencies=[Depends(limit_auth_by_ip)]
+)
 async def user_login_with_username_and_password(
         user_repo: UsersRepository = Depends(get_repository(UsersRepository)),
         form_data: OAuth2PasswordRequestForm = Depends(OAuth2PasswordRequestForm)
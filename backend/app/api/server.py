@@ -2,6 +2,8 @@ from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
 
 from app.core import config, tasks
+from app.core.metrics import MetricsMiddleware, metrics
+from app.core.timing import ServerTimingMiddleware, ProfilerMiddleware
 from app.api.routes import router as api_router
 
 
@@ -15,11 +17,15 @@ def get_application():
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    app.add_middleware(ProfilerMiddleware)
+    app.add_middleware(ServerTimingMiddleware)
+    app.add_middleware(MetricsMiddleware)
 
     app.add_event_handler("startup", tasks.create_start_app_handler(app))
     app.add_event_handler("shutdown", tasks.create_stop_app_handler(app))
 
     app.include_router(api_router, prefix='/api')
+    app.add_route("/metrics", metrics, include_in_schema=False)
     return app
 
 
@@ -1,6 +1,6 @@
 from databases import DatabaseURL
 from starlette.config import Config
-from starlette.datastructures import Secret
+from starlette.datastructures import CommaSeparatedStrings, Secret
 
 
 config = Config(".env")
@@ -29,3 +29,110 @@ DATABASE_URL = config(
   cast=DatabaseURL,
   default=f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB}"
 )
+
+EMOTICON_LEASE_TTL = config("EMOTICON_LEASE_TTL", cast=int, default=30)
+EMOTICON_LEASE_POLL_INTERVAL = config("EMOTICON_LEASE_POLL_INTERVAL", cast=float, default=0.05)
+
+EMOTICON_UPSTREAM_URL = config("EMOTICON_UPSTREAM_URL", cast=str, default="http://emoticon:8080")
+EMOTICON_UPSTREAM_URLS = config("EMOTICON_UPSTREAM_URLS", cast=CommaSeparatedStrings, default=EMOTICON_UPSTREAM_URL)
+UPSTREAM_MAX_CONNECTIONS = config("UPSTREAM_MAX_CONNECTIONS", cast=int, default=100)
+UPSTREAM_MAX_KEEPALIVE = config("UPSTREAM_MAX_KEEPALIVE", cast=int, default=20)
+UPSTREAM_CONNECT_TIMEOUT = config("UPSTREAM_CONNECT_TIMEOUT", cast=float, default=1.0)
+UPSTREAM_READ_TIMEOUT = config("UPSTREAM_READ_TIMEOUT", cast=float, default=5.0)
+UPSTREAM_POOL_TIMEOUT = config("UPSTREAM_POOL_TIMEOUT", cast=float, default=5.0)
+UPSTREAM_RETRIES = config("UPSTREAM_RETRIES", cast=int, default=2)
+UPSTREAM_RETRY_BACKOFF = config("UPSTREAM_RETRY_BACKOFF", cast=float, default=0.1)
+UPSTREAM_BREAKER_FAILURES = config("UPSTREAM_BREAKER_FAILURES", cast=int, default=5)
+UPSTREAM_BREAKER_RESET_TIMEOUT = config("UPSTREAM_BREAKER_RESET_TIMEOUT", cast=float, default=10.0)
+UPSTREAM_HEALTH_PATH = config("UPSTREAM_HEALTH_PATH", cast=str, default="/monster/healthcheck?size=8")
+UPSTREAM_HEALTH_INTERVAL = config("UPSTREAM_HEALTH_INTERVAL", cast=float, default=5.0)
+UPSTREAM_HEALTH_TIMEOUT = config("UPSTREAM_HEALTH_TIMEOUT", cast=float, default=1.0)
+UPSTREAM_HEALTH_FAILURES = config("UPSTREAM_HEALTH_FAILURES", cast=int, default=2)
+UPSTREAM_LATENCY_DECAY = config("UPSTREAM_LATENCY_DECAY", cast=float, default=0.3)
+
+LOCAL_CACHE_SIZE = config("LOCAL_CACHE_SIZE", cast=int, default=10000)
+LOCAL_CACHE_TTL = config("LOCAL_CACHE_TTL", cast=float, default=300.0)
+REDIS_BATCHING = config("REDIS_BATCHING", cast=bool, default=True)
+REDIS_BATCH_WINDOW = config("REDIS_BATCH_WINDOW", cast=float, default=0.0)
+REDIS_BATCH_MAX = config("REDIS_BATCH_MAX", cast=int, default=500)
+REDIS_SHARDS = config("REDIS_SHARDS", cast=CommaSeparatedStrings, default="")
+REDIS_SHARD_REPLICAS = config("REDIS_SHARD_REPLICAS", cast=int, default=160)
+CACHE_INVALIDATION_CHANNEL = config("CACHE_INVALIDATION_CHANNEL", cast=str, default="emoticons:invalidate")
+
+EMOTICON_BATCH_MAX_WORDS = config("EMOTICON_BATCH_MAX_WORDS", cast=int, default=200)
+EMOTICON_BATCH_CONCURRENCY = config("EMOTICON_BATCH_CONCURRENCY", cast=int, default=8)
+
+PASSWORD_HASHING_EXECUTOR = config("PASSWORD_HASHING_EXECUTOR", cast=str, default="thread")
+PASSWORD_HASHING_WORKERS = config("PASSWORD_HASHING_WORKERS", cast=int, default=4)
+PASSWORD_HASHING_MAX_BACKLOG = config("PASSWORD_HASHING_MAX_BACKLOG", cast=int, default=64)
+
+PRINCIPAL_CACHE_SIZE = config("PRINCIPAL_CACHE_SIZE", cast=int, default=10000)
+PRINCIPAL_CACHE_TTL = config("PRINCIPAL_CACHE_TTL", cast=int, default=60)
+PRINCIPAL_CACHE_REDIS = config("PRINCIPAL_CACHE_REDIS", cast=bool, default=False)
+
+MEDIA_ROOT = config("MEDIA_ROOT", cast=str, default="media")
+MEDIA_URL = config("MEDIA_URL", cast=str, default="http://127.0.0.1/emoticon_files")
+
+EMOTICON_MAX_BYTES = config("EMOTICON_MAX_BYTES", cast=int, default=1024 * 1024)
+
+EMOTICON_VARIANT_SIZES = config("EMOTICON_VARIANT_SIZES", cast=CommaSeparatedStrings, default="32,64,128")
+EMOTICON_VARIANT_FORMATS = config("EMOTICON_VARIANT_FORMATS", cast=CommaSeparatedStrings, default="png,webp")
+SPRITE_CELL_SIZE = config("SPRITE_CELL_SIZE", cast=int, default=64)
+VARIANT_WORKERS = config("VARIANT_WORKERS", cast=int, default=2)
+
+MEDIA_STORAGE = config("MEDIA_STORAGE", cast=str, default="files")
+PACK_ROOT = config("PACK_ROOT", cast=str, default=f"{MEDIA_ROOT}/packs")
+PACK_URL = config("PACK_URL", cast=str, default="http://127.0.0.1/api/fetch_emoticon")
+PACK_SEGMENT_BYTES = config("PACK_SEGMENT_BYTES", cast=int, default=64 * 1024 * 1024)
+PACK_COMPACT_GARBAGE_RATIO = config("PACK_COMPACT_GARBAGE_RATIO", cast=float, default=0.5)
+PACK_COMPACT_INTERVAL = config("PACK_COMPACT_INTERVAL", cast=float, default=300.0)
+
+MEDIA_MAX_BYTES = config("MEDIA_MAX_BYTES", cast=int, default=0)
+MEDIA_MAX_FILES = config("MEDIA_MAX_FILES", cast=int, default=0)
+MEDIA_EVICTION_INTERVAL = config("MEDIA_EVICTION_INTERVAL", cast=float, default=60.0)
+MEDIA_EVICTION_BATCH = config("MEDIA_EVICTION_BATCH", cast=int, default=500)
+ACCESS_FLUSH_INTERVAL = config("ACCESS_FLUSH_INTERVAL", cast=float, default=5.0)
+
+EMOTICON_SERVE_MODE = config("EMOTICON_SERVE_MODE", cast=str, default="redirect")
+EMOTICON_CACHE_MAX_AGE = config("EMOTICON_CACHE_MAX_AGE", cast=int, default=365 * 24 * 60 * 60)
+
+EMOTICON_GENERATOR = config("EMOTICON_GENERATOR", cast=str, default="dnmonster")
+IDENTICON_CELL_SIZE = config("IDENTICON_CELL_SIZE", cast=int, default=24)
+IDENTICON_BATCH_MAX = config("IDENTICON_BATCH_MAX", cast=int, default=256)
+
+EMOTICON_MISS_MODE = config("EMOTICON_MISS_MODE", cast=str, default="sync")
+GENERATION_STREAM = config("GENERATION_STREAM", cast=str, default="emoticons:generate")
+GENERATION_GROUP = config("GENERATION_GROUP", cast=str, default="emoticon-workers")
+GENERATION_DEAD_LETTER_STREAM = config("GENERATION_DEAD_LETTER_STREAM", cast=str, default="emoticons:generate:dead")
+GENERATION_STREAM_MAXLEN = config("GENERATION_STREAM_MAXLEN", cast=int, default=100000)
+GENERATION_MAX_ATTEMPTS = config("GENERATION_MAX_ATTEMPTS", cast=int, default=5)
+GENERATION_CLAIM_IDLE_MS = config("GENERATION_CLAIM_IDLE_MS", cast=int, default=30000)
+GENERATION_QUEUED_TTL = config("GENERATION_QUEUED_TTL", cast=int, default=600)
+GENERATION_FAILED_TTL = config("GENERATION_FAILED_TTL", cast=int, default=3600)
+
+SERVER_TIMING = config("SERVER_TIMING", cast=bool, default=True)
+REQUEST_TIMING_LOG = config("REQUEST_TIMING_LOG", cast=bool, default=False)
+PROFILER_TOKEN = config("PROFILER_TOKEN", cast=Secret, default="")
+PROFILE_SAMPLE_RATE = config("PROFILE_SAMPLE_RATE", cast=float, default=0.0)
+PROFILE_INTERVAL = config("PROFILE_INTERVAL", cast=float, default=0.001)
+PROFILE_DIR = config("PROFILE_DIR", cast=str, default="profiles")
+
+EMOTICON_CATALOG_FLUSH_INTERVAL = config("EMOTICON_CATALOG_FLUSH_INTERVAL", cast=float, default=2.0)
+EMOTICON_CATALOG_BATCH = config("EMOTICON_CATALOG_BATCH", cast=int, default=1000)
+EMOTICON_REBUILD_ON_START = config("EMOTICON_REBUILD_ON_START", cast=bool, default=True)
+EMOTICON_REBUILD_CHUNK = config("EMOTICON_REBUILD_CHUNK", cast=int, default=1000)
+
+USAGE_SKETCH_SIZE = config("USAGE_SKETCH_SIZE", cast=int, default=10000)
+USAGE_FLUSH_INTERVAL = config("USAGE_FLUSH_INTERVAL", cast=float, default=10.0)
+USAGE_MAX_TRACKED = config("USAGE_MAX_TRACKED", cast=int, default=100000)
+USAGE_TOP_MAX = config("USAGE_TOP_MAX", cast=int, default=1000)
+
+RATE_LIMIT_HIT_RATE = config("RATE_LIMIT_HIT_RATE", cast=float, default=50.0)
+RATE_LIMIT_HIT_BURST = config("RATE_LIMIT_HIT_BURST", cast=int, default=500)
+RATE_LIMIT_MISS_RATE = config("RATE_LIMIT_MISS_RATE", cast=float, default=2.0)
+RATE_LIMIT_MISS_BURST = config("RATE_LIMIT_MISS_BURST", cast=int, default=50)
+RATE_LIMIT_AUTH_RATE = config("RATE_LIMIT_AUTH_RATE", cast=float, default=0.2)
+RATE_LIMIT_AUTH_BURST = config("RATE_LIMIT_AUTH_BURST", cast=int, default=20)
+FORWARDED_PROXY_HOPS = config("FORWARDED_PROXY_HOPS", cast=int, default=0)
+GENERATION_MAX_IN_FLIGHT = config("GENERATION_MAX_IN_FLIGHT", cast=int, default=64)
+GENERATION_SHED_RETRY_AFTER = config("GENERATION_SHED_RETRY_AFTER", cast=int, default=1)
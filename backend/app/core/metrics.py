@@ -0,0 +1,198 @@
+import time
+
+from typing import Any, Callable, Dict
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling HTTP requests, by route template.",
+    ["method", "route", "status"],
+)
+CACHE_LOOKUPS = Counter(
+    "emoticon_cache_lookups_total",
+    "Emoticon marker lookups, by the layer that answered them.",
+    ["result"],
+)
+LOCAL_CACHE_ENTRIES = Gauge("local_cache_entries", "Entries held by an in-process cache.", ["cache"])
+LOCAL_CACHE_EVICTIONS = Gauge(
+    "local_cache_evictions",
+    "Entries an in-process cache dropped to stay within its size since the process started.",
+    ["cache"],
+)
+LOCAL_CACHE_EXPIRATIONS = Gauge(
+    "local_cache_expirations",
+    "Entries an in-process cache found past their ttl since the process started.",
+    ["cache"],
+)
+REDIS_BATCH_SIZE = Histogram(
+    "redis_batch_size",
+    "Commands merged into one Redis round trip by the batching layer.",
+    ["operation"],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512),
+)
+GENERATIONS = Counter(
+    "emoticon_generations_total",
+    "Emoticons rendered and stored on a cache miss.",
+    ["result"],
+)
+GENERATION_LATENCY = Histogram(
+    "emoticon_generation_duration_seconds",
+    "Time to render and store one emoticon.",
+)
+VARIANT_LATENCY = Histogram(
+    "emoticon_variant_duration_seconds",
+    "Time to derive a variant or a sprite sheet from stored originals, including the wait for a worker.",
+    ["format"],
+)
+UPSTREAM_LATENCY = Histogram(
+    "emoticon_upstream_response_seconds",
+    "Time until an emoticon upstream endpoint answered with response headers.",
+    ["endpoint"],
+)
+UPSTREAM_ERRORS = Counter(
+    "emoticon_upstream_errors_total",
+    "Failed emoticon upstream attempts, by endpoint and exception type.",
+    ["endpoint", "error"],
+)
+UPSTREAM_OUTSTANDING = Gauge(
+    "emoticon_upstream_outstanding_requests",
+    "Requests in flight to an emoticon upstream endpoint.",
+    ["endpoint"],
+)
+UPSTREAM_HEALTHY = Gauge(
+    "emoticon_upstream_healthy",
+    "1 while an emoticon upstream endpoint passes its health checks.",
+    ["endpoint"],
+)
+REQUESTS_SHED = Counter(
+    "requests_shed_total",
+    "Requests and batch items refused by a rate limit or the generation concurrency limit.",
+    ["reason"],
+)
+POOL_SIZE = Gauge("connection_pool_size", "Open connections in the pool.", ["pool"])
+POOL_IN_USE = Gauge("connection_pool_in_use", "Connections currently checked out of the pool.", ["pool"])
+POOL_WAIT = Histogram(
+    "connection_pool_wait_seconds",
+    "Time spent waiting to check a connection out of the pool.",
+    ["pool"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+PASSWORD_HASHING = Histogram(
+    "password_hashing_duration_seconds",
+    "Time spent in bcrypt, including the wait for a hashing worker.",
+    ["operation"],
+    buckets=(0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0),
+)
+PASSWORD_HASHING_QUEUE_DEPTH = Gauge(
+    "password_hashing_queue_depth",
+    "bcrypt calls waiting for a free hashing worker.",
+)
+PASSWORD_HASHING_IN_FLIGHT = Gauge(
+    "password_hashing_in_flight",
+    "bcrypt calls admitted to the hashing pool, running or queued.",
+)
+PASSWORD_HASHING_REJECTED = Counter(
+    "password_hashing_rejected_total",
+    "bcrypt calls refused with 503 because the hashing backlog was full.",
+)
+
+
+def timed_acquire(acquire: Callable, histogram: Histogram) -> Callable:
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        started = time.perf_counter()
+        try:
+            return await acquire(*args, **kwargs)
+        finally:
+            histogram.observe(time.perf_counter() - started)
+    return wrapper
+
+
+class TimedPool:
+    # asyncpg's Pool uses __slots__, so acquire() is timed through a proxy instead of patched on the instance;
+    # databases only ever awaits pool.acquire(), so the wrapper doesn't need to be a context manager.
+    # This leans on the private Database._backend._pool of the pinned databases==0.4.2, recheck it on upgrades
+    def __init__(self, pool, histogram: Histogram) -> None:
+        self._pool = pool
+        self.acquire = timed_acquire(pool.acquire, histogram)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._pool, name)
+
+
+def instrument_db_pool(database) -> None:
+    pool = database._backend._pool
+    POOL_SIZE.labels("db").set_function(pool.get_size)
+    POOL_IN_USE.labels("db").set_function(lambda: pool.get_size() - pool.get_idle_size())
+    database._backend._pool = TimedPool(pool, POOL_WAIT.labels("db"))
+
+
+def instrument_redis_pool(redis, name: str = "redis") -> None:
+    pool = redis.connection
+    POOL_SIZE.labels(name).set_function(lambda: pool.size)
+    # no wait histogram here: aioredis multiplexes commands over the free connections and only goes through
+    # acquire() when none is left, so timing acquire() would only ever see the rare slow path
+    POOL_IN_USE.labels(name).set_function(lambda: pool.size - pool.freesize)
+
+
+def instrument_local_cache(cache, name: str) -> None:
+    # the caches keep their own counts for stats(), the gauges just read them at scrape time
+    LOCAL_CACHE_ENTRIES.labels(name).set_function(lambda: cache.stats()["size"])
+    LOCAL_CACHE_EVICTIONS.labels(name).set_function(lambda: cache.stats()["evictions"])
+    LOCAL_CACHE_EXPIRATIONS.labels(name).set_function(lambda: cache.stats()["expirations"])
+
+
+def instrument_hashing_pool(pool) -> None:
+    PASSWORD_HASHING_QUEUE_DEPTH.set_function(lambda: pool.stats()["queue_depth"])
+    PASSWORD_HASHING_IN_FLIGHT.set_function(lambda: pool.pending)
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+        self._route_names: Dict[Any, str] = {}
+
+    def route_name(self, scope: Scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        name = self._route_names.get(endpoint)
+        if name is None:
+            # label by path template, not by the raw path, so emoticon words don't explode the series count
+            for route in scope["app"].routes:
+                if getattr(route, "endpoint", None) is endpoint:
+                    name = route.path
+                    break
+            else:
+                name = getattr(endpoint, "__name__", "unknown")
+            self._route_names[endpoint] = name
+        return name
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUEST_LATENCY.labels(scope["method"], self.route_name(scope), str(status_code)).observe(
+                time.perf_counter() - started
+            )
+
+
+async def metrics(request: Request) -> Response:
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
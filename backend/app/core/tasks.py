@@ -1,16 +1,51 @@
 from typing import Callable
 from fastapi import FastAPI
 
-from app.db.tasks import connect_to_db, close_db_connection
+from app.db.tasks import connect_to_db, close_db_connection, start_emoticon_catalog, stop_emoticon_catalog
+from app.redis.tasks import (
+    start_cache_invalidation_listener,
+    stop_cache_invalidation_listener,
+    attach_principal_cache,
+    detach_principal_cache,
+    start_usage_flush,
+    stop_usage_flush,
+    close_redis_pool,
+)
+from app.services import auth_service, emoticon_generator, variant_renderer
+from app.storage.tasks import (
+    load_media_storage,
+    start_media_eviction,
+    stop_media_eviction,
+    start_pack_compaction,
+    stop_pack_compaction,
+)
 
 
 def create_start_app_handler(app: FastAPI) -> Callable:
     async def start_app() -> None:
         await connect_to_db(app)
+        await start_emoticon_catalog(app)
+        await load_media_storage(app)
+        await emoticon_generator.start()
+        await start_cache_invalidation_listener(app)
+        await attach_principal_cache(app)
+        await start_media_eviction(app)
+        await start_pack_compaction(app)
+        await start_usage_flush(app)
     return start_app
 
 
 def create_stop_app_handler(app: FastAPI) -> Callable:
     async def stop_app() -> None:
+        await stop_usage_flush(app)
+        await stop_pack_compaction(app)
+        await stop_media_eviction(app)
+        await stop_emoticon_catalog(app)
+        await detach_principal_cache(app)
+        await stop_cache_invalidation_listener(app)
+        await emoticon_generator.close()
+        auth_service.hashing_pool.shutdown()
+        variant_renderer.shutdown()
+        await close_redis_pool(app)
         await close_db_connection(app)
     return stop_app
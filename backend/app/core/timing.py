@@ -0,0 +1,162 @@
+import hmac
+import json
+import logging
+import os
+import random
+import re
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from pyinstrument import Profiler
+from starlette.datastructures import Secret
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.core.config import (
+    SERVER_TIMING,
+    REQUEST_TIMING_LOG,
+    PROFILER_TOKEN,
+    PROFILE_SAMPLE_RATE,
+    PROFILE_INTERVAL,
+    PROFILE_DIR,
+)
+
+
+logger = logging.getLogger(__name__)
+
+_phases: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("request_phases", default=None)
+
+
+def record_phase(name: str, duration: float) -> None:
+    phases = _phases.get()
+    if phases is not None:
+        phases.append((name, duration))
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    phases = _phases.get()
+    if phases is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases.append((name, time.perf_counter() - started))
+
+
+def summarize_phases(phases: List[Tuple[str, float]]) -> Dict[str, float]:
+    # a phase can run several times per request (disk writes per chunk, batch lookups), report the sum
+    totals: Dict[str, float] = {}
+    for name, duration in phases:
+        totals[name] = totals.get(name, 0.0) + duration
+    return totals
+
+
+def server_timing_header(totals: Dict[str, float], total: float) -> str:
+    entries = [f"{name};dur={duration * 1000:.2f}" for name, duration in totals.items()]
+    entries.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(entries)
+
+
+class ServerTimingMiddleware:
+    def __init__(self, app: ASGIApp, header: bool = SERVER_TIMING, log: bool = REQUEST_TIMING_LOG) -> None:
+        self.app = app
+        self.header = header
+        self.log = log
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not (self.header or self.log):
+            await self.app(scope, receive, send)
+            return
+
+        phases: List[Tuple[str, float]] = []
+        token = _phases.set(phases)
+        status_code = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if self.header:
+                    value = server_timing_header(summarize_phases(phases), time.perf_counter() - started)
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", value.encode("latin-1"))
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _phases.reset(token)
+            if self.log:
+                logger.info(json.dumps({
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status_code,
+                    "total_ms": round((time.perf_counter() - started) * 1000, 2),
+                    "phases_ms": {
+                        name: round(duration * 1000, 2) for name, duration in summarize_phases(phases).items()
+                    },
+                }))
+
+
+class ProfilerMiddleware:
+    def __init__(
+            self,
+            app: ASGIApp,
+            token: Secret = PROFILER_TOKEN,
+            sample_rate: float = PROFILE_SAMPLE_RATE,
+            interval: float = PROFILE_INTERVAL,
+            directory: str = PROFILE_DIR
+    ) -> None:
+        self.app = app
+        self.token = str(token).encode("latin-1")
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.directory = directory
+        # pyinstrument allows one profiler per thread, concurrent requests are skipped until it is done
+        self._active = False
+
+    def wants_profile(self, scope: Scope) -> bool:
+        if scope["type"] != "http" or self._active:
+            return False
+        if self.token:
+            for name, value in scope["headers"]:
+                if name == b"x-profile" and hmac.compare_digest(value, self.token):
+                    return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def save(self, scope: Scope, profiler: Profiler) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", scope["path"]).strip("_")[:80]
+        filename = f"{time.strftime('%Y%m%dT%H%M%S')}-{scope['method']}-{slug}-{random.getrandbits(32):08x}.html"
+        with open(os.path.join(self.directory, filename), "w") as f:
+            f.write(profiler.output_html())
+        return filename
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if not self.wants_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        self._active = True
+        profiler = Profiler(interval=self.interval, async_mode="enabled")
+        profiler.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            profiler.stop()
+            self._active = False
+            try:
+                filename = self.save(scope, profiler)
+            except OSError as e:
+                logger.warning("--- PROFILE SAVE ERROR ---")
+                logger.warning(e)
+                logger.warning("--- PROFILE SAVE ERROR ---")
+            else:
+                logger.info("saved profile of %s %s to %s", scope["method"], scope["path"], filename)
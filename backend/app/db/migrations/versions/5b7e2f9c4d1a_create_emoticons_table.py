@@ -0,0 +1,35 @@
+"""create_emoticons_table
+Revision ID: 5b7e2f9c4d1a
+Revises: 01c819b7e6c4
+Create Date: 2026-10-18 11:05:00.000000
+"""
+
+import sqlalchemy as sa
+
+
+from alembic import op
+
+
+
+revision = '5b7e2f9c4d1a'
+down_revision = '01c819b7e6c4'
+branch_labels = None
+depends_on = None
+
+
+def create_emoticons_table() -> None:
+    op.create_table(
+        "emoticons",
+        sa.Column("word", sa.Text, primary_key=True),
+        sa.Column("storage_path", sa.Text, nullable=False),
+        sa.Column("size", sa.BigInteger, nullable=False, server_default="0"),
+        sa.Column("etag", sa.Text, nullable=True),
+        sa.Column("created_at", sa.TIMESTAMP(timezone=True), nullable=False, server_default=sa.func.now()),
+        sa.Column("last_access", sa.TIMESTAMP(timezone=True), nullable=False, server_default=sa.func.now(), index=True)
+    )
+
+def upgrade() -> None:
+    create_emoticons_table()
+
+def downgrade() -> None:
+    op.drop_table("emoticons")
@@ -0,0 +1,110 @@
+import argparse
+import asyncio
+import logging
+import sys
+
+from databases import Database
+
+from app.core.config import DATABASE_URL, EMOTICON_REBUILD_CHUNK
+from app.db.repositories.emoticons import EmoticonsRepository
+from app.models.emoticon import EmoticonCreate
+from app.redis.containers import container
+from app.redis.services import Service, UNTAGGED_MARKER
+from app.storage import storage
+
+
+logger = logging.getLogger(__name__)
+
+
+async def rebuild_redis(db: Database, service: Service, chunk_size: int = EMOTICON_REBUILD_CHUNK) -> int:
+    emoticons_repo = EmoticonsRepository(db)
+    restored = 0
+    after = ""
+    restoring = None
+    while True:
+        emoticons = await emoticons_repo.list_emoticons_after(after=after, limit=chunk_size)
+        # the next page is read from Postgres while the previous chunk is still being written to Redis
+        if restoring is not None:
+            restored += await restoring
+        if not emoticons:
+            break
+        restoring = asyncio.ensure_future(service.restore_emoticon_words([
+            (emoticon.word, emoticon.etag or UNTAGGED_MARKER, emoticon.size, emoticon.last_access.timestamp())
+            for emoticon in emoticons
+        ]))
+        after = emoticons[-1].word
+    return restored
+
+
+async def backfill_catalog(db: Database, service: Service, chunk_size: int = EMOTICON_REBUILD_CHUNK) -> int:
+    # the other way round: emoticons rendered before the table existed only have a marker and a file
+    emoticons_repo = EmoticonsRepository(db)
+    backfilled = 0
+    async for markers in service.scan_emoticon_words(chunk_size):
+        emoticons = []
+        last_access = {}
+        for emoticon_word, marker, accessed_at in markers:
+            stat_result = storage.stat(emoticon_word)
+            if stat_result is None:
+                continue
+            emoticons.append(EmoticonCreate(
+                word=emoticon_word,
+                storage_path=storage.relative_path(emoticon_word),
+                size=stat_result.st_size,
+                etag=None if marker == UNTAGGED_MARKER else marker,
+            ))
+            if accessed_at is not None:
+                last_access[emoticon_word] = accessed_at
+        await emoticons_repo.save_emoticons(emoticons=emoticons)
+        await emoticons_repo.touch_emoticons(last_access=last_access)
+        backfilled += len(emoticons)
+    return backfilled
+
+
+async def rebuild(chunk_size: int) -> int:
+    database = Database(str(DATABASE_URL), min_size=1, max_size=2)
+    await database.connect()
+    try:
+        service = await container.service()
+        migrated = await service.migrate_legacy_markers(storage.stat)
+        if migrated:
+            logger.info("moved %s emoticon markers to their namespaced keys", migrated)
+        restored = await rebuild_redis(database, service, chunk_size)
+    finally:
+        await container.redis_shards.shutdown()
+        await container.redis_pool.shutdown()
+        await database.disconnect()
+    logger.info("restored %s emoticon markers from Postgres", restored)
+    return restored
+
+
+async def backfill(chunk_size: int) -> int:
+    database = Database(str(DATABASE_URL), min_size=1, max_size=2)
+    await database.connect()
+    try:
+        service = await container.service()
+        backfilled = await backfill_catalog(database, service, chunk_size)
+    finally:
+        await container.redis_shards.shutdown()
+        await container.redis_pool.shutdown()
+        await database.disconnect()
+    logger.info("backfilled %s emoticons into the emoticons table", backfilled)
+    return backfilled
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Restore emoticon markers in Redis from the emoticons table.")
+    parser.add_argument("--chunk-size", type=int, default=EMOTICON_REBUILD_CHUNK)
+    parser.add_argument(
+        "--backfill-catalog", action="store_true", help="fill the emoticons table from Redis markers and media instead"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    run = backfill if args.backfill_catalog else rebuild
+    asyncio.get_event_loop().run_until_complete(run(args.chunk_size))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional
+
+from app.db.repositories.base import BaseRepository
+from app.models.emoticon import EmoticonCreate, EmoticonInDB
+
+
+GET_EMOTICON_QUERY = """
+    SELECT word, storage_path, size, etag, created_at, last_access
+    FROM emoticons
+    WHERE word = :word;
+"""
+UPSERT_EMOTICONS_QUERY = """
+    INSERT INTO emoticons (word, storage_path, size, etag)
+    SELECT * FROM unnest(
+        CAST(:words AS text[]), CAST(:storage_paths AS text[]), CAST(:sizes AS bigint[]), CAST(:etags AS text[])
+    )
+    ON CONFLICT (word) DO UPDATE
+    SET storage_path = EXCLUDED.storage_path, size = EXCLUDED.size, etag = EXCLUDED.etag;
+"""
+TOUCH_EMOTICONS_QUERY = """
+    UPDATE emoticons
+    SET last_access = GREATEST(emoticons.last_access, accessed.last_access)
+    FROM unnest(CAST(:words AS text[]), CAST(:last_access AS timestamptz[])) AS accessed (word, last_access)
+    WHERE emoticons.word = accessed.word;
+"""
+DELETE_EMOTICONS_QUERY = """
+    DELETE FROM emoticons
+    WHERE word = ANY(CAST(:words AS text[]));
+"""
+LIST_EMOTICONS_AFTER_QUERY = """
+    SELECT word, storage_path, size, etag, created_at, last_access
+    FROM emoticons
+    WHERE word > :after
+    ORDER BY word
+    LIMIT :limit;
+"""
+
+
+class EmoticonsRepository(BaseRepository):
+    # the batch writes pass whole columns as arrays, so each batch is a single statement and round trip
+
+    async def get_emoticon(self, *, word: str) -> Optional[EmoticonInDB]:
+        emoticon_record = await self.db.fetch_one(query=GET_EMOTICON_QUERY, values={"word": word})
+
+        if not emoticon_record:
+            return None
+
+        return EmoticonInDB(**emoticon_record)
+
+    async def save_emoticons(self, *, emoticons: List[EmoticonCreate]) -> None:
+        if not emoticons:
+            return
+        await self.db.execute(query=UPSERT_EMOTICONS_QUERY, values={
+            "words": [emoticon.word for emoticon in emoticons],
+            "storage_paths": [emoticon.storage_path for emoticon in emoticons],
+            "sizes": [emoticon.size for emoticon in emoticons],
+            "etags": [emoticon.etag for emoticon in emoticons],
+        })
+
+    async def touch_emoticons(self, *, last_access: Dict[str, float]) -> None:
+        if not last_access:
+            return
+        await self.db.execute(query=TOUCH_EMOTICONS_QUERY, values={
+            "words": list(last_access),
+            "last_access": [datetime.fromtimestamp(accessed_at, timezone.utc) for accessed_at in last_access.values()],
+        })
+
+    async def delete_emoticons(self, *, words: Iterable[str]) -> None:
+        words = list(words)
+        if words:
+            await self.db.execute(query=DELETE_EMOTICONS_QUERY, values={"words": words})
+
+    async def list_emoticons_after(self, *, after: str = "", limit: int = 1000) -> List[EmoticonInDB]:
+        emoticon_records = await self.db.fetch_all(
+            query=LIST_EMOTICONS_AFTER_QUERY, values={"after": after, "limit": limit}
+        )
+        return [EmoticonInDB(**emoticon_record) for emoticon_record in emoticon_records]
@@ -2,6 +2,7 @@ from fastapi import HTTPException, status
 from databases import Database
 from typing import Optional
 
+from app.core.timing import phase
 from app.db.repositories.base import BaseRepository
 from app.models.user import UserCreate, UserInDB
 from app.services import auth_service
@@ -25,7 +26,8 @@ class UsersRepository(BaseRepository):
         self.auth_service = auth_service
 
     async def get_user_by_username(self, *, username: str) -> UserInDB:
-        user_record = await self.db.fetch_one(query=GET_USER_BY_USERNAME_QUERY, values={"username": username})
+        with phase("user_lookup"):
+            user_record = await self.db.fetch_one(query=GET_USER_BY_USERNAME_QUERY, values={"username": username})
 
         if not user_record:
             return None
@@ -39,7 +41,9 @@ class UsersRepository(BaseRepository):
                 detail="That username is already taken. Please try another one."
             )
 
-        user_password_update = self.auth_service.create_hashed_password(plaintext_password=new_user.password)
+        user_password_update = await self.auth_service.create_hashed_password_async(
+            plaintext_password=new_user.password
+        )
         new_user_params = new_user.copy(update=user_password_update.dict())
         created_user = await self.db.fetch_one(query=REGISTER_NEW_USER_QUERY, values=new_user_params.dict())
         return UserInDB(**created_user)
@@ -48,6 +52,6 @@ class UsersRepository(BaseRepository):
         user = await self.get_user_by_username(username=username)
         if not user:
             return None
-        if not self.auth_service.verify_password(password=password, hashed_password=user.password):
+        if not await self.auth_service.verify_password_async(password=password, hashed_password=user.password):
             return None
         return user
\ No newline at end of file
@@ -1,10 +1,17 @@
+import asyncio
 import logging
 import os
 
 from fastapi import FastAPI
 from databases import Database
 
-from app.core.config import DATABASE_URL
+from app.core.config import DATABASE_URL, EMOTICON_REBUILD_ON_START
+from app.db.rebuild import backfill_catalog, rebuild_redis
+from app.db.repositories.emoticons import EmoticonsRepository
+from app.redis.containers import container
+from app.redis.services import Service
+from app.services import emoticon_catalog
+from app.core.metrics import instrument_db_pool
 
 
 logger = logging.getLogger(__name__)
@@ -15,6 +22,7 @@ async def connect_to_db(app: FastAPI) -> None:
     database = Database(DB_URL, min_size=2, max_size=10)
     try:
         await database.connect()
+        instrument_db_pool(database)
         app.state._db = database
     except Exception as e:
         logger.warning("--- DB CONNECTION ERROR ---")
@@ -29,3 +37,74 @@ async def close_db_connection(app: FastAPI) -> None:
         logger.warning("--- DB DISCONNECT ERROR ---")
         logger.warning(e)
         logger.warning("--- DB DISCONNECT ERROR ---")
+
+
+async def restore_redis_markers(database: Database, service: Service) -> None:
+    try:
+        restored = await rebuild_redis(database, service)
+    except Exception as e:
+        logger.warning("--- REDIS REBUILD ERROR ---")
+        logger.warning(e)
+        logger.warning("--- REDIS REBUILD ERROR ---")
+    else:
+        logger.info("restored %s emoticon markers from Postgres", restored)
+
+
+async def backfill_emoticon_catalog(database: Database, service: Service) -> None:
+    try:
+        backfilled = await backfill_catalog(database, service)
+    except Exception as e:
+        logger.warning("--- EMOTICON CATALOG BACKFILL ERROR ---")
+        logger.warning(e)
+        logger.warning("--- EMOTICON CATALOG BACKFILL ERROR ---")
+    else:
+        logger.info("backfilled %s emoticons into the emoticons table", backfilled)
+
+
+async def start_emoticon_catalog(app: FastAPI) -> None:
+    database = getattr(app.state, "_db", None)
+    if database is None:
+        return
+    app.state._emoticon_catalog = asyncio.ensure_future(emoticon_catalog.run(database))
+
+    if not EMOTICON_REBUILD_ON_START:
+        return
+    try:
+        service = await container.service()
+        _, total_files = await service.get_media_usage()
+    except Exception as e:
+        logger.warning("--- REDIS CONNECTION ERROR ---")
+        logger.warning(e)
+        logger.warning("--- REDIS CONNECTION ERROR ---")
+        return
+    # Redis came up empty (flush or failover): restore markers in the background instead of re-rendering
+    if not total_files:
+        app.state._redis_rebuild = asyncio.ensure_future(restore_redis_markers(database, service))
+        return
+
+    try:
+        catalog_empty = not await EmoticonsRepository(database).list_emoticons_after(limit=1)
+    except Exception as e:
+        logger.warning("--- DB CONNECTION ERROR ---")
+        logger.warning(e)
+        logger.warning("--- DB CONNECTION ERROR ---")
+        return
+    # the table is newer than the markers: fill it once from what Redis and the media storage already hold
+    if catalog_empty:
+        app.state._catalog_backfill = asyncio.ensure_future(backfill_emoticon_catalog(database, service))
+
+
+async def stop_emoticon_catalog(app: FastAPI) -> None:
+    for name in ("_catalog_backfill", "_redis_rebuild", "_emoticon_catalog"):
+        task = getattr(app.state, name, None)
+        if task is not None:
+            task.cancel()
+    database = getattr(app.state, "_db", None)
+    if database is None:
+        return
+    try:
+        await emoticon_catalog.flush(database)
+    except Exception as e:
+        logger.warning("--- EMOTICON CATALOG FLUSH ERROR ---")
+        logger.warning(e)
+        logger.warning("--- EMOTICON CATALOG FLUSH ERROR ---")
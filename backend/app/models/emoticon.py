@@ -0,0 +1,16 @@
+from datetime import datetime
+from typing import Optional
+
+from app.models.core import CoreModel
+
+
+class EmoticonCreate(CoreModel):
+    word: str
+    storage_path: str
+    size: int = 0
+    etag: Optional[str]
+
+
+class EmoticonInDB(EmoticonCreate):
+    created_at: datetime
+    last_access: datetime
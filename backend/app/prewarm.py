@@ -0,0 +1,145 @@
+import argparse
+import asyncio
+import logging
+import sys
+import time
+
+from typing import Iterable, List, Set
+
+from databases import Database
+
+from app.api.routes.emoticons import handle_new_emoticon_once
+from app.core.config import DATABASE_URL
+from app.redis.containers import container
+from app.services import emoticon_generator, emoticon_catalog
+from app.storage import storage
+
+
+logger = logging.getLogger(__name__)
+
+
+def read_words(source: Iterable[str]) -> List[str]:
+    return list(dict.fromkeys(line.strip() for line in source if line.strip()))
+
+
+def read_done(state_file: str) -> Set[str]:
+    try:
+        with open(state_file) as f:
+            return {line.rstrip("\n") for line in f}
+    except FileNotFoundError:
+        return set()
+
+
+class Progress:
+    def __init__(self, total: int) -> None:
+        self.total = total
+        self.generated = 0
+        self.skipped = 0
+        self.failed = 0
+        self.started = time.monotonic()
+
+    @property
+    def done(self) -> int:
+        return self.generated + self.skipped + self.failed
+
+    def report(self) -> None:
+        elapsed = time.monotonic() - self.started
+        logger.info(
+            "%s/%s done (%s generated, %s already saved, %s failed), %.1f generated/s",
+            self.done, self.total, self.generated, self.skipped, self.failed, self.generated / max(elapsed, 1e-9)
+        )
+
+
+async def prewarm(
+        emoticon_words: List[str],
+        *,
+        workers: int,
+        chunk_size: int,
+        state_file: str,
+        report_every: float
+) -> Progress:
+    done = read_done(state_file)
+    pending = [emoticon_word for emoticon_word in emoticon_words if emoticon_word not in done]
+    progress = Progress(len(pending))
+    service = await container.service()
+    database = Database(str(DATABASE_URL), min_size=1, max_size=2)
+    await database.connect()
+    await emoticon_generator.start()
+    await storage.load()
+
+    queue: asyncio.Queue = asyncio.Queue(maxsize=workers * 2)
+    with open(state_file, "a", buffering=1) as state:
+        async def worker() -> None:
+            while True:
+                emoticon_word = await queue.get()
+                try:
+                    await handle_new_emoticon_once(emoticon_word, service)
+                except Exception as e:
+                    progress.failed += 1
+                    logger.warning("failed to generate %r: %r", emoticon_word, e)
+                else:
+                    progress.generated += 1
+                    state.write(f"{emoticon_word}\n")
+                finally:
+                    queue.task_done()
+
+        async def reporter() -> None:
+            while True:
+                await asyncio.sleep(report_every)
+                progress.report()
+
+        tasks = [asyncio.ensure_future(worker()) for _ in range(workers)]
+        tasks.append(asyncio.ensure_future(reporter()))
+        tasks.append(asyncio.ensure_future(emoticon_catalog.run(database)))
+        try:
+            for start in range(0, len(pending), chunk_size):
+                chunk = pending[start:start + chunk_size]
+                saved = await service.get_emoticon_words(chunk)
+                for emoticon_word in chunk:
+                    if saved[emoticon_word]:
+                        progress.skipped += 1
+                        state.write(f"{emoticon_word}\n")
+                    else:
+                        await queue.put(emoticon_word)
+            await queue.join()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await emoticon_catalog.flush(database)
+            await database.disconnect()
+            await emoticon_generator.close()
+            await container.redis_shards.shutdown()
+            await container.redis_pool.shutdown()
+
+    progress.report()
+    return progress
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Generate emoticons for a list of words ahead of time.")
+    parser.add_argument("words", nargs="?", default="-", help="file with one word per line, - for stdin")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--chunk-size", type=int, default=500, help="words per pipelined Redis lookup")
+    parser.add_argument("--state-file", default=".prewarm.done", help="completed words, used to resume")
+    parser.add_argument("--report-every", type=float, default=5.0)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    if args.words == "-":
+        emoticon_words = read_words(sys.stdin)
+    else:
+        with open(args.words) as f:
+            emoticon_words = read_words(f)
+
+    progress = asyncio.get_event_loop().run_until_complete(prewarm(
+        emoticon_words,
+        workers=args.workers,
+        chunk_size=args.chunk_size,
+        state_file=args.state_file,
+        report_every=args.report_every,
+    ))
+    return 1 if progress.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
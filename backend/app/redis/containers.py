@@ -1,6 +1,8 @@
 from dependency_injector import containers, providers
 
-from . import redis, services
+from app.core.metrics import instrument_local_cache
+from app.core.config import LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL, REDIS_BATCHING, REDIS_SHARDS
+from . import redis, services, generation, usage, limits
 
 
 class Container(containers.DeclarativeContainer):
@@ -13,7 +15,50 @@ class Container(containers.DeclarativeContainer):
         password=config.redis_password,
     )
 
+    redis_shards = providers.Resource(
+        redis.init_redis_shards,
+        primary=redis_pool,
+        hosts=list(REDIS_SHARDS),
+        password=config.redis_password,
+    )
+
+    local_cache = providers.Singleton(
+        services.LocalCache,
+        max_size=LOCAL_CACHE_SIZE,
+        ttl=LOCAL_CACHE_TTL,
+    )
+
+    access_tracker = providers.Singleton(services.AccessTracker)
+
+    usage_counter = providers.Singleton(usage.UsageCounter)
+
+    redis_batcher = providers.Singleton(
+        services.RedisBatcher,
+        shards=redis_shards,
+    )
+
     service = providers.Factory(
         services.Service,
         redis=redis_pool,
+        local_cache=local_cache,
+        access_tracker=access_tracker,
+        usage_counter=usage_counter,
+        batcher=redis_batcher if REDIS_BATCHING else providers.Object(None),
+        shards=redis_shards,
     )
+
+    generation_queue = providers.Factory(
+        generation.GenerationQueue,
+        redis=redis_pool,
+    )
+
+    rate_limiter = providers.Factory(
+        limits.RateLimiter,
+        redis=redis_pool,
+    )
+
+
+container = Container()
+container.config.redis_host.from_env("REDIS_HOST", "redis")
+container.config.redis_password.from_env("REDIS_PASSWORD", "password")
+instrument_local_cache(container.local_cache(), "emoticons")
@@ -0,0 +1,105 @@
+from typing import List, Optional, Tuple
+
+from aioredis import Redis, ReplyError
+
+from app.core.config import (
+    GENERATION_STREAM,
+    GENERATION_GROUP,
+    GENERATION_DEAD_LETTER_STREAM,
+    GENERATION_STREAM_MAXLEN,
+    GENERATION_MAX_ATTEMPTS,
+    GENERATION_CLAIM_IDLE_MS,
+    GENERATION_QUEUED_TTL,
+    GENERATION_FAILED_TTL,
+)
+
+
+Job = Tuple[str, str]
+
+
+class GenerationQueue:
+    def __init__(
+            self,
+            redis: Redis,
+            *,
+            stream: str = GENERATION_STREAM,
+            group: str = GENERATION_GROUP,
+            dead_letter_stream: str = GENERATION_DEAD_LETTER_STREAM,
+            max_attempts: int = GENERATION_MAX_ATTEMPTS,
+            claim_idle_ms: int = GENERATION_CLAIM_IDLE_MS
+    ) -> None:
+        self._redis = redis
+        self.stream = stream
+        self.group = group
+        self.dead_letter_stream = dead_letter_stream
+        self.max_attempts = max_attempts
+        self.claim_idle_ms = claim_idle_ms
+
+    async def enqueue(self, emoticon_word: str) -> bool:
+        # one stream entry per word until it is rendered, dead-lettered or the marker expires
+        if not await self._redis.set(
+                f"queued:{emoticon_word}", 1, expire=GENERATION_QUEUED_TTL, exist=self._redis.SET_IF_NOT_EXIST
+        ):
+            return False
+        await self._redis.xadd(self.stream, {"word": emoticon_word}, max_len=GENERATION_STREAM_MAXLEN)
+        return True
+
+    async def status(self, emoticon_word: str) -> Optional[str]:
+        queued, failed = await self._redis.mget(f"queued:{emoticon_word}", f"failed:{emoticon_word}")
+        if failed:
+            return "failed"
+        if queued:
+            return "pending"
+        return None
+
+    async def ensure_group(self) -> None:
+        try:
+            await self._redis.xgroup_create(self.stream, self.group, latest_id="0", mkstream=True)
+        except ReplyError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+    async def read(self, consumer: str, count: int, block_ms: int) -> List[Job]:
+        messages = await self._redis.xread_group(
+            self.group, consumer, [self.stream], timeout=block_ms, count=count, latest_ids=[">"]
+        )
+        return [(message_id.decode(), fields[b"word"].decode("utf-8")) for _, message_id, fields in messages]
+
+    async def claim_stale(self, consumer: str, count: int) -> Tuple[List[Job], List[Tuple[str, int]]]:
+        pending = await self._redis.xpending(self.stream, self.group, "-", "+", count)
+        stale = [
+            (message_id.decode(), deliveries)
+            for message_id, _, idle_ms, deliveries in pending
+            if idle_ms >= self.claim_idle_ms
+        ]
+        exhausted = [(message_id, deliveries) for message_id, deliveries in stale if deliveries >= self.max_attempts]
+        retry_ids = [message_id for message_id, deliveries in stale if deliveries < self.max_attempts]
+        if not retry_ids:
+            return [], exhausted
+        claimed = await self._redis.xclaim(self.stream, self.group, consumer, self.claim_idle_ms, *retry_ids)
+        return [(message_id.decode(), fields[b"word"].decode("utf-8")) for message_id, fields in claimed], exhausted
+
+    async def word_for(self, message_id: str) -> Optional[str]:
+        messages = await self._redis.xrange(self.stream, message_id, message_id)
+        if not messages:
+            return None
+        return messages[0][1][b"word"].decode("utf-8")
+
+    async def ack(self, message_id: str, emoticon_word: str) -> None:
+        transaction = self._redis.multi_exec()
+        transaction.xack(self.stream, self.group, message_id)
+        transaction.delete(f"queued:{emoticon_word}", f"failed:{emoticon_word}")
+        await transaction.execute()
+
+    async def dead_letter(self, message_id: str, emoticon_word: Optional[str], attempts: int, error: str = "") -> None:
+        transaction = self._redis.multi_exec()
+        transaction.xadd(
+            self.dead_letter_stream,
+            {"word": emoticon_word or "", "message_id": message_id, "attempts": attempts, "error": error},
+            max_len=GENERATION_STREAM_MAXLEN
+        )
+        transaction.xack(self.stream, self.group, message_id)
+        if emoticon_word is not None:
+            transaction.delete(f"queued:{emoticon_word}")
+            transaction.set(f"failed:{emoticon_word}", attempts, expire=GENERATION_FAILED_TTL)
+        await transaction.execute()
@@ -0,0 +1,54 @@
+import math
+import time
+
+from typing import Tuple
+
+from aioredis import Redis
+
+
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local granted = 0
+if tokens >= requested then
+    granted = requested
+elseif ARGV[5] == "1" then
+    granted = math.floor(tokens)
+end
+tokens = tokens - granted
+redis.call("HMSET", KEYS[1], "tokens", tostring(tokens), "ts", ARGV[3])
+redis.call("PEXPIRE", KEYS[1], math.ceil((burst - tokens) / rate * 1000) + 1000)
+local wait = 0
+if granted < requested then
+    wait = (math.min(requested - granted, burst) - tokens) / rate
+end
+return {granted, tostring(wait)}
+"""
+
+
+class RateLimiter:
+    def __init__(self, redis: Redis, prefix: str = "ratelimit") -> None:
+        self._redis = redis
+        self.prefix = prefix
+
+    async def take(self, key: str, rate: float, burst: int, cost: int = 1, partial: bool = False) -> Tuple[int, int]:
+        # returns how many of `cost` tokens were granted and, when short, the seconds until the rest refill;
+        # a request costing more than the burst could never pass whole, so it can only be granted partially
+        if cost <= 0:
+            return 0, 0
+        granted, wait = await self._redis.eval(
+            TOKEN_BUCKET_SCRIPT,
+            keys=[f"{self.prefix}:{key}"],
+            args=[rate, burst, repr(time.time()), cost, int(partial)]
+        )
+        return int(granted), (max(1, math.ceil(float(wait))) if int(granted) < cost else 0)
+
+    async def allow(self, key: str, rate: float, burst: int) -> Tuple[bool, int]:
+        granted, retry_after = await self.take(key, rate, burst)
+        return granted == 1, retry_after
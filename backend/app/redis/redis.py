@@ -1,10 +1,32 @@
-from typing import AsyncIterator
+from typing import AsyncIterator, List
 
 from aioredis import create_redis_pool, Redis
 
+from app.core.metrics import instrument_redis_pool
+from app.redis.sharding import RedisShards
+
 
 async def init_redis_pool(host: str, password: str) -> AsyncIterator[Redis]:
     pool = await create_redis_pool(f"redis://{host}", password=password)
+    instrument_redis_pool(pool)
     yield pool
     pool.close()
     await pool.wait_closed()
+
+
+async def init_redis_shards(primary: Redis, hosts: List[str], password: str) -> AsyncIterator[RedisShards]:
+    # without a shard list the markers stay on the primary, which keeps queues, limits and pub/sub either way
+    if not hosts:
+        yield RedisShards([primary])
+        return
+    pools = []
+    try:
+        for host in hosts:
+            pool = await create_redis_pool(f"redis://{host}", password=password)
+            instrument_redis_pool(pool, f"redis:{host}")
+            pools.append(pool)
+        yield RedisShards(pools, list(hosts))
+    finally:
+        for pool in pools:
+            pool.close()
+            await pool.wait_closed()
@@ -1,13 +1,546 @@
+import time
+import asyncio
+
+from collections import OrderedDict
+from typing import Optional, Any, AsyncIterator, Dict, List, Callable, Tuple
+
 from aioredis import Redis
 
+from app.core.config import CACHE_INVALIDATION_CHANNEL, USAGE_MAX_TRACKED, REDIS_BATCH_WINDOW, REDIS_BATCH_MAX
+from app.core.metrics import CACHE_LOOKUPS, REDIS_BATCH_SIZE
+from app.core.timing import phase
+from app.redis.sharding import RedisShards
+from app.redis.usage import UsageCounter
+
+
+UNTAGGED_MARKER = "saved"
+MARKER_PREFIX = "emoticon:"
+ACCESS_KEY = "emoticons:access"
+SIZES_KEY = "emoticons:sizes"
+BYTES_KEY = "emoticons:bytes"
+USAGE_TOTALS_KEY = "usage:totals"
+USAGE_WORDS_KEY = "usage:words"
+USAGE_WORD_MISSES_KEY = "usage:words:misses"
+USAGE_USERS_KEY = "usage:users"
+USAGE_USER_MISSES_KEY = "usage:users:misses"
+LOCK_PREFIX = "lock:"
+# prefixes of every key the app writes next to the markers, none of them can be a marker from before the namespace
+NON_MARKER_PREFIXES = (
+    MARKER_PREFIX, "emoticons:", "lease:", LOCK_PREFIX, "queued:", "failed:", "usage:", "ratelimit:", "principal:"
+)
+
+SAVE_EMOTICON_SCRIPT = """
+local old_size = tonumber(redis.call("HGET", KEYS[3], ARGV[1]) or "0")
+redis.call("SET", KEYS[1], ARGV[2])
+redis.call("ZADD", KEYS[2], ARGV[4], ARGV[1])
+redis.call("HSET", KEYS[3], ARGV[1], ARGV[3])
+redis.call("INCRBY", KEYS[4], tonumber(ARGV[3]) - old_size)
+return 1
+"""
+TOUCH_EMOTICONS_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    if redis.call("EXISTS", "emoticon:" .. ARGV[i]) == 1 then
+        redis.call("ZADD", KEYS[1], ARGV[i + 1], ARGV[i])
+    end
+end
+return 1
+"""
+EVICT_EMOTICONS_SCRIPT = """
+local evicted = {}
+local emoticon_words = redis.call("ZRANGE", KEYS[1], 0, tonumber(ARGV[1]) - 1)
+for _, emoticon_word in ipairs(emoticon_words) do
+    if redis.call("SET", "lease:" .. emoticon_word, ARGV[2], "NX", "EX", tonumber(ARGV[3])) then
+        local size = tonumber(redis.call("HGET", KEYS[2], emoticon_word) or "0")
+        redis.call("DEL", "emoticon:" .. emoticon_word)
+        redis.call("ZREM", KEYS[1], emoticon_word)
+        redis.call("HDEL", KEYS[2], emoticon_word)
+        redis.call("DECRBY", KEYS[3], size)
+        table.insert(evicted, emoticon_word)
+    end
+end
+return evicted
+"""
+RESTORE_EMOTICONS_SCRIPT = """
+local restored = 0
+for i = 1, #ARGV, 4 do
+    if redis.call("SET", "emoticon:" .. ARGV[i], ARGV[i + 1], "NX") then
+        redis.call("ZADD", KEYS[1], ARGV[i + 3], ARGV[i])
+        redis.call("HSET", KEYS[2], ARGV[i], ARGV[i + 2])
+        redis.call("INCRBY", KEYS[3], ARGV[i + 2])
+        restored = restored + 1
+    end
+end
+return restored
+"""
+FIND_LEGACY_MARKERS_SCRIPT = """
+local found = {}
+for _, key in ipairs(ARGV) do
+    if redis.call("TYPE", key).ok == "string" and redis.call("GET", key) == "saved" then
+        table.insert(found, key)
+    end
+end
+return found
+"""
+DELETE_LEGACY_MARKERS_SCRIPT = """
+local deleted = 0
+for _, key in ipairs(KEYS) do
+    if redis.call("TYPE", key).ok == "string" and redis.call("GET", key) == "saved" then
+        deleted = deleted + redis.call("DEL", key)
+    end
+end
+return deleted
+"""
+RELEASE_LEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+def marker_key(emoticon_word: str) -> str:
+    # words come straight from the url, so their markers get a namespace of their own
+    return f"{MARKER_PREFIX}{emoticon_word}"
+
+
+class LocalCache:
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries: OrderedDict = OrderedDict()
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else min(ttl, self.ttl)))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        self._entries.pop(key, None)
+
+    def delete_matching(self, predicate: Callable[[Any], bool]) -> int:
+        keys = [key for key, (value, _) in self._entries.items() if predicate(value)]
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class AccessTracker:
+    def __init__(self) -> None:
+        self._last_access: Dict[str, float] = {}
+
+    def touch(self, emoticon_word: str) -> None:
+        self._last_access[emoticon_word] = time.time()
+
+    def drain(self) -> Dict[str, float]:
+        last_access, self._last_access = self._last_access, {}
+        return last_access
+
+
+class RedisBatcher:
+    def __init__(
+            self, shards: RedisShards, window: float = REDIS_BATCH_WINDOW, max_size: int = REDIS_BATCH_MAX
+    ) -> None:
+        self._shards = shards
+        self.window = window
+        self.max_size = max_size
+        self._gets: Dict[str, asyncio.Future] = {}
+        self._saves: List[Tuple[list, list, asyncio.Future]] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._flush_handle: Optional[asyncio.Handle] = None
+
+    def _pending(self) -> int:
+        return len(self._gets) + len(self._saves)
+
+    def _schedule(self) -> None:
+        if self._pending() >= self.max_size:
+            self.flush()
+        elif self._flush_handle is None:
+            # a zero window still waits for the current tick, so every request woken in it lands in one batch
+            self._flush_handle = (
+                self._loop.call_later(self.window, self.flush) if self.window > 0 else self._loop.call_soon(self.flush)
+            )
+
+    def _bind_loop(self) -> asyncio.AbstractEventLoop:
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._gets, self._saves, self._flush_handle = {}, [], None
+        return loop
+
+    async def get(self, key: str) -> Optional[str]:
+        loop = self._bind_loop()
+        future = self._gets.get(key)
+        if future is None:
+            future = self._gets[key] = loop.create_future()
+            self._schedule()
+        # shielded so one caller giving up doesn't cancel the lookup for the rest waiting on the same key
+        return await asyncio.shield(future)
+
+    async def save_marker(self, keys: list, args: list) -> None:
+        loop = self._bind_loop()
+        future = loop.create_future()
+        self._saves.append((keys, args, future))
+        self._schedule()
+        await asyncio.shield(future)
+
+    def flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending():
+            return
+        gets, saves = self._gets, self._saves
+        self._gets, self._saves = {}, []
+        asyncio.ensure_future(self._execute(gets, saves))
+
+    async def _execute(self, gets: Dict[str, asyncio.Future], saves: List[Tuple[list, list, asyncio.Future]]) -> None:
+        if len(self._shards) == 1:
+            await self._execute_on(self._shards.nodes[0], gets, saves)
+            return
+        shard_gets: Dict[int, Dict[str, asyncio.Future]] = {}
+        for key, future in gets.items():
+            shard_gets.setdefault(self._shards.index(key), {})[key] = future
+        shard_saves: Dict[int, List[Tuple[list, list, asyncio.Future]]] = {}
+        for save in saves:
+            shard_saves.setdefault(self._shards.index(save[0][0]), []).append(save)
+        await asyncio.gather(*(
+            self._execute_on(self._shards.nodes[index], shard_gets.get(index, {}), shard_saves.get(index, []))
+            for index in set(shard_gets) | set(shard_saves)
+        ))
+
+    async def _execute_on(
+            self, redis: Redis, gets: Dict[str, asyncio.Future], saves: List[Tuple[list, list, asyncio.Future]]
+    ) -> None:
+        # writes go first, so a lookup batched with the write of the same marker already sees it
+        pipe = redis.pipeline()
+        for keys, args, _ in saves:
+            pipe.eval(SAVE_EMOTICON_SCRIPT, keys=keys, args=args)
+        if gets:
+            pipe.mget(*gets, encoding="utf-8")
+        try:
+            results = await pipe.execute(return_exceptions=True)
+        except Exception as e:
+            results = [e] * (len(saves) + bool(gets))
+
+        if saves:
+            REDIS_BATCH_SIZE.labels("save").observe(len(saves))
+            for (_, _, future), result in zip(saves, results):
+                resolve(future, result)
+        if gets:
+            REDIS_BATCH_SIZE.labels("get").observe(len(gets))
+            values = results[-1]
+            for i, future in enumerate(gets.values()):
+                resolve(future, values if isinstance(values, Exception) else values[i])
+
+
+def resolve(future: asyncio.Future, result: Any) -> None:
+    if future.done():
+        return
+    if isinstance(result, Exception):
+        future.set_exception(result)
+    else:
+        future.set_result(result)
+
 
 class Service:
-    def __init__(self, redis: Redis) -> None:
+    def __init__(
+            self,
+            redis: Redis,
+            local_cache: Optional[LocalCache] = None,
+            access_tracker: Optional[AccessTracker] = None,
+            usage_counter: Optional[UsageCounter] = None,
+            batcher: Optional[RedisBatcher] = None,
+            shards: Optional[RedisShards] = None
+    ) -> None:
+        # markers and the per-word bookkeeping live on the word's shard, usage and pub/sub stay on the primary
         self._redis = redis
+        self._shards = shards or RedisShards([redis])
+        self._local_cache = local_cache
+        self._access_tracker = access_tracker
+        self._usage_counter = usage_counter
+        self._batcher = batcher
+
+    def _node(self, emoticon_word: str) -> Redis:
+        # everything kept per word (marker, lease, bookkeeping) is placed by the marker key, so it shares a shard
+        return self._shards.node(marker_key(emoticon_word))
 
-    async def save_emoticon_word(self, emoticon_word) -> bool:
-        await self._redis.set(f"{emoticon_word}", "saved")
+    async def save_emoticon_word(self, emoticon_word, size: int = 0, etag: Optional[str] = None) -> bool:
+        # the marker value doubles as the image's etag, markers written without one stay "saved"
+        marker = etag or UNTAGGED_MARKER
+        keys = [marker_key(emoticon_word), ACCESS_KEY, SIZES_KEY, BYTES_KEY]
+        args = [emoticon_word, marker, size, time.time()]
+        if self._batcher is not None:
+            await self._batcher.save_marker(keys, args)
+        else:
+            await self._node(emoticon_word).eval(SAVE_EMOTICON_SCRIPT, keys=keys, args=args)
+        if self._local_cache is not None:
+            self._local_cache.set(emoticon_word, marker)
         return True
 
+    async def set_emoticon_etag(self, emoticon_word, etag: str) -> bool:
+        redis = self._node(emoticon_word)
+        updated = await redis.set(marker_key(emoticon_word), etag, exist=redis.SET_IF_EXIST)
+        if updated and self._local_cache is not None:
+            self._local_cache.set(emoticon_word, etag)
+        return updated
+
     async def get_emoticon_word(self, emoticon_word) -> str:
-        return await self._redis.get(emoticon_word, encoding="utf-8")
+        if self._local_cache is not None:
+            value = self._local_cache.get(emoticon_word)
+            if value is not None:
+                CACHE_LOOKUPS.labels("local_hit").inc()
+                return value
+        with phase("redis"):
+            if self._batcher is not None:
+                value = await self._batcher.get(marker_key(emoticon_word))
+            else:
+                value = await self._node(emoticon_word).get(marker_key(emoticon_word), encoding="utf-8")
+        CACHE_LOOKUPS.labels("redis_hit" if value is not None else "miss").inc()
+        if value is not None and self._local_cache is not None:
+            self._local_cache.set(emoticon_word, value)
+        return value
+
+    async def get_emoticon_words(self, emoticon_words: List[str]) -> Dict[str, Optional[str]]:
+        found = {}
+        missing = []
+        for emoticon_word in emoticon_words:
+            value = self._local_cache.get(emoticon_word) if self._local_cache is not None else None
+            if value is not None:
+                found[emoticon_word] = value
+            else:
+                missing.append(emoticon_word)
+        CACHE_LOOKUPS.labels("local_hit").inc(len(found))
+        if missing:
+            groups = list(self._shards.group(marker_key(emoticon_word) for emoticon_word in missing).items())
+            with phase("redis"):
+                results = await asyncio.gather(*(
+                    self._shards.nodes[index].mget(*keys, encoding="utf-8") for index, keys in groups
+                ))
+            redis_hits = 0
+            for key, value in (pair for (_, keys), values in zip(groups, results) for pair in zip(keys, values)):
+                emoticon_word = key[len(MARKER_PREFIX):]
+                found[emoticon_word] = value
+                redis_hits += value is not None
+                if value is not None and self._local_cache is not None:
+                    self._local_cache.set(emoticon_word, value)
+            CACHE_LOOKUPS.labels("redis_hit").inc(redis_hits)
+            CACHE_LOOKUPS.labels("miss").inc(len(missing) - redis_hits)
+        return found
+
+    async def invalidate_emoticon_word(self, emoticon_word) -> None:
+        await self.invalidate_emoticon_words([emoticon_word])
+
+    async def invalidate_emoticon_words(self, emoticon_words: List[str]) -> None:
+        if self._local_cache is not None:
+            for emoticon_word in emoticon_words:
+                self._local_cache.delete(emoticon_word)
+        pipe = self._redis.pipeline()
+        for emoticon_word in emoticon_words:
+            pipe.publish(CACHE_INVALIDATION_CHANNEL, emoticon_word)
+        await pipe.execute()
+
+    def touch_emoticon_word(self, emoticon_word) -> None:
+        if self._access_tracker is not None:
+            self._access_tracker.touch(emoticon_word)
+
+    async def flush_access_times(self, chunk_size: int = 500) -> int:
+        if self._access_tracker is None:
+            return 0
+        last_access = self._access_tracker.drain()
+
+        async def flush_shard(index: int, keys: List[str]) -> None:
+            for start in range(0, len(keys), chunk_size):
+                args = []
+                for key in keys[start:start + chunk_size]:
+                    emoticon_word = key[len(MARKER_PREFIX):]
+                    args.extend((emoticon_word, last_access[emoticon_word]))
+                await self._shards.nodes[index].eval(TOUCH_EMOTICONS_SCRIPT, keys=[ACCESS_KEY], args=args)
+
+        groups = self._shards.group(marker_key(emoticon_word) for emoticon_word in last_access)
+        await asyncio.gather(*(flush_shard(index, keys) for index, keys in groups.items()))
+        return len(last_access)
+
+    def count_emoticon_request(self, emoticon_word, username: Optional[str], hit: bool) -> None:
+        if self._usage_counter is not None:
+            self._usage_counter.count(emoticon_word, username, hit)
+
+    async def flush_usage_counters(self, max_tracked: int = USAGE_MAX_TRACKED) -> int:
+        if self._usage_counter is None:
+            return 0
+        window = self._usage_counter.drain()
+        if not window.hits and not window.misses:
+            return 0
+        pipe = self._redis.pipeline()
+        pipe.hincrby(USAGE_TOTALS_KEY, "hits", window.hits)
+        pipe.hincrby(USAGE_TOTALS_KEY, "misses", window.misses)
+        for key, sketch in (
+                (USAGE_WORDS_KEY, window.words),
+                (USAGE_WORD_MISSES_KEY, window.word_misses),
+                (USAGE_USERS_KEY, window.users),
+                (USAGE_USER_MISSES_KEY, window.user_misses),
+        ):
+            # only the part of each count the sketch can vouch for, so churned-out keys never inflate
+            for member, count in sketch.guaranteed():
+                pipe.zincrby(key, count, member)
+            pipe.zremrangebyrank(key, 0, -max_tracked - 1)
+        await pipe.execute()
+        return window.hits + window.misses
+
+    async def get_top_emoticon_words(self, limit: int) -> List[Tuple[str, int, int]]:
+        top = await self._redis.zrevrange(USAGE_WORDS_KEY, 0, limit - 1, withscores=True, encoding="utf-8")
+        pipe = self._redis.pipeline()
+        for emoticon_word, _ in top:
+            pipe.zscore(USAGE_WORD_MISSES_KEY, emoticon_word)
+        misses = await pipe.execute()
+        return [
+            (emoticon_word, int(requests), int(word_misses or 0))
+            for (emoticon_word, requests), word_misses in zip(top, misses)
+        ]
+
+    async def get_media_usage(self) -> Tuple[int, int]:
+        async def shard_usage(redis: Redis) -> Tuple[int, int]:
+            pipe = redis.pipeline()
+            pipe.get(BYTES_KEY)
+            pipe.zcard(ACCESS_KEY)
+            total_bytes, total_files = await pipe.execute()
+            return int(total_bytes or 0), int(total_files or 0)
+
+        usage = await asyncio.gather(*(shard_usage(redis) for redis in self._shards.nodes))
+        return sum(total_bytes for total_bytes, _ in usage), sum(total_files for _, total_files in usage)
+
+    async def evict_coldest_emoticon_words(self, count: int, token: str, lease_ttl: int) -> List[str]:
+        # each shard only knows its own coldest words, with hashed placement an even split is close enough
+        shard_count = -(-count // len(self._shards))
+        evicted = await asyncio.gather(*(
+            redis.eval(
+                EVICT_EMOTICONS_SCRIPT, keys=[ACCESS_KEY, SIZES_KEY, BYTES_KEY], args=[shard_count, token, lease_ttl]
+            )
+            for redis in self._shards.nodes
+        ))
+        return [emoticon_word.decode("utf-8") for emoticon_words in evicted for emoticon_word in emoticon_words]
+
+    async def acquire_lease(self, emoticon_word: str, token: str, ttl: int) -> bool:
+        # leases sit next to the marker, the eviction script takes them on the shard it runs on
+        redis = self._node(emoticon_word)
+        return await redis.set(f"lease:{emoticon_word}", token, expire=ttl, exist=redis.SET_IF_NOT_EXIST)
+
+    async def lease_exists(self, emoticon_word: str) -> bool:
+        return bool(await self._node(emoticon_word).exists(f"lease:{emoticon_word}"))
+
+    async def release_lease(self, emoticon_word: str, token: str) -> bool:
+        return bool(await self._node(emoticon_word).eval(
+            RELEASE_LEASE_SCRIPT, keys=[f"lease:{emoticon_word}"], args=[token]
+        ))
+
+    async def acquire_named_lease(self, name: str, token: str, ttl: int) -> bool:
+        # app-wide locks live on the primary under their own prefix, apart from the per-word leases
+        return await self._redis.set(f"{LOCK_PREFIX}{name}", token, expire=ttl, exist=self._redis.SET_IF_NOT_EXIST)
+
+    async def release_named_lease(self, name: str, token: str) -> bool:
+        return bool(await self._redis.eval(RELEASE_LEASE_SCRIPT, keys=[f"{LOCK_PREFIX}{name}"], args=[token]))
+
+    async def restore_emoticon_words(self, emoticons: List[Tuple[str, str, int, float]]) -> int:
+        # (word, marker, size, last access); words that already have a marker are left alone
+        shard_args: Dict[int, list] = {}
+        for emoticon_word, marker, size, accessed_at in emoticons:
+            args = shard_args.setdefault(self._shards.index(marker_key(emoticon_word)), [])
+            args.extend((emoticon_word, marker, size, accessed_at))
+        restored = await asyncio.gather(*(
+            self._shards.nodes[index].eval(RESTORE_EMOTICONS_SCRIPT, keys=[ACCESS_KEY, SIZES_KEY, BYTES_KEY], args=args)
+            for index, args in shard_args.items()
+        ))
+        return sum(restored)
+
+    async def scan_emoticon_words(self, chunk_size: int = 500) -> AsyncIterator[List[Tuple[str, str, Optional[float]]]]:
+        # (word, marker, last access) for every marker, one shard after the other, a scan batch at a time
+        for redis in self._shards.nodes:
+            cursor = 0
+            while True:
+                cursor, keys = await redis.scan(cursor, match=f"{MARKER_PREFIX}*", count=chunk_size)
+                if keys:
+                    emoticon_words = [key.decode("utf-8")[len(MARKER_PREFIX):] for key in keys]
+                    pipe = redis.pipeline()
+                    pipe.mget(*keys, encoding="utf-8")
+                    for emoticon_word in emoticon_words:
+                        pipe.zscore(ACCESS_KEY, emoticon_word)
+                    markers, *accessed = await pipe.execute()
+                    yield [
+                        (emoticon_word, marker, accessed_at)
+                        for emoticon_word, marker, accessed_at in zip(emoticon_words, markers, accessed)
+                        if marker is not None
+                    ]
+                if not cursor:
+                    break
+
+    async def migrate_legacy_markers(self, stat: Callable[[str], Any], chunk_size: int = 500) -> int:
+        # older versions kept a bare `word -> "saved"` string and nothing else, so the markers are found by a scan;
+        # they are re-created on the shard their namespaced key hashes to, with the size of the file on disk
+        async def migrate_shard(redis: Redis) -> int:
+            migrated = 0
+            cursor = 0
+            while True:
+                cursor, keys = await redis.scan(cursor, count=chunk_size)
+                keys = [key.decode("utf-8") for key in keys]
+                keys = [key for key in keys if not key.startswith(NON_MARKER_PREFIXES)]
+                if keys:
+                    emoticon_words = [
+                        emoticon_word.decode("utf-8")
+                        for emoticon_word in await redis.eval(FIND_LEGACY_MARKERS_SCRIPT, keys=[], args=keys)
+                    ]
+                    now = time.time()
+                    emoticons = []
+                    for emoticon_word in emoticon_words:
+                        stat_result = stat(emoticon_word)
+                        # a marker without its file only ever redirected to a 404, the next request renders it again
+                        if stat_result is not None:
+                            emoticons.append((emoticon_word, UNTAGGED_MARKER, stat_result.st_size, now))
+                    if emoticons:
+                        migrated += await self.restore_emoticon_words(emoticons)
+                    if emoticon_words:
+                        await redis.eval(DELETE_LEGACY_MARKERS_SCRIPT, keys=emoticon_words, args=[])
+                if not cursor:
+                    return migrated
+
+        return sum(await asyncio.gather(*(migrate_shard(redis) for redis in self._shards.nodes)))
+
+
+async def listen_for_invalidations(redis: Redis, local_cache: LocalCache) -> None:
+    channel, = await redis.subscribe(CACHE_INVALIDATION_CHANNEL)
+    try:
+        while await channel.wait_message():
+            local_cache.delete(await channel.get(encoding="utf-8"))
+    finally:
+        await redis.unsubscribe(CACHE_INVALIDATION_CHANNEL)
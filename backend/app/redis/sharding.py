@@ -0,0 +1,51 @@
+import bisect
+import hashlib
+
+from typing import Dict, Iterable, List, Optional
+
+from aioredis import Redis
+
+from app.core.config import REDIS_SHARD_REPLICAS
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    def __init__(self, nodes: List[str], replicas: int = REDIS_SHARD_REPLICAS) -> None:
+        self.nodes = list(nodes)
+        # every node owns many small arcs, so adding one takes an even ~1/n of the keys from all the others
+        points = sorted(
+            (ring_hash(f"{node}#{replica}"), index)
+            for index, node in enumerate(self.nodes)
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._owners = [index for _, index in points]
+
+    def node(self, key: str) -> int:
+        if len(self.nodes) == 1:
+            return 0
+        return self._owners[bisect.bisect(self._hashes, ring_hash(key)) % len(self._hashes)]
+
+
+class RedisShards:
+    def __init__(self, nodes: List[Redis], names: Optional[List[str]] = None) -> None:
+        self.nodes = nodes
+        self.ring = HashRing(names or [str(index) for index in range(len(nodes))])
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def index(self, key: str) -> int:
+        return self.ring.node(key)
+
+    def node(self, key: str) -> Redis:
+        return self.nodes[self.ring.node(key)]
+
+    def group(self, keys: Iterable[str]) -> Dict[int, List[str]]:
+        groups: Dict[int, List[str]] = {}
+        for key in keys:
+            groups.setdefault(self.ring.node(key), []).append(key)
+        return groups
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+
+from fastapi import FastAPI
+
+from app.redis.containers import container
+from app.redis.services import listen_for_invalidations
+from app.core.config import PRINCIPAL_CACHE_REDIS, USAGE_FLUSH_INTERVAL
+from app.services import principal_cache
+
+
+logger = logging.getLogger(__name__)
+
+
+async def start_cache_invalidation_listener(app: FastAPI) -> None:
+    try:
+        redis = await container.redis_pool()
+        app.state._cache_invalidation = asyncio.ensure_future(
+            listen_for_invalidations(redis, container.local_cache())
+        )
+    except Exception as e:
+        logger.warning("--- REDIS SUBSCRIBE ERROR ---")
+        logger.warning(e)
+        logger.warning("--- REDIS SUBSCRIBE ERROR ---")
+
+
+async def stop_cache_invalidation_listener(app: FastAPI) -> None:
+    task = getattr(app.state, "_cache_invalidation", None)
+    if task is not None:
+        task.cancel()
+
+
+async def attach_principal_cache(app: FastAPI) -> None:
+    if not PRINCIPAL_CACHE_REDIS:
+        return
+    try:
+        principal_cache.attach_redis(await container.redis_pool())
+    except Exception as e:
+        logger.warning("--- REDIS CONNECTION ERROR ---")
+        logger.warning(e)
+        logger.warning("--- REDIS CONNECTION ERROR ---")
+
+
+async def detach_principal_cache(app: FastAPI) -> None:
+    principal_cache.attach_redis(None)
+
+
+async def flush_usage_counters() -> None:
+    try:
+        service = await container.service()
+        await service.flush_usage_counters()
+    except Exception as e:
+        logger.warning("--- USAGE FLUSH ERROR ---")
+        logger.warning(e)
+        logger.warning("--- USAGE FLUSH ERROR ---")
+
+
+async def flush_usage_counters_periodically() -> None:
+    while True:
+        await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+        await flush_usage_counters()
+
+
+async def start_usage_flush(app: FastAPI) -> None:
+    app.state._usage_flush = asyncio.ensure_future(flush_usage_counters_periodically())
+
+
+async def stop_usage_flush(app: FastAPI) -> None:
+    task = getattr(app.state, "_usage_flush", None)
+    if task is not None:
+        task.cancel()
+    await flush_usage_counters()
+
+
+async def close_redis_pool(app: FastAPI) -> None:
+    # the batcher holds on to the pool, the next start builds a new one around the new pool
+    container.redis_batcher.reset()
+    try:
+        await container.redis_shards.shutdown()
+        await container.redis_pool.shutdown()
+    except Exception as e:
+        logger.warning("--- REDIS DISCONNECT ERROR ---")
+        logger.warning(e)
+        logger.warning("--- REDIS DISCONNECT ERROR ---")
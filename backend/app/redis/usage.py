@@ -0,0 +1,90 @@
+from typing import Dict, Iterator, Optional, Tuple
+
+from app.core.config import USAGE_SKETCH_SIZE
+
+
+class SpaceSaving:
+    # Space-Saving heavy hitters: at most `capacity` keys, a newcomer replaces a key with the lowest count and
+    # inherits that count as its error, so count - error is a lower bound and count an upper bound
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.counts: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self._buckets: Dict[int, Dict[str, None]] = {}
+        self._min = 0
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def _place(self, key: str, count: int) -> None:
+        self.counts[key] = count
+        self._buckets.setdefault(count, {})[key] = None
+
+    def _unplace(self, key: str) -> int:
+        count = self.counts.pop(key)
+        bucket = self._buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[count]
+        return count
+
+    def add(self, key: str) -> None:
+        count = self.counts.get(key)
+        if count is not None:
+            self._unplace(key)
+            self._place(key, count + 1)
+            if count == self._min and count not in self._buckets:
+                self._min = count + 1
+            return
+
+        if len(self.counts) < self.capacity:
+            self._place(key, 1)
+            self.errors[key] = 0
+            self._min = 1
+            return
+
+        victim = next(iter(self._buckets[self._min]))
+        floor = self._unplace(victim)
+        del self.errors[victim]
+        self._place(key, floor + 1)
+        self.errors[key] = floor
+        if floor not in self._buckets:
+            self._min = floor + 1
+
+    def guaranteed(self) -> Iterator[Tuple[str, int]]:
+        for key, count in self.counts.items():
+            if count > self.errors[key]:
+                yield key, count - self.errors[key]
+
+
+class UsageWindow:
+    def __init__(self, capacity: int) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.words = SpaceSaving(capacity)
+        self.word_misses = SpaceSaving(capacity)
+        self.users = SpaceSaving(capacity)
+        self.user_misses = SpaceSaving(capacity)
+
+
+class UsageCounter:
+    def __init__(self, capacity: int = USAGE_SKETCH_SIZE) -> None:
+        self.capacity = capacity
+        self._window = UsageWindow(capacity)
+
+    def count(self, emoticon_word: str, username: Optional[str], hit: bool) -> None:
+        window = self._window
+        window.words.add(emoticon_word)
+        if username is not None:
+            window.users.add(username)
+        if hit:
+            window.hits += 1
+            return
+        window.misses += 1
+        window.word_misses.add(emoticon_word)
+        if username is not None:
+            window.user_misses.add(username)
+
+    def drain(self) -> UsageWindow:
+        window, self._window = self._window, UsageWindow(self.capacity)
+        return window
@@ -1,4 +1,18 @@
 from app.services.authentication import AuthService
+from app.services.upstream import EmoticonUpstream
+from app.services.principals import PrincipalCache
+from app.services.identicon import IdenticonGenerator
+from app.services.catalog import EmoticonCatalog
+from app.services.variants import VariantRenderer
+from app.core.config import EMOTICON_GENERATOR
+from app.core.metrics import instrument_hashing_pool, instrument_local_cache
 
 
-auth_service = AuthService()
\ No newline at end of file
+auth_service = AuthService()
+instrument_hashing_pool(auth_service.hashing_pool)
+emoticon_upstream = EmoticonUpstream()
+principal_cache = PrincipalCache()
+instrument_local_cache(principal_cache, "principals")
+emoticon_catalog = EmoticonCatalog()
+variant_renderer = VariantRenderer()
+emoticon_generator = IdenticonGenerator() if EMOTICON_GENERATOR == "identicon" else emoticon_upstream
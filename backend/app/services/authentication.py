@@ -1,13 +1,18 @@
+import asyncio
 import bcrypt
 import jwt
 
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, Callable, Any
 from fastapi import HTTPException, status
 from pydantic import ValidationError
 
 from app.core.config import SECRET_KEY, JWT_ALGORITHM, JWT_AUDIENCE, JWT_TOKEN_PREFIX, ACCESS_TOKEN_EXPIRE_MINUTES
+from app.core.metrics import PASSWORD_HASHING, PASSWORD_HASHING_REJECTED
+from app.core.timing import phase
+from app.core.config import PASSWORD_HASHING_EXECUTOR, PASSWORD_HASHING_WORKERS, PASSWORD_HASHING_MAX_BACKLOG
 from app.models.token import JWTMeta, JWTCreds, JWTPayload
 from app.models.user import UserPasswordUpdate, UserInDB
 
@@ -18,16 +23,91 @@ class AuthException(BaseException):
     pass
 
 
+def _hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_password(password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(password, hashed_password)
+
+
+class PasswordHashingPool:
+    def __init__(
+            self,
+            kind: str = PASSWORD_HASHING_EXECUTOR,
+            workers: int = PASSWORD_HASHING_WORKERS,
+            max_backlog: int = PASSWORD_HASHING_MAX_BACKLOG
+    ) -> None:
+        self.kind = kind
+        self.workers = workers
+        self.max_backlog = max_backlog
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self._executor: Optional[Executor] = None
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def run(self, func: Callable, *args: Any) -> Any:
+        if self.pending >= self.max_backlog:
+            self.rejected += 1
+            PASSWORD_HASHING_REJECTED.inc()
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many authentication requests, try again later.",
+                headers={"Retry-After": "1"}
+            )
+        self.pending += 1
+        try:
+            with PASSWORD_HASHING.labels(func.__name__.lstrip("_")).time(), phase("bcrypt"):
+                return await asyncio.get_event_loop().run_in_executor(self._get_executor(), func, *args)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": max(0, self.pending - self.workers),
+            "in_flight": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
 class AuthService:
+    def __init__(self, hashing_pool: Optional[PasswordHashingPool] = None) -> None:
+        self.hashing_pool = hashing_pool or PasswordHashingPool()
+
     def create_hashed_password(self, *, plaintext_password: str) -> str:
         hashed_password = self.hash_password(password=plaintext_password)
         return UserPasswordUpdate(password=hashed_password)
 
     def hash_password(self, *, password: str) -> str:
-        return pwd_context.hash(password)
+        return _hash_password(password)
 
     def verify_password(self, *, password: str, hashed_password: str) -> bool:
-        return pwd_context.verify(password, hashed_password)
+        return _verify_password(password, hashed_password)
+
+    async def create_hashed_password_async(self, *, plaintext_password: str) -> UserPasswordUpdate:
+        hashed_password = await self.hash_password_async(password=plaintext_password)
+        return UserPasswordUpdate(password=hashed_password)
+
+    async def hash_password_async(self, *, password: str) -> str:
+        return await self.hashing_pool.run(_hash_password, password)
+
+    async def verify_password_async(self, *, password: str, hashed_password: str) -> bool:
+        return await self.hashing_pool.run(_verify_password, password, hashed_password)
 
     def create_access_token_for_user(
             self,
@@ -56,13 +136,17 @@ class AuthService:
         return access_token
 
     def get_username_from_token(self, *, token: str, secret_key: str) -> Optional[str]:
+        return self.get_payload_from_token(token=token, secret_key=secret_key).username
+
+    def get_payload_from_token(self, *, token: str, secret_key: str) -> JWTPayload:
         try:
-            decoded_token = jwt.decode(token, str(secret_key), audience=JWT_AUDIENCE, algorithms=[JWT_ALGORITHM])
-            payload = JWTPayload(**decoded_token)
+            with phase("jwt"):
+                decoded_token = jwt.decode(token, str(secret_key), audience=JWT_AUDIENCE, algorithms=[JWT_ALGORITHM])
+                payload = JWTPayload(**decoded_token)
         except (jwt.PyJWTError, ValidationError):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Could not validate token credentials.",
                 headers={"WWW-Authenticate": "Bearer"}
             )
-        return payload.username
+        return payload
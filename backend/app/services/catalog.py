@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+
+from typing import Dict, Iterable, List, Set
+
+from databases import Database
+
+from app.core.config import EMOTICON_CATALOG_FLUSH_INTERVAL, EMOTICON_CATALOG_BATCH
+from app.db.repositories.emoticons import EmoticonsRepository
+from app.models.emoticon import EmoticonCreate
+
+
+logger = logging.getLogger(__name__)
+
+
+def chunked(items: List, size: int) -> Iterable[List]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class EmoticonCatalog:
+    # write-behind buffer for the emoticons table: Redis stays the hot path, Postgres gets batched upserts
+    def __init__(
+            self, batch_size: int = EMOTICON_CATALOG_BATCH, interval: float = EMOTICON_CATALOG_FLUSH_INTERVAL
+    ) -> None:
+        self.batch_size = batch_size
+        self.interval = interval
+        self._saved: Dict[str, EmoticonCreate] = {}
+        self._accessed: Dict[str, float] = {}
+        self._deleted: Set[str] = set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._saved) + len(self._accessed) + len(self._deleted)
+
+    def record(self, emoticon_word: str, storage_path: str, size: int, etag: str) -> None:
+        self._deleted.discard(emoticon_word)
+        self._saved[emoticon_word] = EmoticonCreate(word=emoticon_word, storage_path=storage_path, size=size, etag=etag)
+
+    def touch(self, emoticon_word: str) -> None:
+        self._accessed[emoticon_word] = time.time()
+
+    def forget(self, emoticon_words: Iterable[str]) -> None:
+        for emoticon_word in emoticon_words:
+            self._saved.pop(emoticon_word, None)
+            self._accessed.pop(emoticon_word, None)
+            self._deleted.add(emoticon_word)
+
+    def _requeue(self, saved: Dict[str, EmoticonCreate], accessed: Dict[str, float], deleted: Set[str]) -> None:
+        # anything recorded since the swap is newer than what failed to flush and wins
+        for emoticon_word, emoticon in saved.items():
+            if emoticon_word not in self._deleted:
+                self._saved.setdefault(emoticon_word, emoticon)
+        for emoticon_word, accessed_at in accessed.items():
+            if emoticon_word not in self._deleted:
+                self._accessed[emoticon_word] = max(accessed_at, self._accessed.get(emoticon_word, 0.0))
+        for emoticon_word in deleted:
+            if emoticon_word not in self._saved:
+                self._deleted.add(emoticon_word)
+
+    async def flush(self, db: Database) -> int:
+        saved, self._saved = self._saved, {}
+        accessed, self._accessed = self._accessed, {}
+        deleted, self._deleted = self._deleted, set()
+        emoticons_repo = EmoticonsRepository(db)
+        try:
+            for emoticons in chunked(list(saved.values()), self.batch_size):
+                await emoticons_repo.save_emoticons(emoticons=emoticons)
+            for last_access in chunked(list(accessed.items()), self.batch_size):
+                await emoticons_repo.touch_emoticons(last_access=dict(last_access))
+            for emoticon_words in chunked(list(deleted), self.batch_size):
+                await emoticons_repo.delete_emoticons(words=emoticon_words)
+        except BaseException:
+            self._requeue(saved, accessed, deleted)
+            raise
+        return len(saved) + len(accessed) + len(deleted)
+
+    async def run(self, db: Database) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush(db)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("--- EMOTICON CATALOG FLUSH ERROR ---")
+                logger.warning(e)
+                logger.warning("--- EMOTICON CATALOG FLUSH ERROR ---")
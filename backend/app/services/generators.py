@@ -0,0 +1,26 @@
+import asyncio
+
+from typing import AsyncIterator, Dict, List
+
+
+class EmoticonGenerator:
+    media_type = "image/png"
+
+    async def start(self) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+    async def render(self, emoticon_word: str) -> bytes:
+        raise NotImplementedError
+
+    async def render_many(self, emoticon_words: List[str]) -> Dict[str, bytes]:
+        images = await asyncio.gather(*(self.render(emoticon_word) for emoticon_word in emoticon_words))
+        return dict(zip(emoticon_words, images))
+
+    async def stream(self, emoticon_word: str) -> AsyncIterator[bytes]:
+        yield await self.render(emoticon_word)
+
+    def retry_after(self) -> int:
+        return 1
@@ -0,0 +1,108 @@
+import asyncio
+import hashlib
+import struct
+import zlib
+import numpy as np
+
+from typing import Dict, List, Optional
+
+from app.core.config import IDENTICON_CELL_SIZE, IDENTICON_BATCH_MAX
+from app.core.timing import phase
+from app.services.generators import EmoticonGenerator
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+GRID_SIZE = 5
+BACKGROUND = np.array([240, 240, 240], dtype=np.uint8)
+# the left half plus the middle column, mirrored onto the right half
+MIRRORED_COLUMNS = np.array([0, 1, 2, 1, 0])
+
+
+def _png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+
+def encode_png(scanlines: np.ndarray, width: int, height: int) -> bytes:
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"".join((
+        PNG_SIGNATURE,
+        _png_chunk(b"IHDR", header),
+        _png_chunk(b"IDAT", zlib.compress(scanlines.tobytes(), 6)),
+        _png_chunk(b"IEND", b""),
+    ))
+
+
+def render_identicons(emoticon_words: List[str], cell_size: int = IDENTICON_CELL_SIZE) -> List[bytes]:
+    if not emoticon_words:
+        return []
+    digests = np.frombuffer(
+        b"".join(hashlib.sha256(emoticon_word.encode("utf-8")).digest() for emoticon_word in emoticon_words),
+        dtype=np.uint8
+    ).reshape(len(emoticon_words), 32)
+
+    # 15 bits pick the filled cells of the 5x3 half grid, 3 more bytes pick the colour
+    half = (digests[:, :15] & 1).astype(bool).reshape(-1, GRID_SIZE, 3)
+    cells = half[:, :, MIRRORED_COLUMNS]
+    colours = 64 + digests[:, 15:18] // 2
+
+    grid = np.where(cells[..., None], colours[:, None, None, :], BACKGROUND).astype(np.uint8)
+
+    margin = cell_size // 2
+    side = GRID_SIZE * cell_size + 2 * margin
+    pixels = np.empty((len(emoticon_words), side, side, 3), dtype=np.uint8)
+    pixels[:] = BACKGROUND
+    pixels[:, margin:side - margin, margin:side - margin] = grid.repeat(cell_size, axis=1).repeat(cell_size, axis=2)
+
+    count, height, width, _ = pixels.shape
+    # every PNG scanline starts with its filter type byte, 0 meaning unfiltered
+    scanlines = np.zeros((count, height, 1 + width * 3), dtype=np.uint8)
+    scanlines[:, :, 1:] = pixels.reshape(count, height, width * 3)
+    return [encode_png(scanlines[i], width, height) for i in range(count)]
+
+
+class IdenticonGenerator(EmoticonGenerator):
+    def __init__(self, cell_size: int = IDENTICON_CELL_SIZE, max_batch: int = IDENTICON_BATCH_MAX) -> None:
+        self.cell_size = cell_size
+        self.max_batch = max_batch
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._flush_handle: Optional[asyncio.Handle] = None
+
+    async def render(self, emoticon_word: str) -> bytes:
+        # misses rendered in the same tick (a batch request, prewarm workers) share one vectorized render_many
+        # call in the executor, so neither numpy nor zlib ever runs on the event loop
+        loop = asyncio.get_event_loop()
+        future = self._pending.get(emoticon_word)
+        if future is None:
+            future = self._pending[emoticon_word] = loop.create_future()
+            if len(self._pending) >= self.max_batch:
+                self.flush()
+            elif self._flush_handle is None:
+                self._flush_handle = loop.call_soon(self.flush)
+        with phase("render"):
+            return await asyncio.shield(future)
+
+    def flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, {}
+        if pending:
+            asyncio.ensure_future(self._render_pending(pending))
+
+    async def _render_pending(self, pending: Dict[str, asyncio.Future]) -> None:
+        try:
+            images = await self.render_many(list(pending))
+        except Exception as e:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for emoticon_word, future in pending.items():
+            if not future.done():
+                future.set_result(images[emoticon_word])
+
+    async def render_many(self, emoticon_words: List[str]) -> Dict[str, bytes]:
+        images = await asyncio.get_event_loop().run_in_executor(
+            None, render_identicons, emoticon_words, self.cell_size
+        )
+        return dict(zip(emoticon_words, images))
@@ -0,0 +1,64 @@
+import hashlib
+import time
+
+from typing import Optional
+from aioredis import Redis
+
+from app.core.config import PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL
+from app.models.user import UserInDB
+from app.redis.services import LocalCache
+
+
+class PrincipalCache:
+    def __init__(self, max_size: int = PRINCIPAL_CACHE_SIZE, ttl: int = PRINCIPAL_CACHE_TTL) -> None:
+        self.ttl = ttl
+        self._local = LocalCache(max_size=max_size, ttl=ttl)
+        self._redis: Optional[Redis] = None
+
+    def attach_redis(self, redis: Optional[Redis]) -> None:
+        self._redis = redis
+
+    @staticmethod
+    def token_key(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+    async def get(self, token: str) -> Optional[UserInDB]:
+        key = self.token_key(token)
+        user = self._local.get(key)
+        if user is not None or self._redis is None:
+            return user
+
+        user_json = await self._redis.get(f"principal:{key}", encoding="utf-8")
+        if user_json is None:
+            return None
+        user = UserInDB.parse_raw(user_json)
+        self._local.set(key, user, ttl=await self._redis.ttl(f"principal:{key}"))
+        return user
+
+    async def set(self, token: str, user: UserInDB, expires_at: float) -> None:
+        ttl = min(self.ttl, int(expires_at - time.time()))
+        if ttl <= 0:
+            return
+        key = self.token_key(token)
+        self._local.set(key, user, ttl=ttl)
+        if self._redis is not None:
+            transaction = self._redis.multi_exec()
+            transaction.set(f"principal:{key}", user.json(), expire=ttl)
+            transaction.sadd(f"principal:user:{user.username}", key)
+            transaction.expire(f"principal:user:{user.username}", self.ttl)
+            await transaction.execute()
+
+    async def invalidate_user(self, username: str) -> None:
+        self._local.delete_matching(lambda user: user.username == username)
+        if self._redis is not None:
+            keys = await self._redis.smembers(f"principal:user:{username}", encoding="utf-8")
+            await self._redis.delete(f"principal:user:{username}", *(f"principal:{key}" for key in keys))
+
+    async def invalidate_token(self, token: str) -> None:
+        key = self.token_key(token)
+        self._local.delete(key)
+        if self._redis is not None:
+            await self._redis.delete(f"principal:{key}")
+
+    def stats(self) -> dict:
+        return self._local.stats()
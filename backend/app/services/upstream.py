@@ -0,0 +1,309 @@
+import asyncio
+import logging
+import random
+import time
+import httpx
+
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Set, Union
+
+from app.core.config import (
+    EMOTICON_UPSTREAM_URLS,
+    UPSTREAM_MAX_CONNECTIONS,
+    UPSTREAM_MAX_KEEPALIVE,
+    UPSTREAM_CONNECT_TIMEOUT,
+    UPSTREAM_READ_TIMEOUT,
+    UPSTREAM_POOL_TIMEOUT,
+    UPSTREAM_RETRIES,
+    UPSTREAM_RETRY_BACKOFF,
+    UPSTREAM_BREAKER_FAILURES,
+    UPSTREAM_BREAKER_RESET_TIMEOUT,
+    UPSTREAM_HEALTH_PATH,
+    UPSTREAM_HEALTH_INTERVAL,
+    UPSTREAM_HEALTH_TIMEOUT,
+    UPSTREAM_HEALTH_FAILURES,
+    UPSTREAM_LATENCY_DECAY,
+)
+from app.core.metrics import UPSTREAM_LATENCY, UPSTREAM_ERRORS, UPSTREAM_OUTSTANDING, UPSTREAM_HEALTHY
+from app.core.timing import record_phase
+from app.services.generators import EmoticonGenerator
+
+
+logger = logging.getLogger(__name__)
+
+
+class UpstreamUnavailable(Exception):
+    pass
+
+
+class UpstreamRejected(Exception):
+    def __init__(self, status_code: int, emoticon_word: str) -> None:
+        super().__init__(f"emoticon upstream answered {status_code} for {emoticon_word!r}")
+        self.status_code = status_code
+
+
+def is_client_error(response: httpx.Response) -> bool:
+    # a 4xx is the upstream turning the word down: it is healthy, and asking it again won't change the answer
+    return 400 <= response.status_code < 500
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def ready(self) -> bool:
+        # like allow_request, but without claiming the half-open probe
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at >= self.reset_timeout
+        return not self._probe_in_flight
+
+    def allow_request(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def retry_after(self) -> int:
+        return max(1, int(self.reset_timeout - (time.monotonic() - self.opened_at)))
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        # an attempt its caller abandoned says nothing about the upstream, so the next request gets to probe instead
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning("emoticon upstream circuit opened after %s failures", self.failures)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class UpstreamEndpoint:
+    def __init__(self, url: str, breaker: Optional[CircuitBreaker] = None) -> None:
+        self.url = url.rstrip("/")
+        self.breaker = breaker or CircuitBreaker(UPSTREAM_BREAKER_FAILURES, UPSTREAM_BREAKER_RESET_TIMEOUT)
+        self.outstanding = 0
+        self.latency = 0.0
+        self.healthy = True
+        self.health_failures = 0
+        UPSTREAM_OUTSTANDING.labels(self.url).set_function(lambda: self.outstanding)
+        UPSTREAM_HEALTHY.labels(self.url).set_function(lambda: int(self.healthy))
+
+    def observe_latency(self, elapsed: float, decay: float) -> None:
+        UPSTREAM_LATENCY.labels(self.url).observe(elapsed)
+        self.latency = elapsed if not self.latency else decay * elapsed + (1 - decay) * self.latency
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "breaker": self.breaker.state,
+            "outstanding": self.outstanding,
+            "latency_ms": round(self.latency * 1000, 3),
+        }
+
+
+class EmoticonUpstream(EmoticonGenerator):
+    def __init__(
+            self,
+            base_urls: Union[str, Sequence[str]] = EMOTICON_UPSTREAM_URLS,
+            *,
+            max_connections: int = UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive: int = UPSTREAM_MAX_KEEPALIVE,
+            connect_timeout: float = UPSTREAM_CONNECT_TIMEOUT,
+            read_timeout: float = UPSTREAM_READ_TIMEOUT,
+            pool_timeout: float = UPSTREAM_POOL_TIMEOUT,
+            retries: int = UPSTREAM_RETRIES,
+            retry_backoff: float = UPSTREAM_RETRY_BACKOFF,
+            health_path: str = UPSTREAM_HEALTH_PATH,
+            health_interval: float = UPSTREAM_HEALTH_INTERVAL,
+            health_timeout: float = UPSTREAM_HEALTH_TIMEOUT,
+            health_failures: int = UPSTREAM_HEALTH_FAILURES,
+            latency_decay: float = UPSTREAM_LATENCY_DECAY
+    ) -> None:
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.health_failures = health_failures
+        self.latency_decay = latency_decay
+        self.set_endpoints(base_urls)
+        self._pool_limits = httpx.PoolLimits(soft_limit=max_keepalive, hard_limit=max_connections)
+        self._timeout = httpx.Timeout(
+            connect_timeout=connect_timeout,
+            read_timeout=read_timeout,
+            write_timeout=read_timeout,
+            pool_timeout=pool_timeout,
+        )
+        self._client: Optional[httpx.AsyncClient] = None
+        self._health_checks: Optional[asyncio.Future] = None
+
+    def set_endpoints(self, base_urls: Union[str, Sequence[str]]) -> None:
+        if isinstance(base_urls, str):
+            base_urls = base_urls.split(",")
+        self.endpoints = [UpstreamEndpoint(url.strip()) for url in base_urls if url.strip()]
+
+    async def start(self) -> None:
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self._timeout, pool_limits=self._pool_limits)
+        if self._health_checks is None and self.health_interval > 0:
+            self._health_checks = asyncio.ensure_future(self.run_health_checks())
+
+    async def close(self) -> None:
+        if self._health_checks is not None:
+            self._health_checks.cancel()
+            self._health_checks = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def choose_endpoint(self, tried: Set[UpstreamEndpoint]) -> Optional[UpstreamEndpoint]:
+        ready = [endpoint for endpoint in self.endpoints if endpoint.breaker.ready()]
+        # health checks only steer traffic: when every endpoint failed them, still let the breakers decide
+        candidates = [endpoint for endpoint in ready if endpoint.healthy] or ready
+        candidates = [endpoint for endpoint in candidates if endpoint not in tried] or candidates
+        if len(candidates) > 2:
+            candidates = random.sample(candidates, 2)
+        for endpoint in sorted(candidates, key=lambda endpoint: (endpoint.outstanding, endpoint.latency)):
+            if endpoint.breaker.allow_request():
+                return endpoint
+        return None
+
+    def _record_failure(self, endpoint: UpstreamEndpoint, emoticon_word: str, attempt: int, e: Exception) -> None:
+        UPSTREAM_ERRORS.labels(endpoint.url, type(e).__name__).inc()
+        endpoint.breaker.record_failure()
+        logger.warning(
+            "emoticon upstream %s attempt %s for %r failed: %r", endpoint.url, attempt + 1, emoticon_word, e
+        )
+
+    async def render(self, emoticon_word: str) -> bytes:
+        await self.start()
+        tried: Set[UpstreamEndpoint] = set()
+        for attempt in range(self.retries + 1):
+            endpoint = self.choose_endpoint(tried)
+            if endpoint is None:
+                raise UpstreamUnavailable("every emoticon upstream circuit is open")
+            tried.add(endpoint)
+            endpoint.outstanding += 1
+            requested_at = time.perf_counter()
+            try:
+                response = await self._client.get(f"{endpoint.url}/monster/{emoticon_word}")
+                elapsed = time.perf_counter() - requested_at
+                endpoint.observe_latency(elapsed, self.latency_decay)
+                record_phase("upstream", elapsed)
+                if not is_client_error(response):
+                    response.raise_for_status()
+            except (httpx.HTTPError, OSError) as e:
+                self._record_failure(endpoint, emoticon_word, attempt, e)
+                if attempt < self.retries:
+                    await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+                continue
+            except BaseException:
+                # cancelled: neither a success nor a failure, but a half-open probe must not be held forever
+                endpoint.breaker.release_probe()
+                raise
+            finally:
+                endpoint.outstanding -= 1
+            endpoint.breaker.record_success()
+            if is_client_error(response):
+                raise UpstreamRejected(response.status_code, emoticon_word)
+            return response.content
+        raise UpstreamUnavailable(f"emoticon upstream failed after {self.retries + 1} attempts")
+
+    def retry_after(self) -> int:
+        if any(endpoint.breaker.ready() for endpoint in self.endpoints):
+            return 1
+        return min((endpoint.breaker.retry_after() for endpoint in self.endpoints), default=1)
+
+    async def stream(self, emoticon_word: str) -> AsyncIterator[bytes]:
+        await self.start()
+        tried: Set[UpstreamEndpoint] = set()
+        for attempt in range(self.retries + 1):
+            endpoint = self.choose_endpoint(tried)
+            if endpoint is None:
+                raise UpstreamUnavailable("every emoticon upstream circuit is open")
+            tried.add(endpoint)
+            started = False
+            rejected = None
+            endpoint.outstanding += 1
+            requested_at = time.perf_counter()
+            try:
+                async with self._client.stream("GET", f"{endpoint.url}/monster/{emoticon_word}") as response:
+                    elapsed = time.perf_counter() - requested_at
+                    endpoint.observe_latency(elapsed, self.latency_decay)
+                    record_phase("upstream", elapsed)
+                    if is_client_error(response):
+                        rejected = response.status_code
+                    else:
+                        response.raise_for_status()
+                        async for chunk in response.aiter_bytes():
+                            if chunk:
+                                started = True
+                                yield chunk
+            except (httpx.HTTPError, OSError) as e:
+                self._record_failure(endpoint, emoticon_word, attempt, e)
+                if started:
+                    # part of the body already went to the consumer, so the attempt can't be replayed
+                    raise UpstreamUnavailable(f"emoticon upstream broke off the response for {emoticon_word!r}")
+                if attempt < self.retries:
+                    await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+                continue
+            except BaseException:
+                # the consumer closed the stream (an oversize body) or the task was cancelled, which says nothing
+                # about the upstream's health; only the half-open probe, if this was it, is handed back
+                endpoint.breaker.release_probe()
+                raise
+            finally:
+                endpoint.outstanding -= 1
+            endpoint.breaker.record_success()
+            if rejected is not None:
+                raise UpstreamRejected(rejected, emoticon_word)
+            return
+        raise UpstreamUnavailable(f"emoticon upstream failed after {self.retries + 1} attempts")
+
+    async def check_endpoint(self, endpoint: UpstreamEndpoint) -> bool:
+        try:
+            response = await self._client.get(f"{endpoint.url}{self.health_path}", timeout=self.health_timeout)
+            response.raise_for_status()
+        except (httpx.HTTPError, OSError) as e:
+            endpoint.health_failures += 1
+            if endpoint.healthy and endpoint.health_failures >= self.health_failures:
+                endpoint.healthy = False
+                logger.warning("emoticon upstream %s ejected after failed health checks: %r", endpoint.url, e)
+            return False
+        if not endpoint.healthy:
+            logger.warning("emoticon upstream %s is healthy again", endpoint.url)
+        endpoint.health_failures = 0
+        endpoint.healthy = True
+        return True
+
+    async def run_health_checks(self) -> None:
+        while True:
+            await asyncio.sleep(self.health_interval)
+            if self._client is not None:
+                await asyncio.gather(*(self.check_endpoint(endpoint) for endpoint in self.endpoints))
+
+    def stats(self) -> List[Dict]:
+        return [endpoint.stats() for endpoint in self.endpoints]
@@ -0,0 +1,85 @@
+import asyncio
+import io
+import math
+import numpy as np
+
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import List, Optional
+
+from PIL import Image
+
+from app.core.config import VARIANT_WORKERS
+from app.core.metrics import VARIANT_LATENCY
+from app.core.timing import phase
+
+
+MEDIA_TYPES = {
+    "png": "image/png",
+    "webp": "image/webp",
+}
+
+
+def render_variant(image: bytes, size: Optional[int], image_format: str) -> bytes:
+    with Image.open(io.BytesIO(image)) as original:
+        variant = original.convert("RGBA")
+    if size:
+        # never upscales, a variant at least as large as the original only changes the format
+        variant.thumbnail((size, size), Image.LANCZOS)
+    output = io.BytesIO()
+    if image_format == "webp":
+        # emoticons are flat colour blocks, lossless WebP is both exact and smaller than lossy at this size
+        variant.save(output, "WEBP", lossless=True)
+    else:
+        variant.save(output, "PNG", optimize=True)
+    return output.getvalue()
+
+
+def sprite_columns(count: int) -> int:
+    return max(1, math.ceil(math.sqrt(count)))
+
+
+def render_sprite_sheet(images: List[bytes], cell_size: int) -> bytes:
+    columns = sprite_columns(len(images))
+    rows = max(1, math.ceil(len(images) / columns))
+    # decoding is per image, everything after it works on one (rows * columns, cell, cell, 4) array
+    cells = np.zeros((rows * columns, cell_size, cell_size, 4), dtype=np.uint8)
+    for i, image in enumerate(images):
+        with Image.open(io.BytesIO(image)) as original:
+            tile = original.convert("RGBA")
+        tile.thumbnail((cell_size, cell_size), Image.LANCZOS)
+        top, left = (cell_size - tile.height) // 2, (cell_size - tile.width) // 2
+        cells[i, top:top + tile.height, left:left + tile.width] = np.asarray(tile)
+    sheet = cells.reshape(rows, columns, cell_size, cell_size, 4).swapaxes(1, 2).reshape(
+        rows * cell_size, columns * cell_size, 4
+    )
+    output = io.BytesIO()
+    Image.fromarray(sheet, "RGBA").save(output, "PNG", optimize=True)
+    return output.getvalue()
+
+
+class VariantRenderer:
+    def __init__(self, workers: int = VARIANT_WORKERS) -> None:
+        self.workers = workers
+        self._executor: Optional[Executor] = None
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    async def render(self, image: bytes, size: Optional[int], image_format: str) -> bytes:
+        with VARIANT_LATENCY.labels(image_format).time(), phase("transcode"):
+            return await asyncio.get_event_loop().run_in_executor(
+                self._get_executor(), render_variant, image, size, image_format
+            )
+
+    async def render_sheet(self, images: List[bytes], cell_size: int) -> bytes:
+        with VARIANT_LATENCY.labels("sprite").time(), phase("transcode"):
+            return await asyncio.get_event_loop().run_in_executor(
+                self._get_executor(), render_sprite_sheet, images, cell_size
+            )
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
@@ -0,0 +1,22 @@
+from app.core.config import (
+    MEDIA_ROOT,
+    MEDIA_URL,
+    MEDIA_STORAGE,
+    PACK_ROOT,
+    PACK_URL,
+    PACK_SEGMENT_BYTES,
+    PACK_COMPACT_GARBAGE_RATIO,
+)
+from app.storage.files import ShardedFileStorage
+from app.storage.packs import PackStorage
+from app.storage.eviction import MediaEvictor
+from app.services import emoticon_catalog
+
+
+if MEDIA_STORAGE == "pack":
+    storage = PackStorage(
+        PACK_ROOT, PACK_URL, segment_bytes=PACK_SEGMENT_BYTES, compact_garbage_ratio=PACK_COMPACT_GARBAGE_RATIO
+    )
+else:
+    storage = ShardedFileStorage(MEDIA_ROOT, MEDIA_URL)
+media_evictor = MediaEvictor(storage, catalog=emoticon_catalog)
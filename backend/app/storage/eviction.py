@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import uuid
+
+from typing import Awaitable, Callable
+
+from app.core.config import (
+    EMOTICON_LEASE_TTL,
+    MEDIA_MAX_BYTES,
+    MEDIA_MAX_FILES,
+    MEDIA_EVICTION_INTERVAL,
+    MEDIA_EVICTION_BATCH,
+    ACCESS_FLUSH_INTERVAL,
+)
+from app.redis.services import Service
+
+
+logger = logging.getLogger(__name__)
+
+EVICTION_LEASE = "eviction"
+
+
+class MediaEvictor:
+    def __init__(
+            self,
+            storage,
+            *,
+            catalog=None,
+            max_bytes: int = MEDIA_MAX_BYTES,
+            max_files: int = MEDIA_MAX_FILES,
+            batch_size: int = MEDIA_EVICTION_BATCH,
+            interval: float = MEDIA_EVICTION_INTERVAL,
+            flush_interval: float = ACCESS_FLUSH_INTERVAL
+    ) -> None:
+        self.storage = storage
+        self.catalog = catalog
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.batch_size = batch_size
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.evicted = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.max_bytes or self.max_files)
+
+    def over_budget(self, total_bytes: int, total_files: int) -> bool:
+        return bool(
+            (self.max_bytes and total_bytes > self.max_bytes)
+            or (self.max_files and total_files > self.max_files)
+        )
+
+    async def evict_once(self, service: Service) -> int:
+        token = uuid.uuid4().hex
+        # one worker evicts per cycle, the rest only flush their access times
+        if not await service.acquire_named_lease(EVICTION_LEASE, token, max(1, int(self.interval))):
+            return 0
+
+        evicted = 0
+        try:
+            while True:
+                total_bytes, total_files = await service.get_media_usage()
+                if not self.over_budget(total_bytes, total_files):
+                    break
+                count = self.batch_size
+                if self.max_files and total_files > self.max_files and not (
+                        self.max_bytes and total_bytes > self.max_bytes):
+                    count = min(count, total_files - self.max_files)
+
+                # markers are gone and the words are leased before any file is touched, so no
+                # route redirects to a deleted file and no render can race the unlink below
+                emoticon_words = await service.evict_coldest_emoticon_words(count, token, EMOTICON_LEASE_TTL)
+                if not emoticon_words:
+                    break
+                await service.invalidate_emoticon_words(emoticon_words)
+                if self.catalog is not None:
+                    self.catalog.forget(emoticon_words)
+                for emoticon_word in emoticon_words:
+                    await self.storage.delete(emoticon_word)
+                await asyncio.gather(*(service.release_lease(emoticon_word, token) for emoticon_word in emoticon_words))
+                evicted += len(emoticon_words)
+        finally:
+            await service.release_named_lease(EVICTION_LEASE, token)
+
+        if evicted:
+            logger.info("evicted %s emoticons from media", evicted)
+        self.evicted += evicted
+        return evicted
+
+    async def run(self, get_service: Callable[[], Awaitable[Service]]) -> None:
+        loop = asyncio.get_event_loop()
+        last_eviction = loop.time()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                service = await get_service()
+                await service.flush_access_times()
+                if self.enabled and loop.time() - last_eviction >= self.interval:
+                    last_eviction = loop.time()
+                    await self.evict_once(service)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("--- MEDIA EVICTION ERROR ---")
+                logger.warning(e)
+                logger.warning("--- MEDIA EVICTION ERROR ---")
@@ -0,0 +1,145 @@
+import os
+import time
+import asyncio
+import uuid
+import hashlib
+import aiofiles
+import aiofiles.os
+
+from typing import AsyncIterator, NamedTuple, Optional
+
+from app.core.timing import record_phase
+
+
+VARIANT_PREFIX = "variant:"
+SPRITE_PREFIX = "sprite:"
+DERIVED_PREFIXES = (VARIANT_PREFIX, SPRITE_PREFIX)
+
+
+class ObjectTooLarge(Exception):
+    pass
+
+
+def variant_name(emoticon_word: str, size: Optional[int], image_format: str) -> str:
+    # a derived rendition is stored, marked and evicted like any other emoticon, under its own name
+    return f"{VARIANT_PREFIX}{size or 0}:{image_format}:{emoticon_word}"
+
+
+def sprite_name(digest: str) -> str:
+    return f"{SPRITE_PREFIX}{digest}"
+
+
+def variant_format(emoticon_word: str) -> Optional[str]:
+    if not emoticon_word.startswith(VARIANT_PREFIX):
+        return None
+    return emoticon_word.split(":", 3)[2]
+
+
+class StoredImage(NamedTuple):
+    size: int
+    etag: str
+
+
+class ShardedFileStorage:
+    def __init__(self, root: str, base_url: str, extension: str = "png") -> None:
+        self.root = root
+        self.base_url = base_url.rstrip("/")
+        self.extension = extension
+
+    @staticmethod
+    def key(emoticon_word: str) -> str:
+        return hashlib.sha256(emoticon_word.encode("utf-8")).hexdigest()
+
+    def relative_path(self, emoticon_word: str) -> str:
+        key = self.key(emoticon_word)
+        return f"{key[:2]}/{key[2:4]}/{key}.{variant_format(emoticon_word) or self.extension}"
+
+    def path(self, emoticon_word: str) -> str:
+        return os.path.join(self.root, self.relative_path(emoticon_word))
+
+    def url(self, emoticon_word: str) -> str:
+        return f"{self.base_url}/{self.relative_path(emoticon_word)}"
+
+    async def load(self) -> None:
+        pass
+
+    def exists(self, emoticon_word: str) -> bool:
+        return os.path.exists(self.path(emoticon_word))
+
+    async def write(self, emoticon_word: str, image: bytes) -> StoredImage:
+        path = self.path(emoticon_word)
+        await aiofiles.os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            async with aiofiles.open(tmp_path, "wb") as f:
+                await f.write(image)
+            # rename within one directory is atomic, so nginx sees either nothing or the whole file
+            await aiofiles.os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return StoredImage(size=len(image), etag=hashlib.sha256(image).hexdigest())
+
+    async def write_stream(
+            self,
+            emoticon_word: str,
+            chunks: AsyncIterator[bytes],
+            max_size: Optional[int] = None
+    ) -> StoredImage:
+        path = self.path(emoticon_word)
+        await aiofiles.os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        size = 0
+        digest = hashlib.sha256()
+        # only the time spent on disk, waiting for the next chunk is the producer's phase
+        writing = 0.0
+        try:
+            async with aiofiles.open(tmp_path, "wb") as f:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if max_size is not None and size > max_size:
+                        raise ObjectTooLarge(f"{emoticon_word!r} is larger than {max_size} bytes")
+                    digest.update(chunk)
+                    started = time.perf_counter()
+                    await f.write(chunk)
+                    writing += time.perf_counter() - started
+            started = time.perf_counter()
+            await aiofiles.os.replace(tmp_path, path)
+            writing += time.perf_counter() - started
+            record_phase("disk_write", writing)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            if hasattr(chunks, "aclose"):
+                await chunks.aclose()
+        return StoredImage(size=size, etag=digest.hexdigest())
+
+    def stat(self, emoticon_word: str) -> Optional[os.stat_result]:
+        try:
+            return os.stat(self.path(emoticon_word))
+        except FileNotFoundError:
+            return None
+
+    async def read(self, emoticon_word: str) -> Optional[bytes]:
+        try:
+            async with aiofiles.open(self.path(emoticon_word), "rb") as f:
+                return await f.read()
+        except FileNotFoundError:
+            return None
+
+    async def compute_etag(self, emoticon_word: str) -> str:
+        def digest_file(path: str) -> str:
+            with open(path, "rb") as f:
+                return hashlib.sha256(f.read()).hexdigest()
+
+        return await asyncio.get_event_loop().run_in_executor(None, digest_file, self.path(emoticon_word))
+
+    async def delete(self, emoticon_word: str) -> bool:
+        try:
+            await aiofiles.os.remove(self.path(emoticon_word))
+        except FileNotFoundError:
+            return False
+        return True
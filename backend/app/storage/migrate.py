@@ -0,0 +1,43 @@
+import argparse
+import logging
+import os
+import sys
+
+from app.core.config import MEDIA_ROOT
+from app.storage.files import ShardedFileStorage
+
+
+logger = logging.getLogger(__name__)
+
+
+def migrate_flat_media(storage: ShardedFileStorage, *, dry_run: bool = False) -> int:
+    moved = 0
+    suffix = f".{storage.extension}"
+    with os.scandir(storage.root) as entries:
+        for entry in entries:
+            if not entry.is_file() or not entry.name.endswith(suffix):
+                continue
+            emoticon_word = entry.name[:-len(suffix)]
+            target = storage.path(emoticon_word)
+            logger.info("%s -> %s", entry.path, target)
+            if not dry_run:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(entry.path, target)
+            moved += 1
+    return moved
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Move flat media/{word}.png files into the sharded layout.")
+    parser.add_argument("--media-root", default=MEDIA_ROOT)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    moved = migrate_flat_media(ShardedFileStorage(args.media_root, ""), dry_run=args.dry_run)
+    logger.info("%s emoticons %s", moved, "would be moved" if args.dry_run else "moved")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
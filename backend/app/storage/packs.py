@@ -0,0 +1,367 @@
+import os
+import time
+import mmap
+import fcntl
+import struct
+import asyncio
+import hashlib
+import logging
+import threading
+
+from contextlib import contextmanager
+from typing import AsyncIterator, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import quote
+
+from app.core.timing import record_phase
+from app.storage.files import ObjectTooLarge, StoredImage
+
+
+logger = logging.getLogger(__name__)
+
+# every record is a header followed by the image; a delete is a header with no body, so the
+# segments alone are a complete log that the index can always be rebuilt or caught up from
+RECORD = struct.Struct("<32sBI")
+PUT, DELETE = 0, 1
+INDEX_HEADER = struct.Struct("<4sIQQ")
+INDEX_ENTRY = struct.Struct("<32sIQI")
+INDEX_MAGIC = b"EPK1"
+SEGMENT_SUFFIX = ".pack"
+
+
+class PackEntry(NamedTuple):
+    segment: int
+    offset: int
+    length: int
+
+
+class PackStat(NamedTuple):
+    st_size: int
+
+
+class PackStorage:
+    def __init__(
+            self,
+            root: str,
+            base_url: str,
+            *,
+            segment_bytes: int,
+            compact_garbage_ratio: float
+    ) -> None:
+        self.root = root
+        self.base_url = base_url.rstrip("/")
+        self.segment_bytes = segment_bytes
+        self.compact_garbage_ratio = compact_garbage_ratio
+        self._index: Dict[bytes, PackEntry] = {}
+        self._live: Dict[int, int] = {}
+        self._maps: Dict[int, mmap.mmap] = {}
+        # how far into the log this process has applied records, its own and those appended by other processes
+        self._position: Tuple[int, int] = (0, 0)
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._dirty = False
+
+    @staticmethod
+    def key(emoticon_word: str) -> bytes:
+        return hashlib.sha256(emoticon_word.encode("utf-8")).digest()
+
+    def relative_path(self, emoticon_word: str) -> str:
+        return f"packs/{self.key(emoticon_word).hex()}"
+
+    def url(self, emoticon_word: str) -> str:
+        return f"{self.base_url}/{quote(emoticon_word, safe='')}"
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.root, f"{segment:08d}{SEGMENT_SUFFIX}")
+
+    def segments(self) -> List[int]:
+        return sorted(
+            int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.root) if name.endswith(SEGMENT_SUFFIX)
+        )
+
+    @contextmanager
+    def _writer(self) -> Iterator[None]:
+        # appends and compaction are serialised across every process sharing the directory
+        with self._lock, open(os.path.join(self.root, "lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                self._load()
+                self._replay()
+                self._truncate_torn_tail()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _load(self) -> None:
+        if self._loaded:
+            return
+        os.makedirs(self.root, exist_ok=True)
+        segments = set(self.segments())
+        try:
+            with open(os.path.join(self.root, "index"), "rb") as f:
+                magic, count, segment, offset = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+                if magic != INDEX_MAGIC:
+                    raise ValueError(f"unknown pack index format {magic!r}")
+                data = f.read(count * INDEX_ENTRY.size)
+        except FileNotFoundError:
+            pass
+        except (ValueError, struct.error) as e:
+            logger.warning("--- PACK INDEX ERROR ---")
+            logger.warning(e)
+            logger.warning("--- PACK INDEX ERROR ---")
+        else:
+            for key, entry_segment, entry_offset, length in INDEX_ENTRY.iter_unpack(data):
+                # segments compacted away after this snapshot was written come back through the replay
+                if entry_segment in segments:
+                    self._index[key] = PackEntry(entry_segment, entry_offset, length)
+                    self._live[entry_segment] = self._live.get(entry_segment, 0) + RECORD.size + length
+            self._position = (segment, offset)
+        self._loaded = True
+
+    @staticmethod
+    def _scan(f, offset: int, size: int) -> Iterator[Tuple[bytes, int, int, int]]:
+        # stops at a record that isn't complete yet, another process may be halfway through appending it
+        f.seek(offset)
+        while offset + RECORD.size <= size:
+            key, kind, length = RECORD.unpack(f.read(RECORD.size))
+            if kind == PUT and offset + RECORD.size + length > size:
+                return
+            yield key, kind, offset + RECORD.size, length
+            offset += RECORD.size + (length if kind == PUT else 0)
+            f.seek(offset)
+
+    def _replay(self) -> int:
+        applied = 0
+        segment, offset = self._position
+        for next_segment in [s for s in self.segments() if s >= segment]:
+            if next_segment != segment:
+                segment, offset = next_segment, 0
+            with open(self.segment_path(segment), "rb") as f:
+                for key, kind, data_offset, length in self._scan(f, offset, os.fstat(f.fileno()).st_size):
+                    if kind == PUT:
+                        self._apply_put(key, PackEntry(segment, data_offset, length))
+                        offset = data_offset + length
+                    else:
+                        self._apply_delete(key)
+                        offset = data_offset
+                    applied += 1
+            self._position = (segment, offset)
+        if applied:
+            self._dirty = True
+        for retired in [s for s in list(self._maps) if not os.path.exists(self.segment_path(s))]:
+            self._maps.pop(retired, None)
+        return applied
+
+    def _truncate_torn_tail(self) -> None:
+        # with the lock held nobody else is appending, so bytes past the last whole record were left by a crash
+        segment, offset = self._position
+        path = self.segment_path(segment)
+        torn = os.path.getsize(path) - offset if os.path.exists(path) else 0
+        if torn > 0:
+            logger.warning("dropping %s torn bytes at the end of pack segment %s", torn, segment)
+            os.truncate(path, offset)
+
+    def _apply_put(self, key: bytes, entry: PackEntry) -> None:
+        self._apply_delete(key)
+        self._index[key] = entry
+        self._live[entry.segment] = self._live.get(entry.segment, 0) + RECORD.size + entry.length
+
+    def _apply_delete(self, key: bytes) -> Optional[PackEntry]:
+        entry = self._index.pop(key, None)
+        if entry is not None and entry.segment in self._live:
+            self._live[entry.segment] -= RECORD.size + entry.length
+        return entry
+
+    def _append(self, records: List[Tuple[bytes, int, bytes]]) -> List[PackEntry]:
+        segment, offset = self._position
+        if offset >= self.segment_bytes or not os.path.exists(self.segment_path(segment)):
+            segment, offset = (segment + 1 if offset else segment), 0
+        entries = []
+        data = bytearray()
+        for key, kind, image in records:
+            entries.append(PackEntry(segment, offset + len(data) + RECORD.size, len(image)))
+            data += RECORD.pack(key, kind, len(image))
+            data += image
+        with open(self.segment_path(segment), "ab") as f:
+            f.write(data)
+        for (key, kind, _), entry in zip(records, entries):
+            if kind == PUT:
+                self._apply_put(key, entry)
+            else:
+                self._apply_delete(key)
+        self._position = (segment, offset + len(data))
+        self._dirty = True
+        return entries
+
+    def put(self, emoticon_word: str, image: bytes) -> PackEntry:
+        with self._writer():
+            return self._append([(self.key(emoticon_word), PUT, image)])[0]
+
+    def remove(self, emoticon_word: str) -> bool:
+        key = self.key(emoticon_word)
+        with self._writer():
+            if key not in self._index:
+                return False
+            self._append([(key, DELETE, b"")])
+        return True
+
+    def _map(self, segment: int, end: int) -> mmap.mmap:
+        mapping = self._maps.get(segment)
+        if mapping is None or len(mapping) < end:
+            # the active segment keeps growing, remap it; readers still holding slices keep the old mapping alive
+            with open(self.segment_path(segment), "rb") as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = mapping
+        return mapping
+
+    def lookup(self, emoticon_word: str) -> Optional[memoryview]:
+        entry = self._index.get(self.key(emoticon_word))
+        if entry is None:
+            return None
+        try:
+            mapping = self._map(entry.segment, entry.offset + entry.length)
+        except FileNotFoundError:
+            return None
+        return memoryview(mapping)[entry.offset:entry.offset + entry.length]
+
+    def refresh(self) -> int:
+        with self._lock:
+            self._load()
+            return self._replay()
+
+    async def read(self, emoticon_word: str) -> Optional[memoryview]:
+        if not self._loaded:
+            await asyncio.get_event_loop().run_in_executor(None, self.refresh)
+        image = self.lookup(emoticon_word)
+        if image is None:
+            # written, moved or deleted by another process since this one last caught up with the log
+            await asyncio.get_event_loop().run_in_executor(None, self.refresh)
+            image = self.lookup(emoticon_word)
+        return image
+
+    async def load(self) -> None:
+        # the app loads the log at startup, so stat() and exists() on the request path never replay it inline
+        if not self._loaded:
+            await asyncio.get_event_loop().run_in_executor(None, self.refresh)
+
+    def exists(self, emoticon_word: str) -> bool:
+        if not self._loaded:
+            self.refresh()
+        return self.key(emoticon_word) in self._index
+
+    def stat(self, emoticon_word: str) -> Optional[PackStat]:
+        if not self._loaded:
+            self.refresh()
+        entry = self._index.get(self.key(emoticon_word))
+        return None if entry is None else PackStat(entry.length)
+
+    async def write(self, emoticon_word: str, image: bytes) -> StoredImage:
+        started = time.perf_counter()
+        await asyncio.get_event_loop().run_in_executor(None, self.put, emoticon_word, image)
+        record_phase("disk_write", time.perf_counter() - started)
+        return StoredImage(size=len(image), etag=hashlib.sha256(image).hexdigest())
+
+    async def write_stream(
+            self,
+            emoticon_word: str,
+            chunks: AsyncIterator[bytes],
+            max_size: Optional[int] = None
+    ) -> StoredImage:
+        # a record is appended in one piece, so the image is buffered first; emoticons are small and capped
+        image = bytearray()
+        try:
+            async for chunk in chunks:
+                image += chunk
+                if max_size is not None and len(image) > max_size:
+                    raise ObjectTooLarge(f"{emoticon_word!r} is larger than {max_size} bytes")
+        finally:
+            if hasattr(chunks, "aclose"):
+                await chunks.aclose()
+        return await self.write(emoticon_word, bytes(image))
+
+    async def compute_etag(self, emoticon_word: str) -> str:
+        image = await self.read(emoticon_word)
+        return hashlib.sha256(image if image is not None else b"").hexdigest()
+
+    async def delete(self, emoticon_word: str) -> bool:
+        return await asyncio.get_event_loop().run_in_executor(None, self.remove, emoticon_word)
+
+    def garbage_ratio(self, segment: int) -> float:
+        try:
+            size = os.path.getsize(self.segment_path(segment))
+        except FileNotFoundError:
+            return 0.0
+        return 1 - self._live.get(segment, 0) / size if size else 0.0
+
+    def compact_segment(self, segment: int) -> int:
+        # live images and still needed deletes are appended to the active segment like any other write,
+        # so every process picks up their new location from the log before the old segment goes away
+        with self._writer():
+            if segment >= self._position[0]:
+                return 0
+            older = any(other < segment for other in self.segments())
+            records = []
+            with open(self.segment_path(segment), "rb") as f:
+                scanned = list(self._scan(f, 0, os.fstat(f.fileno()).st_size))
+                for key, kind, offset, length in scanned:
+                    if kind == PUT and self._index.get(key) == PackEntry(segment, offset, length):
+                        f.seek(offset)
+                        records.append((key, PUT, f.read(length)))
+                    elif kind == DELETE and older and key not in self._index:
+                        records.append((key, DELETE, b""))
+            for start in range(0, len(records), 1000):
+                self._append(records[start:start + 1000])
+            self.save_index()
+            self._maps.pop(segment, None)
+            self._live.pop(segment, None)
+            os.remove(self.segment_path(segment))
+        return len(records)
+
+    def compact(self) -> int:
+        self.refresh()
+        moved = 0
+        for segment in self.segments()[:-1]:
+            if self.garbage_ratio(segment) >= self.compact_garbage_ratio:
+                moved += self.compact_segment(segment)
+                logger.info("compacted pack segment %s", segment)
+        return moved
+
+    def save_index(self) -> None:
+        with self._lock:
+            if not self._loaded:
+                return
+            entries = b"".join(
+                INDEX_ENTRY.pack(key, *entry) for key, entry in self._index.items()
+            )
+            header = INDEX_HEADER.pack(INDEX_MAGIC, len(self._index), *self._position)
+            path = os.path.join(self.root, "index")
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(header)
+                f.write(entries)
+            os.replace(tmp_path, path)
+            self._dirty = False
+
+    def maintain(self) -> int:
+        moved = self.compact()
+        if self._dirty:
+            self.save_index()
+        return moved
+
+    async def run(self, interval: float) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await loop.run_in_executor(None, self.maintain)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("--- PACK COMPACTION ERROR ---")
+                logger.warning(e)
+                logger.warning("--- PACK COMPACTION ERROR ---")
+
+    def stats(self) -> dict:
+        return {
+            "images": len(self._index),
+            "segments": {segment: round(self.garbage_ratio(segment), 3) for segment in self._live},
+        }
@@ -0,0 +1,44 @@
+import asyncio
+import logging
+
+from fastapi import FastAPI
+
+from app.core.config import PACK_COMPACT_INTERVAL
+from app.redis.containers import container
+from app.storage import media_evictor, storage
+from app.storage.packs import PackStorage
+
+
+logger = logging.getLogger(__name__)
+
+
+async def load_media_storage(app: FastAPI) -> None:
+    try:
+        await storage.load()
+    except Exception as e:
+        logger.warning("--- MEDIA STORAGE LOAD ERROR ---")
+        logger.warning(e)
+        logger.warning("--- MEDIA STORAGE LOAD ERROR ---")
+
+
+async def start_media_eviction(app: FastAPI) -> None:
+    app.state._media_eviction = asyncio.ensure_future(media_evictor.run(container.service))
+
+
+async def stop_media_eviction(app: FastAPI) -> None:
+    task = getattr(app.state, "_media_eviction", None)
+    if task is not None:
+        task.cancel()
+
+
+async def start_pack_compaction(app: FastAPI) -> None:
+    if isinstance(storage, PackStorage):
+        app.state._pack_compaction = asyncio.ensure_future(storage.run(PACK_COMPACT_INTERVAL))
+
+
+async def stop_pack_compaction(app: FastAPI) -> None:
+    task = getattr(app.state, "_pack_compaction", None)
+    if task is not None:
+        task.cancel()
+        # the next start replays the log from where this snapshot stops instead of from the beginning
+        await asyncio.get_event_loop().run_in_executor(None, storage.save_index)
@@ -0,0 +1,142 @@
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import socket
+import sys
+
+from typing import Dict
+
+from databases import Database
+
+from app.api.routes.emoticons import handle_new_emoticon_once
+from app.core.config import DATABASE_URL
+from app.redis.containers import container
+from app.redis.generation import GenerationQueue
+from app.redis.services import Service
+from app.services import emoticon_generator, emoticon_catalog
+from app.services.upstream import UpstreamRejected
+from app.storage import storage
+
+
+logger = logging.getLogger(__name__)
+
+
+class GenerationWorker:
+    def __init__(
+            self,
+            queue: GenerationQueue,
+            service: Service,
+            *,
+            consumer: str,
+            concurrency: int = 16,
+            block_ms: int = 5000
+    ) -> None:
+        self.queue = queue
+        self.service = service
+        self.consumer = consumer
+        self.concurrency = concurrency
+        self.block_ms = block_ms
+        self.generated = 0
+        self.failed = 0
+        self.dead_lettered = 0
+        self._errors: Dict[str, str] = {}
+
+    async def process(self, message_id: str, emoticon_word: str) -> None:
+        try:
+            await handle_new_emoticon_once(emoticon_word, self.service)
+        except UpstreamRejected as e:
+            # the upstream will turn the word down on every delivery, so it goes straight to the dead letters
+            self.failed += 1
+            self.dead_lettered += 1
+            self._errors.pop(message_id, None)
+            await self.queue.dead_letter(message_id, emoticon_word, 1, repr(e))
+            logger.warning("dead-lettered %r: %r", emoticon_word, e)
+            return
+        except Exception as e:
+            # left unacked: it is claimed again once idle and dead-lettered after max_attempts deliveries
+            self.failed += 1
+            self._errors[message_id] = repr(e)
+            logger.warning("failed to generate %r: %r", emoticon_word, e)
+            return
+        self._errors.pop(message_id, None)
+        await self.queue.ack(message_id, emoticon_word)
+        self.generated += 1
+
+    async def run_once(self) -> int:
+        retries, exhausted = await self.queue.claim_stale(self.consumer, self.concurrency)
+        for message_id, attempts in exhausted:
+            emoticon_word = await self.queue.word_for(message_id)
+            await self.queue.dead_letter(message_id, emoticon_word, attempts, self._errors.pop(message_id, ""))
+            self.dead_lettered += 1
+            logger.warning("dead-lettered %r after %s attempts", emoticon_word, attempts)
+
+        jobs = retries
+        if len(jobs) < self.concurrency:
+            jobs += await self.queue.read(self.consumer, self.concurrency - len(jobs), self.block_ms)
+        await asyncio.gather(*(self.process(message_id, emoticon_word) for message_id, emoticon_word in jobs))
+        return len(jobs)
+
+    async def run(self, stopping: asyncio.Event) -> None:
+        await self.queue.ensure_group()
+        while not stopping.is_set():
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("--- GENERATION WORKER ERROR ---")
+                logger.warning(e)
+                logger.warning("--- GENERATION WORKER ERROR ---")
+                await asyncio.sleep(1)
+
+
+async def serve(consumer: str, concurrency: int, block_ms: int) -> None:
+    stopping = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+
+    database = Database(str(DATABASE_URL), min_size=1, max_size=2)
+    await database.connect()
+    catalog_task = asyncio.ensure_future(emoticon_catalog.run(database))
+    await emoticon_generator.start()
+    await storage.load()
+    worker = GenerationWorker(
+        await container.generation_queue(),
+        await container.service(),
+        consumer=consumer,
+        concurrency=concurrency,
+        block_ms=block_ms,
+    )
+    logger.info("generation worker %s started", consumer)
+    try:
+        await worker.run(stopping)
+    finally:
+        catalog_task.cancel()
+        await emoticon_catalog.flush(database)
+        await database.disconnect()
+        await emoticon_generator.close()
+        await container.redis_shards.shutdown()
+        await container.redis_pool.shutdown()
+        logger.info(
+            "generation worker %s stopped: %s generated, %s failed, %s dead-lettered",
+            consumer, worker.generated, worker.failed, worker.dead_lettered
+        )
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Render queued emoticons from the generation stream.")
+    parser.add_argument("--consumer", default=f"{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--block-ms", type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    asyncio.get_event_loop().run_until_complete(serve(args.consumer, args.concurrency, args.block_ms))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+Per-image latency and throughput of the in-process identicon renderer against
+the dnmonster HTTP upstream.
+
+    python -m benchmarks.generators --count 2000
+    python -m benchmarks.generators --upstream-url http://emoticon:8080
+
+Without --upstream-url the HTTP side runs against an in-process stub that
+answers after --stub-latency seconds, which isolates the client overhead.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+os.environ.setdefault("POSTGRES_USER", "bench")
+os.environ.setdefault("POSTGRES_PASSWORD", "bench")
+os.environ.setdefault("POSTGRES_DB", "bench")
+
+from app.services.generators import EmoticonGenerator  # noqa: E402
+from app.services.identicon import IdenticonGenerator  # noqa: E402
+from app.services.upstream import EmoticonUpstream  # noqa: E402
+from benchmarks.miss_memory import serve_stub  # noqa: E402
+
+
+def summarize(name: str, latencies: list, elapsed: float, count: int) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "generator": name,
+        "images": count,
+        "p50_ms": round(statistics.median(latencies) * 1000, 3) if latencies else None,
+        "p99_ms": round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 3) if latencies else None,
+        "images_per_second": round(count / elapsed, 1),
+    }
+
+
+async def sequential(name: str, generator: EmoticonGenerator, words: list) -> dict:
+    latencies = []
+    started = time.perf_counter()
+    for word in words:
+        t = time.perf_counter()
+        await generator.render(word)
+        latencies.append(time.perf_counter() - t)
+    return summarize(f"{name}:sequential", latencies, time.perf_counter() - started, len(words))
+
+
+async def concurrent(name: str, generator: EmoticonGenerator, words: list, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def render(word: str) -> None:
+        async with semaphore:
+            t = time.perf_counter()
+            await generator.render(word)
+            latencies.append(time.perf_counter() - t)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(render(word) for word in words))
+    return summarize(f"{name}:concurrent-{concurrency}", latencies, time.perf_counter() - started, len(words))
+
+
+async def batched(name: str, generator: EmoticonGenerator, words: list, batch_size: int) -> dict:
+    latencies = []
+    started = time.perf_counter()
+    for start in range(0, len(words), batch_size):
+        batch = words[start:start + batch_size]
+        t = time.perf_counter()
+        await generator.render_many(batch)
+        latencies.extend([(time.perf_counter() - t) / len(batch)] * len(batch))
+    return summarize(f"{name}:batch-{batch_size}", latencies, time.perf_counter() - started, len(words))
+
+
+async def run(args: argparse.Namespace) -> list:
+    words = [f"word-{i}" for i in range(args.count)]
+    identicon = IdenticonGenerator()
+    results = [
+        await sequential("identicon", identicon, words),
+        await batched("identicon", identicon, words, args.batch_size),
+    ]
+
+    server = None
+    upstream_url = args.upstream_url
+    if upstream_url is None:
+        server = await serve_stub(
+            args.stub_image_size, args.stub_image_size, 0.0, args.concurrency, latency=args.stub_latency
+        )
+        upstream_url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+    upstream = EmoticonUpstream(upstream_url, max_connections=args.concurrency, max_keepalive=args.concurrency)
+    await upstream.start()
+    upstream_words = words[:args.upstream_count]
+    results.append(await sequential("dnmonster", upstream, upstream_words))
+    results.append(await concurrent("dnmonster", upstream, upstream_words, args.concurrency))
+    await upstream.close()
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=200)
+    parser.add_argument("--upstream-url", default=None)
+    parser.add_argument("--upstream-count", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--stub-latency", type=float, default=0.005)
+    parser.add_argument("--stub-image-size", type=int, default=4096)
+    args = parser.parse_args(argv)
+
+    results = asyncio.get_event_loop().run_until_complete(run(args))
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
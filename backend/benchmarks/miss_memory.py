@@ -0,0 +1,125 @@
+"""
+Peak RSS of a burst of concurrent emoticon misses, buffered vs streamed.
+
+    python -m benchmarks.miss_memory --concurrency 300 --image-size 262144
+
+Every mode runs in its own subprocess because ru_maxrss is a high-water mark
+for the whole process. A stub dnmonster is started in-process and trickles the
+body out in chunks so that all misses are in flight at the same time.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("POSTGRES_USER", "bench")
+os.environ.setdefault("POSTGRES_PASSWORD", "bench")
+os.environ.setdefault("POSTGRES_DB", "bench")
+
+from app.services.upstream import EmoticonUpstream  # noqa: E402
+from app.storage.files import ShardedFileStorage  # noqa: E402
+
+
+async def serve_stub(
+        image_size: int, chunk_size: int, chunk_delay: float, backlog: int, latency: float = 0.0
+) -> asyncio.AbstractServer:
+    body = os.urandom(chunk_size)
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while await reader.readuntil(b"\r\n\r\n"):
+                if latency:
+                    await asyncio.sleep(latency)
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: image/png\r\n"
+                    + f"Content-Length: {image_size}\r\n\r\n".encode()
+                )
+                sent = 0
+                while sent < image_size:
+                    piece = body[:min(chunk_size, image_size - sent)]
+                    writer.write(piece)
+                    sent += len(piece)
+                    await writer.drain()
+                    await asyncio.sleep(chunk_delay)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0, backlog=backlog)
+
+
+def peak_rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+async def run_mode(args: argparse.Namespace) -> dict:
+    server = await serve_stub(args.image_size, args.chunk_size, args.chunk_delay, args.concurrency)
+    port = server.sockets[0].getsockname()[1]
+    upstream = EmoticonUpstream(
+        f"http://127.0.0.1:{port}", max_connections=args.concurrency, connect_timeout=30, read_timeout=30, retries=0
+    )
+    await upstream.start()
+
+    with tempfile.TemporaryDirectory() as media_root:
+        storage = ShardedFileStorage(media_root, "")
+
+        async def buffered(emoticon_word: str) -> None:
+            await storage.write(emoticon_word, await upstream.render(emoticon_word))
+
+        async def streamed(emoticon_word: str) -> None:
+            await storage.write_stream(emoticon_word, upstream.stream(emoticon_word), max_size=args.image_size)
+
+        miss = streamed if args.mode == "streamed" else buffered
+        baseline = peak_rss_kb()
+        started = time.perf_counter()
+        await asyncio.gather(*(miss(f"word-{i}") for i in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    await upstream.close()
+    server.close()
+    await server.wait_closed()
+    return {
+        "mode": args.mode,
+        "concurrency": args.concurrency,
+        "image_size": args.image_size,
+        "seconds": round(elapsed, 3),
+        "baseline_rss_kb": baseline,
+        "peak_rss_kb": peak_rss_kb(),
+        "peak_rss_growth_kb": peak_rss_kb() - baseline,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["buffered", "streamed"])
+    parser.add_argument("--concurrency", type=int, default=300)
+    parser.add_argument("--image-size", type=int, default=256 * 1024)
+    parser.add_argument("--chunk-size", type=int, default=16 * 1024)
+    parser.add_argument("--chunk-delay", type=float, default=0.005)
+    args = parser.parse_args(argv)
+
+    if args.mode:
+        print(json.dumps(asyncio.get_event_loop().run_until_complete(run_mode(args))))
+        return 0
+
+    results = []
+    for mode in ("buffered", "streamed"):
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.miss_memory", "--mode", mode,
+             "--concurrency", str(args.concurrency), "--image-size", str(args.image_size),
+             "--chunk-size", str(args.chunk_size), "--chunk-delay", str(args.chunk_delay)],
+            check=True, stdout=subprocess.PIPE, universal_newlines=True
+        ).stdout
+        results.append(json.loads(output))
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
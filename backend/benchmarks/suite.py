@@ -0,0 +1,323 @@
+"""
+End-to-end latency, throughput and peak memory of the API for the main
+request shapes, without the docker-compose stack.
+
+    python -m benchmarks.suite run --output before.json
+    python -m benchmarks.suite run --scenario cold_miss --stub-latency 0.05
+    python -m benchmarks.suite compare before.json after.json
+
+The app runs in-process behind httpx's ASGI transport. Redis is fakeredis
+(with Lua, so the service scripts run unchanged), the users table lives in
+memory, and dnmonster is the stub from benchmarks.miss_memory answering after
+--stub-latency seconds. Every scenario runs in its own subprocess because
+ru_maxrss is a high-water mark for the whole process.
+
+compare exits with 1 when a p50/p95/p99 got slower, or throughput dropped, by
+more than --max-regression.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from typing import Awaitable, Callable, Dict, List, Optional
+
+os.environ.setdefault("POSTGRES_USER", "bench")
+os.environ.setdefault("POSTGRES_PASSWORD", "bench")
+os.environ.setdefault("POSTGRES_DB", "bench")
+# every scenario is a single user hammering the API, which is exactly what the rate limits are there to stop
+for budget in ("HIT", "MISS", "AUTH"):
+    os.environ.setdefault(f"RATE_LIMIT_{budget}_RATE", "0")
+
+
+LATENCY_METRICS = ["p50_ms", "p95_ms", "p99_ms"]
+
+Request = Callable[[], Awaitable]
+
+
+class MemoryDatabase:
+    # stands in for databases.Database behind UsersRepository, which only ever calls fetch_one
+    def __init__(self) -> None:
+        self.users: Dict[str, dict] = {}
+
+    async def fetch_one(self, query: str, values: dict) -> Optional[dict]:
+        from app.db.repositories.users import GET_USER_BY_USERNAME_QUERY, REGISTER_NEW_USER_QUERY
+
+        if query == GET_USER_BY_USERNAME_QUERY:
+            return self.users.get(values["username"])
+        if query == REGISTER_NEW_USER_QUERY:
+            user = {"id": len(self.users) + 1, "username": values["username"], "password": values["password"]}
+            self.users[values["username"]] = user
+            return user
+        raise NotImplementedError(query)
+
+
+def percentile(latencies: List[float], fraction: float) -> Optional[float]:
+    if not latencies:
+        return None
+    return round(latencies[max(0, math.ceil(fraction * len(latencies)) - 1)] * 1000, 3)
+
+
+async def drive(requests: List[Request], concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def send(request: Request) -> None:
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                response = await request()
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(send(request) for request in requests))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(requests),
+        "errors": errors,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "throughput_rps": round(len(requests) / elapsed, 1),
+        "seconds": round(elapsed, 3),
+    }
+
+
+def get_emoticon(client, emoticon_word: str) -> Request:
+    return lambda: client.get(f"/api/fetch_emoticon/{emoticon_word}", allow_redirects=False)
+
+
+async def warm_hit(client, args: argparse.Namespace) -> dict:
+    emoticon_words = [f"warm-{i}" for i in range(args.words)]
+    await drive([get_emoticon(client, emoticon_word) for emoticon_word in emoticon_words], args.concurrency)
+    cycle = itertools.cycle(emoticon_words)
+    return await drive([get_emoticon(client, next(cycle)) for _ in range(args.requests)], args.concurrency)
+
+
+async def cold_miss(client, args: argparse.Namespace) -> dict:
+    run = uuid.uuid4().hex[:8]
+    return await drive([get_emoticon(client, f"cold-{run}-{i}") for i in range(args.requests)], args.concurrency)
+
+
+async def thundering_herd(client, args: argparse.Namespace) -> dict:
+    # every group of `concurrency` requests asks for the same new word at the same time
+    run = uuid.uuid4().hex[:8]
+    return await drive(
+        [get_emoticon(client, f"herd-{run}-{i // args.concurrency}") for i in range(args.requests)],
+        args.concurrency
+    )
+
+
+async def login_burst(client, args: argparse.Namespace) -> dict:
+    form = {"username": "bench", "password": "benchmark-password"}
+    return await drive(
+        [lambda: client.post("/api/users/login/token/", data=form) for _ in range(args.logins)],
+        args.concurrency
+    )
+
+
+async def batch(client, args: argparse.Namespace) -> dict:
+    # half of every batch was rendered by an earlier batch, the other half is new
+    run = uuid.uuid4().hex[:8]
+    batches = []
+    for i in range(max(1, args.requests // args.batch_size)):
+        emoticon_words = [f"batch-{run}-{i}-{j}" for j in range(args.batch_size // 2)]
+        if i:
+            emoticon_words += [f"batch-{run}-{i - 1}-{j}" for j in range(args.batch_size - len(emoticon_words))]
+        batches.append(emoticon_words)
+
+    def post(emoticon_words: List[str]) -> Request:
+        return lambda: client.post("/api/fetch_emoticon/batch", json={"emoticon_words": emoticon_words})
+
+    result = await drive([post(emoticon_words) for emoticon_words in batches], max(1, args.concurrency // 8))
+    result["batch_size"] = args.batch_size
+    return result
+
+
+SCENARIOS = {
+    "warm_hit": warm_hit,
+    "cold_miss": cold_miss,
+    "thundering_herd": thundering_herd,
+    "login_burst": login_burst,
+    "batch": batch,
+}
+
+
+async def run_scenario(args: argparse.Namespace) -> dict:
+    from dependency_injector import providers
+    from fakeredis.aioredis import create_redis_pool
+    from httpx import AsyncClient
+
+    from app.api.server import get_application
+    from app.redis.containers import container
+    from app.services import emoticon_generator, emoticon_upstream
+    from benchmarks.miss_memory import serve_stub
+
+    server = await serve_stub(
+        args.image_size, args.image_size, 0.0, args.concurrency, latency=args.stub_latency
+    )
+    emoticon_upstream.set_endpoints(f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}")
+    await emoticon_generator.start()
+    redis = await create_redis_pool()
+    container.redis_pool.override(providers.Object(redis))
+
+    app = get_application()
+    app.state._db = MemoryDatabase()
+    async with AsyncClient(app=app, base_url="http://bench") as client:
+        response = await client.post(
+            "/api/users/register_user",
+            json={"new_user": {"username": "bench", "password": "benchmark-password"}}
+        )
+        response.raise_for_status()
+        token = response.json()["access_token"]["access_token"]
+        client.headers["Authorization"] = f"Bearer {token}"
+
+        baseline = peak_rss_kb()
+        result = await SCENARIOS[args.scenario](client, args)
+
+    await emoticon_generator.close()
+    redis.close()
+    await redis.wait_closed()
+    server.close()
+    await server.wait_closed()
+    return {
+        "scenario": args.scenario,
+        **result,
+        "baseline_rss_kb": baseline,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def peak_rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def scenario_argv(args: argparse.Namespace, scenario: str) -> List[str]:
+    return [
+        sys.executable, "-m", "benchmarks.suite", "scenario", scenario,
+        "--requests", str(args.requests), "--concurrency", str(args.concurrency), "--words", str(args.words),
+        "--logins", str(args.logins), "--batch-size", str(args.batch_size),
+        "--stub-latency", str(args.stub_latency), "--image-size", str(args.image_size),
+    ]
+
+
+def run(args: argparse.Namespace) -> int:
+    results = {}
+    for scenario in args.scenario or SCENARIOS:
+        with tempfile.TemporaryDirectory() as media_root:
+            output = subprocess.run(
+                scenario_argv(args, scenario),
+                check=True, stdout=subprocess.PIPE, universal_newlines=True,
+                env={**os.environ, "MEDIA_ROOT": media_root}
+            ).stdout
+        results[scenario] = json.loads(output)
+        print(f"{scenario}: {json.dumps(results[scenario])}", file=sys.stderr)
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "params": {
+            "requests": args.requests, "concurrency": args.concurrency, "words": args.words,
+            "logins": args.logins, "batch_size": args.batch_size,
+            "stub_latency": args.stub_latency, "image_size": args.image_size,
+        },
+        "scenarios": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    return 0
+
+
+def change(before: Optional[float], after: Optional[float]) -> Optional[float]:
+    if not before or after is None:
+        return None
+    return (after - before) / before
+
+
+def compare(args: argparse.Namespace) -> int:
+    with open(args.before) as f:
+        before = json.load(f)["scenarios"]
+    with open(args.after) as f:
+        after = json.load(f)["scenarios"]
+
+    regressions = []
+    for scenario in [scenario for scenario in before if scenario in after]:
+        for metric in LATENCY_METRICS + ["throughput_rps", "peak_rss_kb"]:
+            delta = change(before[scenario].get(metric), after[scenario].get(metric))
+            if delta is None:
+                continue
+            print(f"{scenario:16} {metric:15} {before[scenario][metric]:>12} -> {after[scenario][metric]:>12} "
+                  f"{delta:+8.1%}")
+            worse = -delta if metric == "throughput_rps" else delta
+            if metric != "peak_rss_kb" and worse > args.max_regression:
+                regressions.append(f"{scenario} {metric}")
+
+    if regressions:
+        print(f"regressed by more than {args.max_regression:.0%}: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+def add_load_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--words", type=int, default=500, help="distinct words in the warm_hit working set")
+    parser.add_argument("--logins", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--stub-latency", type=float, default=0.02)
+    parser.add_argument("--image-size", type=int, default=8192)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command")
+
+    run_parser = commands.add_parser("run", help="run scenarios, each in its own process")
+    run_parser.add_argument("--scenario", action="append", choices=list(SCENARIOS))
+    run_parser.add_argument("--output", default=None)
+    add_load_arguments(run_parser)
+
+    scenario_parser = commands.add_parser("scenario", help="run one scenario in this process")
+    scenario_parser.add_argument("scenario", choices=list(SCENARIOS))
+    add_load_arguments(scenario_parser)
+
+    compare_parser = commands.add_parser("compare", help="compare two reports written by run")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--max-regression", type=float, default=0.10)
+
+    args = parser.parse_args(argv)
+    if args.command == "scenario":
+        print(json.dumps(asyncio.get_event_loop().run_until_complete(run_scenario(args))))
+        return 0
+    if args.command == "compare":
+        return compare(args)
+    if args.command == "run":
+        return run(args)
+    parser.print_help()
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,14 +3,19 @@ import os
 import pytest
 import alembic
 
-from asgi_lifespan import LifespanManager
-from fastapi import FastAPI
-from httpx import AsyncClient
-from databases import Database
-from alembic.config import Config
+# every test logs in from the same address, the per-IP auth limit is exercised explicitly instead
+os.environ.setdefault("RATE_LIMIT_AUTH_RATE", "0")
 
-from app.models.user import UserCreate, UserInDB
-from app.db.repositories.users import UsersRepository
+from asgi_lifespan import LifespanManager  # noqa: E402
+from fastapi import FastAPI  # noqa: E402
+from httpx import AsyncClient  # noqa: E402
+from databases import Database  # noqa: E402
+from alembic.config import Config  # noqa: E402
+
+from app.models.user import UserCreate, UserInDB  # noqa: E402
+from app.db.repositories.users import UsersRepository  # noqa: E402
+from app.services import auth_service  # noqa: E402
+from app.core.config import SECRET_KEY, JWT_TOKEN_PREFIX  # noqa: E402
 
 
 @pytest.fixture(scope="session")
@@ -58,3 +63,13 @@ async def test_user(db: Database) -> UserInDB:
     if existing_user:
         return existing_user
     return await user_repo.register_new_user(new_user=new_user)
+
+
+@pytest.fixture
+def authorized_client(client: AsyncClient, test_user: UserInDB) -> AsyncClient:
+    access_token = auth_service.create_access_token_for_user(user=test_user, secret_key=str(SECRET_KEY))
+    client.headers = {
+        **client.headers,
+        "Authorization": f"{JWT_TOKEN_PREFIX} {access_token}",
+    }
+    return client
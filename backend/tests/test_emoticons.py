@@ -1,9 +1,11 @@
+import uuid
+import asyncio
 import pytest
 
 from httpx import AsyncClient
 from fastapi import FastAPI
 
-from starlette.status import HTTP_404_NOT_FOUND
+from starlette.status import HTTP_200_OK, HTTP_202_ACCEPTED, HTTP_304_NOT_MODIFIED, HTTP_404_NOT_FOUND
 
 
 class TestEmoticonRoutes:
@@ -12,3 +14,1202 @@ class TestEmoticonRoutes:
         response = await client.get("/api/fetch_emoticon/hmmm")
         assert response.status_code != HTTP_404_NOT_FOUND
 
+
+class FakeService:
+    def __init__(self) -> None:
+        self.words = {}
+        self.leases = {}
+
+    async def save_emoticon_word(self, emoticon_word, size: int = 0) -> bool:
+        self.words[emoticon_word] = "saved"
+        return True
+
+    def touch_emoticon_word(self, emoticon_word) -> None:
+        pass
+
+    async def get_emoticon_word(self, emoticon_word) -> str:
+        return self.words.get(emoticon_word)
+
+    async def get_emoticon_words(self, emoticon_words):
+        return {emoticon_word: self.words.get(emoticon_word) for emoticon_word in emoticon_words}
+
+    async def acquire_lease(self, emoticon_word: str, token: str, ttl: int) -> bool:
+        return self.leases.setdefault(emoticon_word, token) == token
+
+    async def lease_exists(self, emoticon_word: str) -> bool:
+        return emoticon_word in self.leases
+
+    async def release_lease(self, emoticon_word: str, token: str) -> bool:
+        return self.leases.pop(emoticon_word, None) == token
+
+
+class TestEmoticonCoalescing:
+    @pytest.mark.asyncio
+    async def test_concurrent_misses_generate_once(self, monkeypatch) -> None:
+        from app.api.routes import emoticons
+
+        calls = []
+
+        async def fake_handle_new_emoticon(emoticon_word, service):
+            calls.append(emoticon_word)
+            await asyncio.sleep(0.01)
+            await service.save_emoticon_word(emoticon_word)
+
+        monkeypatch.setattr(emoticons, "handle_new_emoticon", fake_handle_new_emoticon)
+        service = FakeService()
+        await asyncio.gather(*(emoticons.handle_new_emoticon_once("viral", service) for _ in range(50)))
+        assert calls == ["viral"]
+        assert await service.get_emoticon_word("viral") == "saved"
+
+    @pytest.mark.asyncio
+    async def test_followers_take_over_when_the_holder_fails(self, monkeypatch) -> None:
+        from app.api.routes import emoticons
+
+        calls = []
+
+        async def fake_handle_new_emoticon(emoticon_word, service):
+            calls.append(emoticon_word)
+            await service.save_emoticon_word(emoticon_word)
+
+        monkeypatch.setattr(emoticons, "handle_new_emoticon", fake_handle_new_emoticon)
+        monkeypatch.setattr(emoticons, "EMOTICON_LEASE_POLL_INTERVAL", 0.01)
+        service = FakeService()
+        # another worker holds the lease and gives up without a marker, as it would with the upstream down
+        await service.acquire_lease("unlucky", "other-worker", 30)
+        asyncio.get_event_loop().call_later(0.05, service.leases.pop, "unlucky")
+
+        started = asyncio.get_event_loop().time()
+        await asyncio.gather(*(emoticons.handle_new_emoticon_with_lease("unlucky", service) for _ in range(5)))
+        assert asyncio.get_event_loop().time() - started < 1
+        assert calls == ["unlucky"]
+        assert await service.get_emoticon_word("unlucky") == "saved"
+
+
+class TestUpstreamCircuitBreaker:
+    def test_breaker_opens_after_threshold_and_probes_after_reset(self) -> None:
+        from app.services.upstream import CircuitBreaker
+
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+        breaker.record_failure()
+        assert breaker.state == CircuitBreaker.OPEN
+
+        assert breaker.allow_request()
+        assert not breaker.allow_request()
+        breaker.record_success()
+        assert breaker.state == CircuitBreaker.CLOSED
+
+    @pytest.mark.asyncio
+    async def test_abandoned_probe_is_released(self, tmpdir) -> None:
+        from app.services.upstream import CircuitBreaker, EmoticonUpstream
+        from app.storage.files import ObjectTooLarge, ShardedFileStorage
+        from benchmarks.miss_memory import serve_stub
+
+        server = await serve_stub(4096, 1024, 0.05, 8)
+        upstream = EmoticonUpstream(f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}", health_interval=0)
+        breaker = upstream.endpoints[0].breaker
+        breaker.failure_threshold, breaker.reset_timeout = 1, 0
+        storage = ShardedFileStorage(str(tmpdir), "")
+        try:
+            for _ in range(2):
+                breaker.record_failure()
+                assert breaker.state == CircuitBreaker.OPEN
+                failures = breaker.failures
+                # the half-open probe answers with a body over the limit and the writer hangs up on it
+                with pytest.raises(ObjectTooLarge):
+                    await storage.write_stream("probe", upstream.stream("probe"), max_size=1024)
+                assert breaker.state == CircuitBreaker.HALF_OPEN
+                assert breaker.failures == failures
+                assert breaker.ready()
+
+            breaker.record_failure()
+            writing = asyncio.ensure_future(storage.write_stream("probe", upstream.stream("probe"), max_size=8192))
+            while not upstream.endpoints[0].outstanding:
+                await asyncio.sleep(0.01)
+            writing.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await writing
+            assert breaker.failures == 3
+            assert breaker.ready()
+            assert len(await upstream.render("probe")) == 4096
+            assert breaker.state == CircuitBreaker.CLOSED
+        finally:
+            await upstream.close()
+            server.close()
+            await server.wait_closed()
+            # let the stub's connection handlers notice the hang-ups before the loop goes away
+            await asyncio.sleep(0.1)
+
+    @pytest.mark.asyncio
+    async def test_client_errors_are_passed_through_without_retries(self) -> None:
+        import httpx
+        from app.services.upstream import CircuitBreaker, EmoticonUpstream, UpstreamRejected, UpstreamUnavailable
+
+        requests = []
+
+        async def dnmonster(scope, receive, send):
+            emoticon_word = scope["path"].rsplit("/", 1)[1]
+            requests.append(emoticon_word)
+            status_code = {"rejected": 400, "down": 503}.get(emoticon_word, 200)
+            await send({"type": "http.response.start", "status": status_code, "headers": []})
+            await send({"type": "http.response.body", "body": b"\x89PNG"})
+
+        upstream = EmoticonUpstream("http://dnmonster", retries=2, retry_backoff=0, health_interval=0)
+        upstream._client = httpx.AsyncClient(app=dnmonster)
+        breaker = upstream.endpoints[0].breaker
+        breaker.failure_threshold = 10
+        try:
+            with pytest.raises(UpstreamRejected) as rejected:
+                await upstream.render("rejected")
+            assert rejected.value.status_code == 400
+            with pytest.raises(UpstreamRejected):
+                async for _ in upstream.stream("rejected"):
+                    pass
+            assert requests == ["rejected", "rejected"]
+            assert (breaker.state, breaker.failures) == (CircuitBreaker.CLOSED, 0)
+
+            with pytest.raises(UpstreamUnavailable):
+                await upstream.render("down")
+            assert requests.count("down") == 3 and breaker.failures == 3
+            assert await upstream.render("fine") == b"\x89PNG"
+        finally:
+            await upstream.close()
+
+
+class TestUpstreamLoadBalancing:
+    def test_less_loaded_endpoint_is_chosen(self) -> None:
+        from app.services.upstream import EmoticonUpstream
+
+        upstream = EmoticonUpstream(["http://busy:8080", "http://idle:8080"], health_interval=0)
+        busy, idle = upstream.endpoints
+        busy.outstanding = 5
+        assert upstream.choose_endpoint(set()) is idle
+        assert upstream.choose_endpoint({idle}) is busy
+
+    @pytest.mark.asyncio
+    async def test_no_endpoints_is_unavailable_not_a_crash(self) -> None:
+        from app.services.upstream import EmoticonUpstream, UpstreamUnavailable
+
+        upstream = EmoticonUpstream("", health_interval=0)
+        try:
+            assert upstream.retry_after() == 1
+            with pytest.raises(UpstreamUnavailable):
+                await upstream.render("nowhere")
+        finally:
+            await upstream.close()
+
+    @pytest.mark.asyncio
+    async def test_failing_endpoint_is_ejected_until_it_recovers(self) -> None:
+        import httpx
+        from app.services.upstream import CircuitBreaker, EmoticonUpstream
+
+        down = {"flaky"}
+
+        async def dnmonster(scope, receive, send):
+            host = dict(scope["headers"])[b"host"].decode()
+            status_code = 503 if host in down else 200
+            await send({"type": "http.response.start", "status": status_code, "headers": []})
+            await send({"type": "http.response.body", "body": host.encode()})
+
+        upstream = EmoticonUpstream(
+            "http://flaky,http://healthy", retries=0, health_interval=0, health_timeout=0.5, health_failures=2
+        )
+        upstream._client = httpx.AsyncClient(app=dnmonster)
+        try:
+            flaky, healthy = upstream.endpoints
+            assert not await upstream.check_endpoint(flaky)
+            assert flaky.healthy
+            assert not await upstream.check_endpoint(flaky)
+            assert not flaky.healthy
+            healthy.outstanding = 10
+            assert all(upstream.choose_endpoint(set()) is healthy for _ in range(10))
+
+            # passing a health check again puts it straight back in rotation
+            down.clear()
+            assert await upstream.check_endpoint(flaky)
+            assert upstream.choose_endpoint(set()) is flaky
+
+            # an open breaker keeps it out until the reset timeout, then one probe closes it again
+            flaky.breaker.failure_threshold, flaky.breaker.reset_timeout = 1, 0.05
+            flaky.breaker.record_failure()
+            assert flaky.breaker.state == CircuitBreaker.OPEN
+            assert upstream.choose_endpoint(set()) is healthy
+            await asyncio.sleep(0.05)
+            assert await upstream.render("probe") == b"flaky"
+            assert flaky.breaker.state == CircuitBreaker.CLOSED
+            assert upstream.choose_endpoint(set()) is flaky
+        finally:
+            await upstream.close()
+
+
+class TestLocalCache:
+    def test_lru_evicts_least_recently_used(self) -> None:
+        from app.redis.services import LocalCache
+
+        cache = LocalCache(max_size=2, ttl=60)
+        cache.set("a", "saved")
+        cache.set("b", "saved")
+        assert cache.get("a") == "saved"
+        cache.set("c", "saved")
+        assert cache.get("b") is None
+        assert cache.get("a") == "saved"
+        assert cache.stats()["evictions"] == 1
+
+    def test_expired_entries_are_misses(self) -> None:
+        from app.redis.services import LocalCache
+
+        cache = LocalCache(max_size=2, ttl=0)
+        cache.set("a", "saved")
+        assert cache.get("a") is None
+        assert cache.stats()["expirations"] == 1
+
+
+class TestEmoticonBatchRoutes:
+    @pytest.mark.asyncio
+    async def test_batch_is_looked_up_once_and_generated_with_a_cap(
+            self, app: FastAPI, authorized_client: AsyncClient, monkeypatch, tmpdir
+    ) -> None:
+        from app.api.routes import emoticons
+        from app.redis.containers import container
+        from app.redis.services import Service
+        from app.storage.files import ShardedFileStorage
+
+        lookups = []
+        in_flight = []
+        peak = []
+        get_emoticon_words = Service.get_emoticon_words
+
+        async def counting_get_emoticon_words(self, emoticon_words):
+            lookups.append(list(emoticon_words))
+            return await get_emoticon_words(self, emoticon_words)
+
+        async def fake_fetch_emoticon(emoticon_word):
+            in_flight.append(emoticon_word)
+            peak.append(len(in_flight))
+            try:
+                await asyncio.sleep(0.01)
+                if emoticon_word.endswith("broken"):
+                    raise RuntimeError("render failed")
+                yield emoticon_word.encode()
+            finally:
+                in_flight.remove(emoticon_word)
+
+        storage = ShardedFileStorage(str(tmpdir), "http://testserver/media")
+        monkeypatch.setattr(Service, "get_emoticon_words", counting_get_emoticon_words)
+        monkeypatch.setattr(emoticons, "storage", storage)
+        monkeypatch.setattr(emoticons, "fetch_emoticon", fake_fetch_emoticon)
+        monkeypatch.setattr(emoticons, "EMOTICON_BATCH_CONCURRENCY", 2)
+        monkeypatch.setattr(emoticons, "EMOTICON_BATCH_MAX_WORDS", 6)
+        redis = await container.redis_pool()
+        await redis.delete("ratelimit:hit:username7", "ratelimit:miss:username7")
+        try:
+            run = uuid.uuid4().hex
+            saved = f"batch-{run}-saved"
+            await (await container.service()).save_emoticon_word(saved)
+            emoticon_words = [saved] + [f"batch-{run}-{i}" for i in range(4)] + [f"batch-{run}-broken"]
+            lookups.clear()
+
+            response = await authorized_client.post(
+                app.url_path_for("emoticons:fetch-emoticons-batch"),
+                json={"emoticon_words": emoticon_words + emoticon_words[:3]}
+            )
+            assert response.status_code == HTTP_200_OK
+            assert lookups == [emoticon_words]
+            assert max(peak) == 2 and len(peak) == 5
+            assert response.json() == {
+                emoticon_word: None if emoticon_word.endswith("broken") else storage.url(emoticon_word)
+                for emoticon_word in emoticon_words
+            }
+
+            response = await authorized_client.post(
+                app.url_path_for("emoticons:fetch-emoticons-batch"),
+                json={"emoticon_words": [f"batch-{run}-extra-{i}" for i in range(7)]}
+            )
+            assert response.status_code == 422
+        finally:
+            await redis.delete("ratelimit:hit:username7", "ratelimit:miss:username7")
+
+
+class TestRedisBatcher:
+    @pytest.mark.asyncio
+    async def test_lookups_and_writes_in_one_tick_share_a_round_trip(self) -> None:
+        from app.redis.services import RedisBatcher
+        from app.redis.sharding import RedisShards
+
+        executed = []
+
+        class FakePipeline:
+            def __init__(self) -> None:
+                self.commands = []
+
+            def eval(self, script, keys, args):
+                self.commands.append(("eval", keys[0]))
+
+            def mget(self, *keys, encoding=None):
+                self.commands.append(("mget", keys))
+
+            async def execute(self, return_exceptions=False):
+                executed.append(self.commands)
+                return [1 for command in self.commands if command[0] == "eval"] + [
+                    [None if key == "missing" else f"marker-{key}" for key in self.commands[-1][1]]
+                ]
+
+        class FakeRedis:
+            def pipeline(self):
+                return FakePipeline()
+
+        batcher = RedisBatcher(RedisShards([FakeRedis()]), window=0.0, max_size=100)
+        keys = [f"word-{i % 10}" for i in range(30)] + ["missing"]
+        results = await asyncio.gather(
+            batcher.save_marker(["word-0"], []), *(batcher.get(key) for key in keys)
+        )
+        assert results[1:] == [f"marker-{key}" for key in keys[:-1]] + [None]
+        assert len(executed) == 1
+        assert executed[0][0] == ("eval", "word-0")
+        assert sorted(executed[0][1][1]) == sorted(set(keys))
+
+        await asyncio.gather(*(batcher.get(f"other-{i}") for i in range(250)))
+        assert len(executed) == 4
+
+
+class TestMarkerKeys:
+    @pytest.mark.asyncio
+    async def test_words_cannot_clobber_other_keys(self) -> None:
+        from aioredis import create_redis_pool
+
+        from app.redis.containers import container
+        from app.redis.limits import RateLimiter
+        from app.redis.services import Service
+
+        redis = await create_redis_pool(
+            f"redis://{container.config.redis_host()}/13", password=container.config.redis_password()
+        )
+        try:
+            await redis.flushdb()
+            service = Service(redis)
+            rate_limiter = RateLimiter(redis)
+            assert await rate_limiter.take("hit:alice", rate=10, burst=10) == (1, 0)
+            for emoticon_word in ("emoticons:access", "emoticons:bytes", "ratelimit:hit:alice", "lease:bob"):
+                await service.save_emoticon_word(emoticon_word, size=5)
+            await service.save_emoticon_word("plain", size=5)
+            assert await service.get_media_usage() == (25, 5)
+            assert await service.get_emoticon_word("lease:bob") == "saved"
+            assert await service.acquire_lease("bob", "token", 30)
+            assert await service.lease_exists("bob") and not await service.lease_exists("lease:bob")
+            assert await rate_limiter.take("hit:alice", rate=10, burst=10) == (1, 0)
+        finally:
+            await redis.flushdb()
+            redis.close()
+            await redis.wait_closed()
+
+    @pytest.mark.asyncio
+    async def test_bare_markers_from_older_versions_are_migrated(self, tmpdir) -> None:
+        from aioredis import create_redis_pool
+
+        from app.redis.containers import container
+        from app.redis.services import ACCESS_KEY, SIZES_KEY, Service, marker_key
+        from app.storage.files import ShardedFileStorage
+
+        redis = await create_redis_pool(
+            f"redis://{container.config.redis_host()}/13", password=container.config.redis_password()
+        )
+        storage = ShardedFileStorage(str(tmpdir), "")
+        try:
+            await redis.flushdb()
+            # what the baseline left behind: `SET word "saved"` and the file, no access zset or sizes
+            for emoticon_word in ("smile", "wink", "orphan"):
+                await redis.set(emoticon_word, "saved")
+            await storage.write("smile", b"12345")
+            await storage.write("wink", b"123")
+            await redis.set("queued:frown", 1)
+            await redis.set("lease:smile", "saved")
+            await redis.set("note", "something else")
+            await redis.hset("principal:user:bob", "key", "value")
+            service = Service(redis)
+
+            assert await service.migrate_legacy_markers(storage.stat, chunk_size=2) == 2
+            assert await service.get_emoticon_words(["smile", "wink", "orphan"]) == {
+                "smile": "saved", "wink": "saved", "orphan": None
+            }
+            assert await service.get_media_usage() == (8, 2)
+            assert await redis.zrange(ACCESS_KEY, encoding="utf-8") in (["smile", "wink"], ["wink", "smile"])
+            assert await redis.hget(SIZES_KEY, "smile", encoding="utf-8") == "5"
+            assert not await redis.exists("smile", "wink", "orphan")
+            assert await redis.get("lease:smile", encoding="utf-8") == "saved"
+            assert await redis.get("note", encoding="utf-8") == "something else"
+            assert await redis.exists("queued:frown", "principal:user:bob", marker_key("smile")) == 3
+            assert await service.migrate_legacy_markers(storage.stat) == 0
+        finally:
+            await redis.flushdb()
+            redis.close()
+            await redis.wait_closed()
+
+
+class TestRedisSharding:
+    def test_adding_a_node_only_moves_keys_to_it(self) -> None:
+        from app.redis.sharding import HashRing
+
+        keys = [f"word-{i}" for i in range(20000)]
+        before = HashRing(["redis-1", "redis-2", "redis-3"])
+        after = HashRing(["redis-1", "redis-2", "redis-3", "redis-4"])
+        owners = [before.node(key) for key in keys]
+        moved = [key for key, owner in zip(keys, owners) if after.node(key) != owner]
+        assert all(after.node(key) == 3 for key in moved)
+        assert 0.15 < len(moved) / len(keys) < 0.35
+        assert all(0.25 < owners.count(index) / len(keys) < 0.42 for index in range(3))
+
+    @pytest.mark.asyncio
+    async def test_markers_are_routed_and_batched_per_shard(self) -> None:
+        from aioredis import create_redis_pool
+
+        from app.redis.containers import container
+        from app.redis.services import RedisBatcher, Service, marker_key
+        from app.redis.sharding import RedisShards
+
+        host, password = container.config.redis_host(), container.config.redis_password()
+        nodes = [await create_redis_pool(f"redis://{host}/{db}", password=password) for db in (14, 15)]
+        try:
+            for node in nodes:
+                await node.flushdb()
+            shards = RedisShards(nodes, ["shard-a", "shard-b"])
+            service = Service(nodes[0], batcher=RedisBatcher(shards), shards=shards)
+            emoticon_words = [f"sharded-{i}" for i in range(40)]
+            await asyncio.gather(*(service.save_emoticon_word(word, size=10) for word in emoticon_words))
+
+            for word in emoticon_words:
+                index = shards.index(marker_key(word))
+                assert await nodes[index].get(marker_key(word)) is not None
+                assert await nodes[1 - index].get(marker_key(word)) is None
+            assert {shards.index(marker_key(word)) for word in emoticon_words} == {0, 1}
+            assert set(await asyncio.gather(*(service.get_emoticon_word(word) for word in emoticon_words))) == {"saved"}
+            from_other_node = await Service(nodes[0], shards=shards).get_emoticon_words(emoticon_words)
+            assert set(from_other_node.values()) == {"saved"}
+            assert await service.get_media_usage() == (400, 40)
+
+            evicted = await service.evict_coldest_emoticon_words(4, "token", 30)
+            assert len(evicted) == 4
+            assert await service.get_media_usage() == (360, 36)
+        finally:
+            for node in nodes:
+                await node.flushdb()
+                node.close()
+                await node.wait_closed()
+
+
+class TestShardedFileStorage:
+    @pytest.mark.asyncio
+    async def test_images_are_written_to_sharded_paths(self, tmpdir) -> None:
+        from app.storage.files import ShardedFileStorage
+
+        storage = ShardedFileStorage(str(tmpdir), "http://127.0.0.1/emoticon_files/")
+        await storage.write("Kek", b"png")
+        key = storage.key("Kek")
+        assert storage.relative_path("Kek") == f"{key[:2]}/{key[2:4]}/{key}.png"
+        assert storage.url("Kek") == f"http://127.0.0.1/emoticon_files/{key[:2]}/{key[2:4]}/{key}.png"
+        assert storage.path("Kek") != storage.path("kek")
+        with open(storage.path("Kek"), "rb") as f:
+            assert f.read() == b"png"
+        assert tmpdir.join(key[:2], key[2:4]).listdir() == [tmpdir.join(key[:2], key[2:4], f"{key}.png")]
+
+    @pytest.mark.asyncio
+    async def test_streamed_writes_respect_max_size(self, tmpdir) -> None:
+        from app.storage.files import ShardedFileStorage, ObjectTooLarge
+
+        async def chunks():
+            for _ in range(4):
+                yield b"x" * 10
+
+        storage = ShardedFileStorage(str(tmpdir), "")
+        assert (await storage.write_stream("small", chunks(), max_size=40)).size == 40
+        with pytest.raises(ObjectTooLarge):
+            await storage.write_stream("large", chunks(), max_size=39)
+        assert not storage.exists("large")
+        key = storage.key("large")
+        assert tmpdir.join(key[:2], key[2:4]).listdir() == []
+
+    def test_flat_media_is_migrated(self, tmpdir) -> None:
+        from app.storage.files import ShardedFileStorage
+        from app.storage.migrate import migrate_flat_media
+
+        tmpdir.join("kek.png").write_binary(b"png")
+        storage = ShardedFileStorage(str(tmpdir), "")
+        assert migrate_flat_media(storage) == 1
+        assert not tmpdir.join("kek.png").exists()
+        assert storage.exists("kek")
+
+
+class TestPackStorage:
+    @pytest.mark.asyncio
+    async def test_images_are_read_back_from_mmap_slices(self, tmpdir) -> None:
+        from app.storage.packs import PackStorage
+
+        storage = PackStorage(
+            str(tmpdir), "http://127.0.0.1/api/fetch_emoticon/", segment_bytes=64, compact_garbage_ratio=0.5
+        )
+        for i in range(10):
+            await storage.write(f"word-{i}", f"png-{i}".encode() * 4)
+        assert await storage.delete("word-3")
+        assert not await storage.delete("word-3")
+
+        image = await storage.read("word-7")
+        assert isinstance(image, memoryview) and image == b"png-7" * 4
+        assert await storage.read("word-3") is None
+        assert storage.url("a b") == "http://127.0.0.1/api/fetch_emoticon/a%20b"
+        assert len(storage.segments()) > 1
+
+        # a second process appending to the same directory is picked up from the log
+        other = PackStorage(str(tmpdir), "", segment_bytes=64, compact_garbage_ratio=0.5)
+        assert await other.read("word-7") == b"png-7" * 4
+        await other.write("from-other", b"other")
+        assert await storage.read("from-other") == b"other"
+
+    @pytest.mark.asyncio
+    async def test_compaction_reclaims_deleted_images(self, tmpdir) -> None:
+        from app.storage.packs import PackStorage
+
+        storage = PackStorage(str(tmpdir), "", segment_bytes=256, compact_garbage_ratio=0.5)
+        for i in range(40):
+            await storage.write(f"word-{i}", b"x" * 40)
+        for i in range(40):
+            if i % 4:
+                await storage.delete(f"word-{i}")
+        size_before = sum(f.size() for f in tmpdir.listdir(lambda f: f.ext == ".pack"))
+
+        assert storage.maintain() > 0
+        size_after = sum(f.size() for f in tmpdir.listdir(lambda f: f.ext == ".pack"))
+        assert size_after < size_before / 2
+        for i in range(40):
+            image = await storage.read(f"word-{i}")
+            assert (image is not None) == (i % 4 == 0)
+
+        reopened = PackStorage(str(tmpdir), "", segment_bytes=256, compact_garbage_ratio=0.5)
+        for i in range(40):
+            image = await reopened.read(f"word-{i}")
+            assert (image == b"x" * 40) if i % 4 == 0 else image is None
+
+    @pytest.mark.asyncio
+    async def test_loaded_storage_answers_stat_without_replaying(self, tmpdir, monkeypatch) -> None:
+        from app.storage.packs import PackStorage
+
+        await PackStorage(str(tmpdir), "", segment_bytes=256, compact_garbage_ratio=0.5).write("word", b"x" * 40)
+        storage = PackStorage(str(tmpdir), "", segment_bytes=256, compact_garbage_ratio=0.5)
+        await storage.load()
+
+        def blocking_refresh():
+            raise AssertionError("replayed the log on the event loop")
+
+        monkeypatch.setattr(storage, "refresh", blocking_refresh)
+        assert storage.exists("word")
+        assert storage.stat("word").st_size == 40
+
+
+class TestMediaEvictor:
+    def test_budget_checks(self) -> None:
+        from app.storage.eviction import MediaEvictor
+
+        assert not MediaEvictor(None, max_bytes=0, max_files=0).enabled
+        evictor = MediaEvictor(None, max_bytes=100, max_files=10)
+        assert evictor.enabled
+        assert not evictor.over_budget(100, 10)
+        assert evictor.over_budget(101, 1)
+        assert evictor.over_budget(1, 11)
+
+    @pytest.mark.asyncio
+    async def test_eviction_lock_is_not_a_word_lease(self, tmpdir) -> None:
+        from aioredis import create_redis_pool
+
+        from app.redis.containers import container
+        from app.redis.services import Service
+        from app.storage.eviction import EVICTION_LEASE, MediaEvictor
+        from app.storage.files import ShardedFileStorage
+
+        redis = await create_redis_pool(
+            f"redis://{container.config.redis_host()}/13", password=container.config.redis_password()
+        )
+        storage = ShardedFileStorage(str(tmpdir), "")
+        try:
+            await redis.flushdb()
+            service = Service(redis)
+            for emoticon_word in (EVICTION_LEASE, "cold", "warm"):
+                await storage.write(emoticon_word, b"12345")
+                await service.save_emoticon_word(emoticon_word, size=5)
+            # a request rendering the word "eviction" must not stop eviction, nor eviction lock the word out
+            assert await service.acquire_lease(EVICTION_LEASE, "renderer", 30)
+            evictor = MediaEvictor(storage, max_files=1, interval=30)
+            assert await evictor.evict_once(service) == 1
+            assert await service.get_media_usage() == (10, 2)
+            assert await service.acquire_named_lease(EVICTION_LEASE, "other-worker", 30)
+            assert await evictor.evict_once(service) == 0
+            assert await service.release_named_lease(EVICTION_LEASE, "other-worker")
+            assert await service.release_lease(EVICTION_LEASE, "renderer")
+        finally:
+            await redis.flushdb()
+            redis.close()
+            await redis.wait_closed()
+
+
+class TestEmoticonDirectServing:
+    @pytest.mark.asyncio
+    async def test_direct_mode_serves_bytes_with_etag_and_304(
+            self, app: FastAPI, authorized_client: AsyncClient, monkeypatch, tmpdir
+    ) -> None:
+        from app.api.routes import emoticons
+        from app.storage.files import ShardedFileStorage
+
+        async def fake_fetch_emoticon(emoticon_word):
+            yield b"\x89PNG"
+            yield emoticon_word.encode()
+
+        monkeypatch.setattr(emoticons, "EMOTICON_SERVE_MODE", "direct")
+        monkeypatch.setattr(emoticons, "storage", ShardedFileStorage(str(tmpdir), ""))
+        monkeypatch.setattr(emoticons, "fetch_emoticon", fake_fetch_emoticon)
+
+        emoticon_word = f"direct-{uuid.uuid4().hex}"
+        response = await authorized_client.get(f"/api/fetch_emoticon/{emoticon_word}")
+        assert response.status_code == HTTP_200_OK
+        assert response.content == b"\x89PNG" + emoticon_word.encode()
+        assert "immutable" in response.headers["cache-control"]
+        etag = response.headers["etag"]
+
+        response = await authorized_client.get(f"/api/fetch_emoticon/{emoticon_word}", headers={"If-None-Match": etag})
+        assert response.status_code == HTTP_304_NOT_MODIFIED
+        assert response.headers["etag"] == etag
+
+    @pytest.mark.asyncio
+    async def test_file_without_a_marker_is_served_with_its_own_etag(self, monkeypatch, tmpdir) -> None:
+        from app.api.routes import emoticons
+        from app.storage.files import ShardedFileStorage
+
+        storage = ShardedFileStorage(str(tmpdir), "")
+        monkeypatch.setattr(emoticons, "EMOTICON_SERVE_MODE", "direct")
+        monkeypatch.setattr(emoticons, "storage", storage)
+        stored = await storage.write("evicted", b"\x89PNG")
+        service = FakeService()
+
+        response = await emoticons.serve_emoticon("evicted", None, None, service)
+        assert response.headers["etag"] == f'"{stored.etag}"'
+        response = await emoticons.serve_emoticon("evicted", None, f'"{stored.etag}"', service)
+        assert response.status_code == HTTP_304_NOT_MODIFIED
+        assert service.words == {}
+
+    @pytest.mark.asyncio
+    async def test_pack_mode_streams_bytes_from_the_pack(
+            self, app: FastAPI, authorized_client: AsyncClient, monkeypatch, tmpdir
+    ) -> None:
+        from app.api.routes import emoticons
+        from app.storage.packs import PackStorage
+
+        async def fake_fetch_emoticon(emoticon_word):
+            yield b"\x89PNG"
+            yield emoticon_word.encode()
+
+        storage = PackStorage(
+            str(tmpdir), "http://testserver/api/fetch_emoticon", segment_bytes=1024, compact_garbage_ratio=0.5
+        )
+        monkeypatch.setattr(emoticons, "MEDIA_STORAGE", "pack")
+        monkeypatch.setattr(emoticons, "storage", storage)
+        monkeypatch.setattr(emoticons, "fetch_emoticon", fake_fetch_emoticon)
+
+        emoticon_word = f"packed-{uuid.uuid4().hex}"
+        for _ in range(2):
+            response = await authorized_client.get(f"/api/fetch_emoticon/{emoticon_word}")
+            assert response.status_code == HTTP_200_OK
+            assert response.content == b"\x89PNG" + emoticon_word.encode()
+            assert response.headers["content-length"] == str(len(response.content))
+        assert await storage.read(emoticon_word) == response.content
+
+
+class TestEmoticonVariants:
+    def test_variants_are_resized_and_reencoded(self) -> None:
+        import io
+        from PIL import Image
+        from app.services.identicon import render_identicons
+        from app.services.variants import render_variant
+
+        original = render_identicons(["kek"])[0]
+        webp = render_variant(original, 32, "webp")
+        assert webp[:4] == b"RIFF" and webp[8:12] == b"WEBP"
+        with Image.open(io.BytesIO(webp)) as image:
+            assert image.size == (32, 32)
+        with Image.open(io.BytesIO(render_variant(original, 4096, "png"))) as image:
+            assert image.size == Image.open(io.BytesIO(original)).size
+
+    @pytest.mark.asyncio
+    async def test_variants_are_derived_once_and_capped(
+            self, app: FastAPI, authorized_client: AsyncClient, monkeypatch, tmpdir
+    ) -> None:
+        from app.api.routes import emoticons
+        from app.services.identicon import render_identicons
+        from app.storage.files import ShardedFileStorage, variant_name
+
+        renders = []
+
+        async def fake_fetch_emoticon(emoticon_word):
+            yield render_identicons([emoticon_word])[0]
+
+        async def fake_render(image, size, image_format):
+            renders.append((size, image_format))
+            return f"{size}.{image_format}".encode()
+
+        storage = ShardedFileStorage(str(tmpdir), "")
+        monkeypatch.setattr(emoticons, "EMOTICON_SERVE_MODE", "direct")
+        monkeypatch.setattr(emoticons, "storage", storage)
+        monkeypatch.setattr(emoticons, "fetch_emoticon", fake_fetch_emoticon)
+        monkeypatch.setattr(emoticons.variant_renderer, "render", fake_render)
+
+        emoticon_word = f"variant-{uuid.uuid4().hex}"
+        for _ in range(2):
+            response = await authorized_client.get(
+                f"/api/fetch_emoticon/{emoticon_word}", params={"size": 32, "format": "webp"}
+            )
+            assert response.status_code == HTTP_200_OK
+            assert response.headers["content-type"] == "image/webp"
+            assert response.content == b"32.webp"
+        assert renders == [(32, "webp")]
+        assert storage.exists(emoticon_word)
+        assert storage.path(variant_name(emoticon_word, 32, "webp")).endswith(".webp")
+
+        response = await authorized_client.get(f"/api/fetch_emoticon/{emoticon_word}", params={"size": 33})
+        assert response.status_code == 400
+        response = await authorized_client.get(f"/api/fetch_emoticon/{emoticon_word}", params={"format": "gif"})
+        assert response.status_code == 400
+
+        # the variant's own name can't be requested as a word and overwritten with a plain render
+        response = await authorized_client.get(f"/api/fetch_emoticon/{variant_name(emoticon_word, 32, 'webp')}")
+        assert response.status_code == 400
+        response = await authorized_client.post(
+            app.url_path_for("emoticons:fetch-emoticons-batch"),
+            json={"emoticon_words": [variant_name(emoticon_word, 64, "webp")]}
+        )
+        assert response.status_code == 400
+
+
+class TestSpriteSheets:
+    def test_tiles_are_laid_out_row_by_row(self) -> None:
+        import io
+        import numpy as np
+        from PIL import Image
+        from app.services.variants import render_sprite_sheet
+
+        def solid(colour, side):
+            output = io.BytesIO()
+            Image.new("RGBA", (side, side), colour).save(output, "PNG")
+            return output.getvalue()
+
+        colours = [(255, 0, 0, 255), (0, 255, 0, 255), (0, 0, 255, 255)]
+        sheet = np.asarray(Image.open(io.BytesIO(render_sprite_sheet([solid(c, 64) for c in colours], 16))))
+        assert sheet.shape == (32, 32, 4)
+        assert tuple(sheet[8, 8]) == colours[0]
+        assert tuple(sheet[8, 24]) == colours[1]
+        assert tuple(sheet[24, 8]) == colours[2]
+        assert tuple(sheet[24, 24]) == (0, 0, 0, 0)
+
+    @pytest.mark.asyncio
+    async def test_sheets_are_cached_by_word_set(
+            self, app: FastAPI, authorized_client: AsyncClient, monkeypatch, tmpdir
+    ) -> None:
+        from app.api.routes import emoticons
+        from app.services.identicon import render_identicons
+        from app.services.variants import render_sprite_sheet
+        from app.storage.files import ShardedFileStorage
+
+        sheets = []
+
+        async def fake_fetch_emoticon(emoticon_word):
+            yield render_identicons([emoticon_word])[0]
+
+        async def fake_render_sheet(images, cell_size):
+            sheets.append(len(images))
+            return render_sprite_sheet(images, cell_size)
+
+        monkeypatch.setattr(emoticons, "EMOTICON_SERVE_MODE", "direct")
+        monkeypatch.setattr(emoticons, "storage", ShardedFileStorage(str(tmpdir), ""))
+        monkeypatch.setattr(emoticons, "fetch_emoticon", fake_fetch_emoticon)
+        monkeypatch.setattr(emoticons.variant_renderer, "render_sheet", fake_render_sheet)
+
+        run = uuid.uuid4().hex
+        emoticon_words = [f"sprite-{run}-{i}" for i in range(3)]
+        first = await authorized_client.post(
+            "/api/fetch_emoticon/sprite", json={"emoticon_words": emoticon_words, "size": 32}
+        )
+        assert first.status_code == HTTP_200_OK
+        assert first.json()["missing"] == []
+        assert first.json()["atlas"][emoticon_words[2]] == {"x": 0, "y": 32, "w": 32, "h": 32}
+
+        second = await authorized_client.post(
+            "/api/fetch_emoticon/sprite", json={"emoticon_words": emoticon_words[::-1], "size": 32}
+        )
+        assert second.json()["url"] == first.json()["url"]
+        assert sheets == [3]
+
+        response = await authorized_client.get(first.json()["url"])
+        assert response.status_code == HTTP_200_OK
+        assert response.headers["content-type"] == "image/png"
+
+        response = await authorized_client.post(
+            "/api/fetch_emoticon/sprite", json={"emoticon_words": emoticon_words, "size": 33}
+        )
+        assert response.status_code == 400
+        sheet_name = first.json()["url"].rsplit("/", 1)[1]
+        response = await authorized_client.get(f"/api/fetch_emoticon/sprite:{sheet_name}")
+        assert response.status_code == 400
+
+    @pytest.mark.asyncio
+    async def test_misses_are_charged_per_word(
+            self, app: FastAPI, authorized_client: AsyncClient, monkeypatch, tmpdir
+    ) -> None:
+        from app.api.routes import emoticons
+        from app.redis.containers import container
+        from app.services.identicon import render_identicons
+        from app.services.variants import render_sprite_sheet
+        from app.storage.files import ShardedFileStorage
+
+        async def fake_fetch_emoticon(emoticon_word):
+            yield render_identicons([emoticon_word])[0]
+
+        async def fake_render_sheet(images, cell_size):
+            return render_sprite_sheet(images, cell_size)
+
+        monkeypatch.setattr(emoticons, "storage", ShardedFileStorage(str(tmpdir), ""))
+        monkeypatch.setattr(emoticons, "fetch_emoticon", fake_fetch_emoticon)
+        monkeypatch.setattr(emoticons.variant_renderer, "render_sheet", fake_render_sheet)
+        monkeypatch.setitem(emoticons.BUDGETS, "miss", (0.001, 2))
+        redis = await container.redis_pool()
+        await redis.delete("ratelimit:miss:username7")
+        try:
+            emoticon_words = [f"sprite-budget-{uuid.uuid4().hex}-{i}" for i in range(4)]
+            response = await authorized_client.post(
+                "/api/fetch_emoticon/sprite", json={"emoticon_words": emoticon_words}
+            )
+            assert response.status_code == HTTP_200_OK
+            assert len(response.json()["atlas"]) == 2
+            assert sorted(response.json()["missing"]) == sorted(set(emoticon_words) - set(response.json()["atlas"]))
+            assert int(response.headers["Retry-After"]) > 0
+
+            response = await authorized_client.post(
+                "/api/fetch_emoticon/sprite", json={"emoticon_words": [f"sprite-budget-{uuid.uuid4().hex}"]}
+            )
+            assert response.status_code == 429
+        finally:
+            await redis.delete("ratelimit:miss:username7")
+
+
+class TestEmoticonGenerationQueue:
+    @pytest.mark.asyncio
+    async def test_queue_mode_defers_misses_to_worker(
+            self, app: FastAPI, authorized_client: AsyncClient, monkeypatch, tmpdir
+    ) -> None:
+        from dependency_injector import providers
+        from app.api.routes import emoticons
+        from app.redis.containers import container
+        from app.redis.generation import GenerationQueue
+        from app.storage.files import ShardedFileStorage
+        from app.worker import GenerationWorker
+
+        async def fake_fetch_emoticon(emoticon_word):
+            yield b"\x89PNG"
+
+        monkeypatch.setattr(emoticons, "EMOTICON_MISS_MODE", "queue")
+        monkeypatch.setattr(emoticons, "storage", ShardedFileStorage(str(tmpdir), ""))
+        monkeypatch.setattr(emoticons, "fetch_emoticon", fake_fetch_emoticon)
+        stream = f"test:generate:{uuid.uuid4().hex}"
+        emoticon_word = f"queued-{uuid.uuid4().hex}"
+
+        with container.generation_queue.override(
+                providers.Factory(GenerationQueue, redis=container.redis_pool, stream=stream, group="test")
+        ):
+            response = await authorized_client.get(f"/api/fetch_emoticon/{emoticon_word}")
+            assert response.status_code == HTTP_202_ACCEPTED
+            status_url = response.json()["status_url"]
+            response = await authorized_client.get(status_url)
+            assert response.json()["status"] == "pending"
+
+            queue = await container.generation_queue()
+            await queue.ensure_group()
+            worker = GenerationWorker(queue, await container.service(), consumer="test", block_ms=100)
+            assert await worker.run_once() == 1
+            assert worker.generated == 1
+
+            response = await authorized_client.get(status_url)
+            assert response.json()["status"] == "ready"
+            await queue._redis.delete(stream)
+
+
+class TestPrewarm:
+    @pytest.mark.asyncio
+    async def test_prewarm_skips_saved_words_and_resumes(self, monkeypatch, tmpdir, caplog) -> None:
+        import logging
+        from types import SimpleNamespace
+        from app import prewarm
+
+        service = FakeService()
+        service.words["already-saved"] = "saved"
+        calls = []
+        failing = {"broken"}
+
+        async def fake_handle_new_emoticon_once(emoticon_word, service):
+            calls.append(emoticon_word)
+            if emoticon_word in failing:
+                raise RuntimeError("upstream down")
+            await service.save_emoticon_word(emoticon_word)
+
+        async def noop(*args, **kwargs) -> None:
+            pass
+
+        async def get_service():
+            return service
+
+        class FakeDatabase:
+            def __init__(self, *args, **kwargs) -> None:
+                pass
+
+            connect = disconnect = noop
+
+        monkeypatch.setattr(prewarm, "handle_new_emoticon_once", fake_handle_new_emoticon_once)
+        monkeypatch.setattr(prewarm, "Database", FakeDatabase)
+        monkeypatch.setattr(prewarm, "container", SimpleNamespace(
+            service=get_service,
+            redis_shards=SimpleNamespace(shutdown=noop),
+            redis_pool=SimpleNamespace(shutdown=noop),
+        ))
+        monkeypatch.setattr(prewarm, "emoticon_generator", SimpleNamespace(start=noop, close=noop))
+        monkeypatch.setattr(prewarm, "emoticon_catalog", SimpleNamespace(run=noop, flush=noop))
+        monkeypatch.setattr(prewarm, "storage", SimpleNamespace(load=noop))
+        caplog.set_level(logging.INFO, logger=prewarm.__name__)
+
+        state_file = str(tmpdir.join("prewarm.done"))
+        with open(state_file, "w") as f:
+            f.write("done-last-run\n")
+        emoticon_words = prewarm.read_words(
+            ["done-last-run\n", "one\n", "\n", "already-saved\n", "two\n", "one\n", "broken"]
+        )
+        assert emoticon_words == ["done-last-run", "one", "already-saved", "two", "broken"]
+
+        progress = await prewarm.prewarm(
+            emoticon_words, workers=2, chunk_size=2, state_file=state_file, report_every=60
+        )
+        assert (progress.total, progress.generated, progress.skipped, progress.failed) == (4, 2, 1, 1)
+        assert sorted(calls) == ["broken", "one", "two"]
+        assert prewarm.read_done(state_file) == {"done-last-run", "one", "already-saved", "two"}
+        assert "4/4 done (2 generated, 1 already saved, 1 failed)" in caplog.text
+
+        calls.clear()
+        failing.clear()
+        progress = await prewarm.prewarm(
+            emoticon_words, workers=2, chunk_size=2, state_file=state_file, report_every=60
+        )
+        assert (progress.total, progress.generated, progress.skipped, progress.failed) == (1, 1, 0, 0)
+        assert calls == ["broken"]
+        assert prewarm.read_done(state_file) == set(emoticon_words)
+
+
+class TestIdenticonGenerator:
+    @pytest.mark.asyncio
+    async def test_identicons_are_deterministic_pngs(self) -> None:
+        import struct
+        import zlib
+        from app.services.identicon import IdenticonGenerator, PNG_SIGNATURE
+
+        generator = IdenticonGenerator(cell_size=4)
+        image = await generator.render("kek")
+        assert image.startswith(PNG_SIGNATURE)
+        assert image == await generator.render("kek")
+        assert image != await generator.render("lol")
+
+        width, height = struct.unpack(">II", image[16:24])
+        assert width == height == 5 * 4 + 2 * 2
+        idat_length, = struct.unpack(">I", image[33:37])
+        assert len(zlib.decompress(image[41:41 + idat_length])) == height * (1 + width * 3)
+
+    @pytest.mark.asyncio
+    async def test_batch_render_matches_single_render(self) -> None:
+        from app.services.identicon import IdenticonGenerator
+
+        generator = IdenticonGenerator(cell_size=4)
+        images = await generator.render_many(["kek", "lol"])
+        assert images["kek"] == await generator.render("kek")
+        assert images["lol"] == await generator.render("lol")
+
+    @pytest.mark.asyncio
+    async def test_concurrent_renders_share_one_batch(self, monkeypatch) -> None:
+        from app.services.identicon import IdenticonGenerator, render_identicons
+
+        batches = []
+
+        def counting_render_identicons(emoticon_words, cell_size):
+            batches.append(list(emoticon_words))
+            return render_identicons(emoticon_words, cell_size)
+
+        monkeypatch.setattr("app.services.identicon.render_identicons", counting_render_identicons)
+        generator = IdenticonGenerator(cell_size=4, max_batch=8)
+        emoticon_words = [f"word-{i // 2}" for i in range(20)]
+        images = await asyncio.gather(*(generator.render(emoticon_word) for emoticon_word in emoticon_words))
+        assert images == [render_identicons([emoticon_word], 4)[0] for emoticon_word in emoticon_words]
+        # the eighth distinct word fills the first batch, its duplicate right after it opens the second
+        assert sorted(len(batch) for batch in batches) == [3, 8]
+
+
+class TestEmoticonCatalog:
+    @pytest.mark.asyncio
+    async def test_catalog_flushes_in_batches_and_rebuilds_redis(self, app: FastAPI, client: AsyncClient) -> None:
+        from app.db.rebuild import rebuild_redis
+        from app.db.repositories.emoticons import EmoticonsRepository
+        from app.redis.containers import container
+        from app.services.catalog import EmoticonCatalog
+
+        db = app.state._db
+        catalog = EmoticonCatalog(batch_size=2)
+        prefix = uuid.uuid4().hex
+        emoticon_words = [f"{prefix}-{i}" for i in range(5)]
+        for i, emoticon_word in enumerate(emoticon_words):
+            catalog.record(emoticon_word, f"aa/bb/{emoticon_word}.png", 100 + i, f"etag-{i}")
+        catalog.touch(emoticon_words[0])
+        catalog.forget([emoticon_words[4]])
+        assert await catalog.flush(db) == 6
+        assert catalog.pending == 0
+
+        emoticons_repo = EmoticonsRepository(db)
+        saved = await emoticons_repo.get_emoticon(word=emoticon_words[1])
+        assert (saved.storage_path, saved.size, saved.etag) == (f"aa/bb/{emoticon_words[1]}.png", 101, "etag-1")
+        assert await emoticons_repo.get_emoticon(word=emoticon_words[4]) is None
+
+        service = await container.service()
+        assert await rebuild_redis(db, service, chunk_size=2) >= 4
+        assert await service.get_emoticon_word(emoticon_words[3]) == "etag-3"
+        assert await rebuild_redis(db, service, chunk_size=2) == 0
+
+        await emoticons_repo.delete_emoticons(words=emoticon_words)
+
+    @pytest.mark.asyncio
+    async def test_catalog_is_backfilled_from_markers_and_media(
+            self, app: FastAPI, client: AsyncClient, monkeypatch, tmpdir
+    ) -> None:
+        from aioredis import create_redis_pool
+
+        from app.db import rebuild
+        from app.db.repositories.emoticons import EmoticonsRepository
+        from app.redis.containers import container
+        from app.redis.services import Service
+        from app.storage.files import ShardedFileStorage
+
+        redis = await create_redis_pool(
+            f"redis://{container.config.redis_host()}/13", password=container.config.redis_password()
+        )
+        storage = ShardedFileStorage(str(tmpdir), "")
+        monkeypatch.setattr(rebuild, "storage", storage)
+        emoticons_repo = EmoticonsRepository(app.state._db)
+        prefix = uuid.uuid4().hex
+        tagged, untagged, missing = (f"{prefix}-{name}" for name in ("tagged", "untagged", "missing"))
+        try:
+            await redis.flushdb()
+            service = Service(redis)
+            stored = await storage.write(tagged, b"12345")
+            await service.save_emoticon_word(tagged, size=stored.size, etag=stored.etag)
+            await storage.write(untagged, b"123")
+            await service.save_emoticon_word(untagged, size=3)
+            await service.save_emoticon_word(missing, size=7)
+
+            assert await rebuild.backfill_catalog(app.state._db, service, chunk_size=1) == 2
+            saved = await emoticons_repo.get_emoticon(word=tagged)
+            assert (saved.storage_path, saved.size, saved.etag) == (storage.relative_path(tagged), 5, stored.etag)
+            saved = await emoticons_repo.get_emoticon(word=untagged)
+            assert (saved.size, saved.etag) == (3, None)
+            assert await emoticons_repo.get_emoticon(word=missing) is None
+        finally:
+            await emoticons_repo.delete_emoticons(words=[tagged, untagged, missing])
+            await redis.flushdb()
+            redis.close()
+            await redis.wait_closed()
+
+    @pytest.mark.asyncio
+    async def test_startup_survives_broken_redis(self, app: FastAPI, client: AsyncClient) -> None:
+        from dependency_injector import providers
+
+        from app.db.tasks import start_emoticon_catalog, stop_emoticon_catalog
+        from app.redis.containers import container
+
+        class BrokenService:
+            async def get_media_usage(self):
+                raise ConnectionRefusedError("redis is down")
+
+        with container.service.override(providers.Object(BrokenService())):
+            await start_emoticon_catalog(app)
+        assert getattr(app.state, "_redis_rebuild", None) is None
+        await stop_emoticon_catalog(app)
+
+
+class TestUsageCounters:
+    def test_space_saving_keeps_heavy_hitters_in_bounded_memory(self) -> None:
+        from app.redis.usage import SpaceSaving
+
+        sketch = SpaceSaving(capacity=10)
+        for i in range(5000):
+            sketch.add("hot" if i % 2 else f"cold-{i}")
+            assert len(sketch) <= 10
+        counts = dict(sketch.guaranteed())
+        assert counts["hot"] == 2500
+
+    @pytest.mark.asyncio
+    async def test_counts_are_flushed_and_ranked(self, app: FastAPI, authorized_client: AsyncClient) -> None:
+        from app.redis.containers import container
+        from app.redis.services import USAGE_WORDS_KEY, USAGE_WORD_MISSES_KEY
+
+        service = await container.service()
+        redis = await container.redis_pool()
+        await service.flush_usage_counters()
+        await redis.delete(USAGE_WORDS_KEY, USAGE_WORD_MISSES_KEY)
+
+        emoticon_word = f"popular-{uuid.uuid4().hex}"
+        for hit in (False, True, True):
+            service.count_emoticon_request(emoticon_word, "username7", hit=hit)
+        service.count_emoticon_request("rare", "username7", hit=True)
+        assert await service.flush_usage_counters() == 4
+
+        response = await authorized_client.get("/api/fetch_emoticon/stats/top", params={"limit": 1})
+        assert response.status_code == HTTP_200_OK
+        assert response.json()["words"] == [{"word": emoticon_word, "requests": 3, "hits": 2, "misses": 1}]
+
+
+class TestRateLimiting:
+    @pytest.mark.asyncio
+    async def test_token_bucket_grants_burst_then_refills(self, app: FastAPI, client: AsyncClient) -> None:
+        from app.redis.containers import container
+
+        rate_limiter = await container.rate_limiter()
+        key = f"test:{uuid.uuid4().hex}"
+        assert await rate_limiter.take(key, rate=1000, burst=3, cost=5) == (0, 1)
+        assert await rate_limiter.take(key, rate=1000, burst=3, cost=5, partial=True) == (3, 1)
+        allowed, retry_after = await rate_limiter.allow(key, rate=1000, burst=3)
+        assert not allowed and retry_after == 1
+        await asyncio.sleep(0.01)
+        assert (await rate_limiter.allow(key, rate=1000, burst=3))[0]
+
+    @pytest.mark.asyncio
+    async def test_new_renders_are_shed_over_the_concurrency_limit(self, monkeypatch) -> None:
+        from app.api.routes import emoticons
+
+        monkeypatch.setattr(emoticons, "GENERATION_MAX_IN_FLIGHT", 1)
+        monkeypatch.setattr(emoticons, "_in_flight", {"busy": asyncio.get_event_loop().create_future()})
+
+        with pytest.raises(emoticons.GenerationOverloaded):
+            await emoticons.handle_new_emoticon_or_shed("another", FakeService())
+
+    @pytest.mark.asyncio
+    async def test_login_is_limited_per_ip(self, app: FastAPI, client: AsyncClient, monkeypatch) -> None:
+        from app.api.dependencies import limits
+
+        monkeypatch.setattr(limits, "RATE_LIMIT_AUTH_RATE", 0.001)
+        monkeypatch.setattr(limits, "RATE_LIMIT_AUTH_BURST", 1)
+        monkeypatch.setattr(limits, "FORWARDED_PROXY_HOPS", 1)
+
+        form = {"username": "nobody", "password": "wrong-password"}
+        headers = {
+            "content-type": "application/x-www-form-urlencoded",
+            "X-Forwarded-For": f"1.2.3.4, {uuid.uuid4().hex}",
+        }
+        first = await client.post(app.url_path_for("users:login-username-and-password"), data=form, headers=headers)
+        second = await client.post(app.url_path_for("users:login-username-and-password"), data=form, headers=headers)
+        assert first.status_code != 429
+        assert second.status_code == 429
+        assert int(second.headers["Retry-After"]) > 0
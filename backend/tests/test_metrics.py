@@ -0,0 +1,60 @@
+import asyncio
+import pytest
+
+from httpx import AsyncClient
+from fastapi import FastAPI
+
+from starlette.status import HTTP_200_OK
+
+
+class TestMetrics:
+    @pytest.mark.asyncio
+    async def test_metrics_label_requests_by_route_template(
+            self, app: FastAPI, authorized_client: AsyncClient
+    ) -> None:
+        await authorized_client.post("/api/fetch_emoticon/batch", json={"emoticon_words": []})
+        response = await authorized_client.get("/metrics")
+        assert response.status_code == HTTP_200_OK
+        assert 'route="/api/fetch_emoticon/batch"' in response.text
+        assert 'connection_pool_in_use{pool="db"}' in response.text
+        assert 'connection_pool_wait_seconds_count{pool="db"}' in response.text
+        assert 'connection_pool_wait_seconds_count{pool="redis"}' not in response.text
+        assert "emoticon_cache_lookups_total" in response.text
+        assert "password_hashing_queue_depth" in response.text
+        assert "password_hashing_in_flight" in response.text
+        assert "password_hashing_rejected_total" in response.text
+        assert 'local_cache_evictions{cache="emoticons"}' in response.text
+        assert 'local_cache_expirations{cache="principals"}' in response.text
+
+
+class TestRequestTiming:
+    @pytest.mark.asyncio
+    async def test_server_timing_breaks_request_into_phases(
+            self, app: FastAPI, authorized_client: AsyncClient
+    ) -> None:
+        response = await authorized_client.post("/api/fetch_emoticon/batch", json={"emoticon_words": ["kek"]})
+        server_timing = response.headers["server-timing"]
+        assert "auth_cache;dur=" in server_timing
+        assert "total;dur=" in server_timing
+
+    @pytest.mark.asyncio
+    async def test_profiler_only_runs_for_the_admin_token(self, tmpdir) -> None:
+        from starlette.applications import Starlette
+        from starlette.datastructures import Secret
+        from starlette.responses import PlainTextResponse
+        from app.core.timing import ProfilerMiddleware
+
+        inner = Starlette()
+
+        @inner.route("/slow")
+        async def slow(request):
+            await asyncio.sleep(0.01)
+            return PlainTextResponse("ok")
+
+        profiled = ProfilerMiddleware(inner, token=Secret("letmein"), directory=str(tmpdir))
+        async with AsyncClient(app=profiled, base_url="http://testserver") as client:
+            await client.get("/slow", headers={"X-Profile": "wrong"})
+            assert tmpdir.listdir() == []
+            response = await client.get("/slow", headers={"X-Profile": "letmein"})
+            assert response.status_code == HTTP_200_OK
+        assert len(tmpdir.listdir()) == 1
@@ -188,3 +188,46 @@ class TestUserLogin:
         res = await client.post(app.url_path_for("users:login-username-and-password"), data=login_data)
         assert res.status_code == status_code
         assert "access_token" not in res.json()
+
+
+class TestPasswordHashingPool:
+    async def test_hashing_runs_off_the_event_loop(self) -> None:
+        from app.services.authentication import AuthService, PasswordHashingPool
+
+        service = AuthService(hashing_pool=PasswordHashingPool(kind="thread", workers=2, max_backlog=8))
+        hashed_password = await service.hash_password_async(password="password1234567")
+        assert await service.verify_password_async(password="password1234567", hashed_password=hashed_password)
+        assert service.hashing_pool.stats()["completed"] == 2
+        service.hashing_pool.shutdown()
+
+    async def test_hashing_rejects_work_past_backlog(self) -> None:
+        from fastapi import HTTPException
+        from app.services.authentication import PasswordHashingPool
+
+        pool = PasswordHashingPool(kind="thread", workers=1, max_backlog=0)
+        with pytest.raises(HTTPException):
+            await pool.run(len, "password")
+        assert pool.stats()["rejected"] == 1
+
+
+class TestPrincipalCache:
+    async def test_cached_principal_is_returned_until_invalidated(self) -> None:
+        import time
+        from app.services.principals import PrincipalCache
+
+        cache = PrincipalCache(max_size=10, ttl=60)
+        user = UserInDB(id=1, username="username7", password="hashedpassword")
+        await cache.set("token", user, expires_at=time.time() + 3600)
+        assert (await cache.get("token")).username == user.username
+
+        await cache.invalidate_user(user.username)
+        assert await cache.get("token") is None
+
+    async def test_expired_token_is_not_cached(self) -> None:
+        import time
+        from app.services.principals import PrincipalCache
+
+        cache = PrincipalCache(max_size=10, ttl=60)
+        user = UserInDB(id=1, username="username7", password="hashedpassword")
+        await cache.set("token", user, expires_at=time.time() - 1)
+        assert await cache.get("token") is None